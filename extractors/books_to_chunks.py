@@ -1,51 +1,119 @@
 import argparse
+import bisect
 import os
+import shutil
 import tqdm
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
 
 from library.english_constants import abbreviated_titles
-from library.token_count import get_token_count, get_tokens, decode_tokens
+from library.batching_utils import run_in_process_pool, ShardWriter, SHARD_FORMATS, get_shard_path
+from library.chunk_manifest import ChunkManifest
+from library.token_count import get_tokens_batch, decode_tokens, get_token_count_cache, \
+    get_tokenizer_id, init_tokenizer
 
 LINE_ENDINGS = (".", "?", "'", '"')
 
 
-def break_text_into_chunks(input_file: str, output_folder: str, max_tokens: int, exclude_if_too_long: bool) -> None:
-    print("book_to_chunks processing: ", input_file)
+def break_text_into_chunks(input_file: str, output_folder: str, max_tokens: int, exclude_if_too_long: bool,
+                           streaming: bool = False, show_progress: bool = True,
+                           shard_format: Optional[str] = None) -> int:
+    """
+    :param input_file:
+    :param output_folder:
+    :param max_tokens:
+    :param exclude_if_too_long:
+    :param streaming: If true, the file is read a line at a time instead of all at once. Memory use is then bounded by
+        the chunk size (plus a batch of paragraphs) instead of the size of the file.
+    :param show_progress: If false, nothing is printed (e.g. when running in a worker process).
+    :param shard_format: If set (see SHARD_FORMATS), the chunks are written to a single shard next to output_folder
+        (e.g. the_bible.chunks.jsonl) instead of a file per chunk in output_folder.
+    :return: the number of chunks written.
+    """
+    if show_progress:
+        print("book_to_chunks processing: ", input_file)
+    chunk_count = 0
     with open(input_file, 'r', encoding='utf-8', errors='ignore') as file:
-        content = file.read()
+        lines = file if streaming else file.read().split("\n")
+        paragraphs = tqdm.tqdm(iter_paragraphs(strip_bom(lines)), "processing paragraphs", disable=not show_progress)
+        chunks = iter_chunks(paragraphs, max_tokens, exclude_if_too_long)
+
+        if shard_format:
+            source = os.path.basename(output_folder)
+            os.makedirs(os.path.dirname(output_folder) or ".", exist_ok=True)
+            with ShardWriter(get_shard_path(os.path.dirname(output_folder), source, shard_format),
+                             shard_format) as shard:
+                for chunk in chunks:
+                    chunk_count += 1
+                    shard.write(source, chunk_count, chunk.text, chunk.token_count)
+            return chunk_count
+
+        # Write chunks to separate text files in the output folder
+        os.makedirs(output_folder, exist_ok=True)
+        for chunk in chunks:
+            chunk_count += 1
+            output_file = os.path.join(output_folder, f"chunk_{chunk_count}.txt")
+            with open(output_file, 'w', encoding='utf-8') as chunk_file:
+                chunk_file.write(chunk.text)
+    return chunk_count
+
+
+def strip_bom(lines: Iterable[str]) -> Iterator[str]:
     # strip BOM since str.strip() won't do it.
-    if ord(content[0]) == 65279:
-        content = content[1:]
+    for index, line in enumerate(lines):
+        if index == 0 and len(line) > 0 and ord(line[0]) == 65279:
+            line = line[1:]
+        yield line
 
-    paragraphs = preprocess_text(content)
-    paragraphs = apply_token_cap_to_paragraphs(paragraphs, exclude_if_too_long, max_tokens-1)
 
-    chunks = []
-    start_index = 0
-    end_index = 0
-    token_count = 0
+class Chunk(NamedTuple):
+    text: str
+    # the paragraphs' token counts, plus one per newline between them. A paragraph can take a token fewer after a
+    # newline than on its own, so this can be a little over the count of the text.
+    token_count: int
 
-    for index, paragraph in tqdm.tqdm(enumerate(paragraphs), "processing paragraphs"):
-        paragraph_tokens = get_token_count(paragraph)
 
-        # pad token count by 1 for newline
-        if token_count + paragraph_tokens + 1 < max_tokens:
-            end_index = index
-            token_count = token_count + paragraph_tokens + 1
-        else:
-            chunks.append("\n".join(paragraphs[start_index:end_index+1]))
-            start_index = index
-            end_index = index
-            token_count = paragraph_tokens
+def iter_chunks(paragraphs: Iterable[str], max_tokens: int, exclude_if_too_long: bool,
+                batch_size: int = 1000) -> Iterator[Chunk]:
+    """
+    Join paragraphs into chunks of less than max_tokens, yielding each chunk as soon as it's complete.
+    Paragraphs are tokenized batch_size at a time; a chunk's token count is added up from its paragraphs', so chunks
+    aren't tokenized again.
 
-        if index == len(paragraphs) - 1:
-            chunks.append("\n".join(paragraphs[start_index:end_index+1]))
+    :param paragraphs:
+    :param max_tokens:
+    :param exclude_if_too_long:
+    :param batch_size:
+    :return:
+    """
+    chunk = []
+    token_count = 0
+    chunk_token_count = 0
+    for batch in iter_batches(paragraphs, batch_size):
+        for paragraph in apply_token_cap_to_paragraphs(batch, exclude_if_too_long, max_tokens-1):
+            # pad token count by 1 for newline
+            if token_count + paragraph.token_count + 1 < max_tokens:
+                chunk_token_count += paragraph.token_count + (1 if chunk else 0)
+                chunk.append(paragraph.text)
+                token_count = token_count + paragraph.token_count + 1
+            else:
+                if chunk:
+                    yield Chunk("\n".join(chunk), chunk_token_count)
+                chunk = [paragraph.text]
+                token_count = paragraph.token_count
+                chunk_token_count = paragraph.token_count
+    if chunk:
+        yield Chunk("\n".join(chunk), chunk_token_count)
 
-    # Write chunks to separate text files in the output folder
-    os.makedirs(output_folder, exist_ok=True)
-    for i, chunk in enumerate(chunks):
-        output_file = os.path.join(output_folder, f"chunk_{i + 1}.txt")
-        with open(output_file, 'w', encoding='utf-8') as file:
-            file.write(chunk)
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def preprocess_text(content: str) -> list[str]:
@@ -58,10 +126,16 @@ def preprocess_text(content: str) -> list[str]:
     :param content:
     :return:
     """
-    content = content.replace("’", "'")
-    lines = content.split("\n")
+    return list(iter_paragraphs(content.split("\n")))
+
+
+def iter_paragraphs(lines: Iterable[str]) -> Iterator[str]:
+    """
+    The generator behind preprocess_text, which takes the lines of the text one at a time (e.g. from an open file).
 
-    paragraphs = []
+    :param lines:
+    :return:
+    """
     current_paragraph = []
 
     def is_paragraph_start(l: str) -> bool:
@@ -79,7 +153,7 @@ def preprocess_text(content: str) -> list[str]:
         return l.endswith(LINE_ENDINGS)
 
     for line in lines:
-        line = line.strip()
+        line = line.replace("’", "'").strip()
         if len(line) == 0:
             continue
         if line.isnumeric():
@@ -94,62 +168,158 @@ def preprocess_text(content: str) -> list[str]:
             continue
 
         if is_end_of_paragraph(line):
-            paragraphs.append(" ".join(current_paragraph))
+            yield " ".join(current_paragraph)
             current_paragraph = []
 
     if current_paragraph:
-        paragraphs.append("\n".join(current_paragraph))
+        yield "\n".join(current_paragraph)
 
-    return paragraphs
 
+class Paragraph(NamedTuple):
+    text: str
+    tokens: list[str]
 
-def apply_token_cap_to_paragraphs(paragraphs: list[str], exclude_if_too_long: bool, max_tokens: int):
-    result = []
-    for paragraph in paragraphs:
-        tokens = get_tokens(paragraph)
+    @property
+    def token_count(self) -> int:
+        return len(self.tokens)
+
+
+def apply_token_cap_to_paragraphs(paragraphs: list[str], exclude_if_too_long: bool,
+                                  max_tokens: int) -> list[Paragraph]:
+    """
+    Tokenize the paragraphs (once) and break up, or exclude, those with more than max_tokens.
+    Broken up paragraphs are split at a word or sentence boundary where possible.
+
+    :param paragraphs:
+    :param exclude_if_too_long:
+    :param max_tokens:
+    :return: the resulting paragraphs, along with their tokens.
+    """
+    result = []  # type: list[Union[Paragraph, str]]
+    for paragraph, tokens in zip(paragraphs, get_tokens_batch(paragraphs)):
         if len(tokens) <= max_tokens:
-            result.append(paragraph)
+            result.append(Paragraph(paragraph, tokens))
         elif exclude_if_too_long:
             continue
         else:
-            remaining_tokens = tokens
-            print(len(tokens))
-            while len(remaining_tokens):
-                if len(remaining_tokens) < max_tokens - 1:
-                    result.append(decode_tokens(remaining_tokens))
-                    break
-                end_token = max_tokens - 1
-                keep, carry = None, None
-                while end_token > 0:
-                    print(end_token, "end token", remaining_tokens[end_token])
-                    if "." == remaining_tokens[end_token]:
-                        keep, carry = remaining_tokens[end_token], None
-                        break
-                    if "▁" == remaining_tokens[end_token][0]:
-                        keep, carry = None, remaining_tokens[end_token]
-                        break
-                    if "▁" == remaining_tokens[end_token][-1]:
-                        keep, carry = remaining_tokens[end_token], None
-                        break
-                    end_token = end_token - 1
-                fragment_tokens = remaining_tokens[:end_token]
-                if keep:
-                    fragment_tokens.append(keep)
-                result.append(decode_tokens(fragment_tokens))
-                remaining_tokens = remaining_tokens[end_token+1:]
-                if carry:
-                    remaining_tokens = [carry] + remaining_tokens
-    return result
-
-
-def books_to_chunks(in_folder: str, out_folder: str, max_tokens: int, exclude_if_too_long: bool = False):
-    for f in os.listdir(in_folder):
-        if not f.endswith(".txt"):
+            result.extend([decode_tokens(f) for f in split_tokens(tokens, max_tokens)])
+
+    # fragments are re-tokenized, since decoding and encoding a fragment doesn't always give back the same tokens
+    # (e.g. a fragment that starts mid-word gains a leading space).
+    fragments = [p for p in result if isinstance(p, str)]
+    fragment_tokens = iter(get_tokens_batch(fragments))
+    return [Paragraph(p, next(fragment_tokens)) if isinstance(p, str) else p for p in result]
+
+
+def split_tokens(tokens: list[str], max_tokens: int) -> list[list[str]]:
+    """
+    Split a paragraph's tokens into fragments that fit in max_tokens.
+    Each fragment ends at the last boundary that fits: after a '.' or a token ending with a space, or before a token
+    starting with a space. If there's no boundary, the fragment is cut after max_tokens - 1 tokens.
+
+    :param tokens:
+    :param max_tokens:
+    :return:
+    """
+    # boundaries[i] is a position in tokens, cut_after[i] is whether the cut comes after that token
+    boundaries = []
+    cut_after = []
+    for position, token in enumerate(tokens):
+        if token == ".":
+            boundaries.append(position)
+            cut_after.append(True)
+        elif token[0] == "▁":
+            boundaries.append(position)
+            cut_after.append(False)
+        elif token[-1] == "▁":
+            boundaries.append(position)
+            cut_after.append(True)
+
+    fragments = []
+    start = 0
+    while len(tokens) - start >= max_tokens - 1:
+        # the last boundary within max_tokens - 1 tokens, excluding the fragment's first token
+        last_position = start + min(max_tokens - 1, len(tokens) - start - 1)
+        boundary_index = bisect.bisect_right(boundaries, last_position) - 1
+        if boundary_index >= 0 and boundaries[boundary_index] > start:
+            end = boundaries[boundary_index] + (1 if cut_after[boundary_index] else 0)
+        else:
+            end = start + max_tokens - 1
+        fragments.append(tokens[start:end])
+        start = end
+    if start < len(tokens):
+        fragments.append(tokens[start:])
+    return fragments
+
+
+def books_to_chunks(in_folder: str, out_folder: str, max_tokens: int, exclude_if_too_long: bool = False,
+                    streaming: bool = False, workers: int = 1, shard_format: Optional[str] = None):
+    """
+    :param in_folder:
+    :param out_folder:
+    :param max_tokens:
+    :param exclude_if_too_long:
+    :param streaming: see break_text_into_chunks.
+    :param workers: the number of processes to split the books across. Each book's output only depends on the book,
+        so the output is the same for any number of workers.
+    :param shard_format: see break_text_into_chunks.
+    :return:
+    """
+    # books that are unchanged since the last run (with the same settings) are skipped; see ChunkManifest.
+    manifest = ChunkManifest(out_folder, {"max_tokens": max_tokens,
+                                          "exclude_if_too_long": exclude_if_too_long,
+                                          "shard_format": shard_format,
+                                          "tokenizer": get_tokenizer_id()})
+    filenames = sorted([f for f in os.listdir(in_folder) if f.endswith(".txt")])
+    deleted = manifest.remove_deleted_inputs(filenames)
+
+    jobs = []
+    for f in filenames:
+        input_file = os.path.join(in_folder, f)
+        if manifest.is_up_to_date(f, input_file):
             continue
-        break_text_into_chunks(os.path.join(in_folder, f),
-                               os.path.join(out_folder, f.replace(".txt", "")),
-                               max_tokens,
-                               exclude_if_too_long=exclude_if_too_long)
+        book_folder = os.path.join(out_folder, f.replace(".txt", ""))
+        manifest.remove_outputs(f)
+        for output_path in get_book_output_paths(book_folder):
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            elif os.path.isfile(output_path):
+                os.remove(output_path)
+        jobs.append((input_file,
+                     book_folder,
+                     max_tokens,
+                     exclude_if_too_long,
+                     streaming,
+                     workers <= 1,
+                     shard_format))
+
+    chunk_counts = run_in_process_pool(break_text_into_chunks_job, jobs, workers, "books",
+                                       initializer=init_tokenizer, initargs=(1,))
+    for job in jobs:
+        input_file, book_folder = job[0], job[1]
+        manifest.record(os.path.basename(input_file), input_file,
+                        [p for p in get_book_output_paths(book_folder) if os.path.exists(p)])
+    manifest.save()
+    print(f"books_to_chunks wrote {sum(chunk_counts)} chunks from {len(jobs)} books "
+          f"({len(filenames) - len(jobs)} unchanged books skipped, {len(deleted)} deleted books removed)")
+
+
+def get_book_output_paths(book_folder: str) -> list[str]:
+    """
+    :param book_folder:
+    :return: everything a book can be written to: its folder of chunks, or a shard in any format.
+    """
+    return [book_folder] + [get_shard_path(os.path.dirname(book_folder), os.path.basename(book_folder), f)
+                            for f in SHARD_FORMATS]
+
+
+def break_text_into_chunks_job(input_file: str, output_folder: str, max_tokens: int, exclude_if_too_long: bool,
+                               streaming: bool, show_progress: bool, shard_format: Optional[str]) -> int:
+    chunk_count = break_text_into_chunks(input_file, output_folder, max_tokens, exclude_if_too_long,
+                                         streaming=streaming, show_progress=show_progress, shard_format=shard_format)
+    # worker processes exit without running atexit handlers, so save token counts while we can.
+    get_token_count_cache().flush()
+    return chunk_count
 
 
 if __name__ == "__main__":
@@ -166,6 +336,15 @@ if __name__ == "__main__":
                         'max_tokens should be your training length minus your expected prompt length. \n')
     parser.add_argument('-exclude', action='store_true', help='Excludes paragraphs that are longer than max_tokens. \n'
                         'By default, excessively long paragraphs will be broken at word boundaries. \n')
+    parser.add_argument('-streaming', action='store_true', help='Reads each file a line at a time and writes each '
+                        'chunk as soon as it is complete, so memory use does not grow with the size of the file. \n'
+                        'Use for multi-gigabyte inputs. \n')
+    parser.add_argument('--workers', type=int, default=1, help='The number of processes to split the books across. \n'
+                        'Output is the same regardless of the number of workers. \n')
+    parser.add_argument('--shard_format', type=str, choices=SHARD_FORMATS, default=None, help='Writes each book to a '
+                        'single {output_folder}/Derp.chunks.jsonl (or .parquet) shard instead of a file per chunk. \n'
+                        'Each record has the source book, chunk index, text and token count. \n')
 
     args = parser.parse_args()
-    books_to_chunks(args.input_folder, args.output_folder, args.max_tokens, args.exclude)
+    books_to_chunks(args.input_folder, args.output_folder, args.max_tokens, args.exclude, args.streaming, args.workers,
+                    args.shard_format)
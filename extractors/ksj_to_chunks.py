@@ -2,8 +2,12 @@ import argparse
 import json
 import os
 import re
+from typing import Optional
 
-from library.token_count import get_token_count
+from library.batching_utils import ShardWriter, SHARD_FORMATS, get_shard_path, run_in_process_pool
+from library.chunk_manifest import ChunkManifest
+from library.token_count import get_token_count, get_continued_token_counts, get_tokenizer_id, \
+    get_token_count_cache, init_tokenizer
 from library.settings_manager import ROOT_FOLDER
 
 VN_LOCATIONS = os.path.join(ROOT_FOLDER, "ksj_locations.json")
@@ -11,20 +15,27 @@ VN_NAMES = os.path.join(ROOT_FOLDER, "ksj_names.json")
 DEFAULT_NARRATOR = "NARRATOR (V.O.)"
 
 
-def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_tokens: int) -> None:
+def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_tokens: int,
+                       shard_format: Optional[str] = None,
+                       locations_map: Optional[dict[str, str]] = None) -> tuple[list[str], dict[str, str], dict[str, str]]:
     """
     Takes in a single .ksj script file and:
     - formats the contents as a screenplay, keeping narration, dialog and scene change markers.
     - outputs the contents in max_token length files (using the sentencepiece tokenizer).
     - separates out files containing roleplay actions into a separate /roleplay/ folder.
-    - additionally, outputs story constants like character names and locations to files in the project root.
+    - additionally, returns story constants like character names and locations, for ksj_folder_to_chunks to save.
     - skips files that contain branches.
 
     :param in_folder:
     :param filename:
     :param out_folder:
     :param max_tokens:
-    :return:
+    :param shard_format: If set (see SHARD_FORMATS), the chunks are written to a {script}.chunks.{shard_format} shard
+        (and one in /roleplay/) instead of a file per chunk.
+    :param locations_map: the location registry (see load_registries), which maps scene markers to location names.
+        Loaded from VN_LOCATIONS if not given. It isn't modified, so that each script's output only depends on the
+        registry it started with.
+    :return: the paths of the chunks (or shards) that were written, the newly discovered locations and the names.
     """
 
     """
@@ -80,18 +91,11 @@ def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_token
         print("\tDiscovered a branch, exiting")
 
     final_script = []
-    if os.path.exists(VN_LOCATIONS):
-        with open(VN_LOCATIONS, "rb") as f:
-            locations_map = json.load(f)
-    else:
-        locations_map = {}
+    if locations_map is None:
+        locations_map, _ = load_registries()
     locations_original_and_new = set(locations_map.keys()).union(locations_map.values())
-
-    if os.path.exists(VN_NAMES):
-        with open(VN_NAMES, "rb") as f:
-            all_names = json.load(f)
-    else:
-        all_names = {}
+    new_locations = {}
+    names = {}
 
     # for every line...
     for l in ksj_lines:
@@ -100,8 +104,9 @@ def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_token
         if l.startswith(";◇◇◇："):
             if l.startswith(";◇◇◇：背景指定  ：～昼夕夜etc"):
                 continue
-            locations_map[l] = locations_map.get(l, l)
-            location_line = locations_map[l] + "\n"
+            if l not in locations_map:
+                new_locations[l] = l
+            location_line = locations_map.get(l, l) + "\n"
             if len(final_script) == 0:
                 final_script.append(location_line)
             elif final_script[-1].strip() in locations_original_and_new:
@@ -114,7 +119,7 @@ def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_token
             start_pos = l.find('"') + 1
             end_pos = l.find('"', start_pos)
             name = l[start_pos:end_pos]
-            all_names[name] = name
+            names[name] = name
             final_script.append(name.upper() + "\n")
             continue
         if len(l) == 0 or l[0] in ["@", ";", "*"]:
@@ -141,46 +146,75 @@ def convert_ksj_script(in_folder: str, filename: str, out_folder: str, max_token
                 continue
         condensed_script.append(l)
 
-    with open(VN_LOCATIONS, 'w') as f:
-        json.dump(locations_map, f, ensure_ascii=False, indent=2)
-    with open(VN_NAMES, 'w') as f:
-        json.dump(all_names, f, ensure_ascii=False, indent=2)
-
     os.makedirs(out_folder, exist_ok=True)
     out_folder_roleplay = os.path.join(out_folder, "roleplay")
     os.makedirs(out_folder_roleplay, exist_ok=True)
 
+    # the chunk's token count is kept as a running total, so that each line is only tokenized once: as it follows the
+    # previous line. only the first line of a chunk is tokenized again, on its own.
+    continued_line_token_counts = get_continued_token_counts(condensed_script)
+
+    chunks = []
     last_location = ""
-    current_chunk = ""
+    chunk_lines = []
+    token_count = 0
     chunk_index = 0
     for i, l in enumerate(condensed_script):
         if l.strip() in locations_original_and_new:
             last_location = l.strip()
+        elif len(chunk_lines) == 0 and last_location != "":
+            chunk_lines.append(last_location + "\n")
+            token_count = get_token_count(chunk_lines[0])
+        # the token count of the chunk without this line, which is what's written if this line doesn't fit.
+        chunk_token_count = token_count if chunk_lines else 0
+        if len(chunk_lines) == 0:
+            token_count = get_token_count(l)
         else:
-            if current_chunk == "" and last_location != "":
-                current_chunk = last_location + "\n"
-        prev_chunk = current_chunk
-        current_chunk += l
-        token_count = get_token_count(current_chunk)
+            token_count += continued_line_token_counts[i]
+        chunk_lines.append(l)
 
         if token_count > max_tokens or i == len(condensed_script) - 1:
+            prev_chunk = "".join(chunk_lines[:-1])
             # get rid of roleplay tags *UWU*
             pattern = r'\*.*?\*'  # Regular expression pattern to match *BLAH*
             matches = re.findall(pattern, prev_chunk)
-            if not matches:
-                output_path = get_file_chunk_output_path(filename, chunk_index, out_folder)
-            else:
-                output_path = get_file_chunk_output_path(filename, chunk_index, out_folder_roleplay)
-            with open(output_path, 'w', encoding='utf-8') as file:
-                file.write(prev_chunk)
-            current_chunk = ""
+            chunks.append((chunk_index, prev_chunk, len(matches) > 0, chunk_token_count))
+            chunk_lines = []
             chunk_index += 1
 
+    if shard_format:
+        return write_chunk_shards(filename, chunks, out_folder, out_folder_roleplay, shard_format), new_locations, names
 
-def get_file_output_path(filename: str, prompts_folder: str) -> str:
-    chunk_name, extension = os.path.splitext(filename)
-    out_name = f"{chunk_name}.txt"
-    return os.path.join(prompts_folder, out_name)
+    output_paths = []
+    for chunk_index, chunk, is_roleplay, _ in chunks:
+        output_path = get_file_chunk_output_path(filename, chunk_index,
+                                                 out_folder_roleplay if is_roleplay else out_folder)
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(chunk)
+        output_paths.append(output_path)
+    return output_paths, new_locations, names
+
+
+def write_chunk_shards(filename: str, chunks: list[tuple[int, str, bool, int]], out_folder: str,
+                       out_folder_roleplay: str, shard_format: str) -> list[str]:
+    """
+    write a script's chunks to one shard in out_folder and one in out_folder_roleplay, instead of a file per chunk.
+
+    :param filename:
+    :param chunks: (chunk index, text, whether it contains roleplay actions, token count) for each chunk.
+    :param out_folder:
+    :param out_folder_roleplay:
+    :param shard_format:
+    :return: the paths of the shards that were written.
+    """
+    source, extension = os.path.splitext(filename)
+    shards = {False: ShardWriter(get_shard_path(out_folder, source, shard_format), shard_format),
+              True: ShardWriter(get_shard_path(out_folder_roleplay, source, shard_format), shard_format)}
+    for chunk_index, chunk, is_roleplay, token_count in chunks:
+        shards[is_roleplay].write(source, chunk_index, chunk, token_count)
+    for shard in shards.values():
+        shard.close()
+    return [shard.path for shard in shards.values() if shard.record_count > 0]
 
 
 def get_file_chunk_output_path(filename: str, index: int, prompts_folder: str) -> str:
@@ -189,20 +223,107 @@ def get_file_chunk_output_path(filename: str, index: int, prompts_folder: str) -
     return os.path.join(prompts_folder, out_name)
 
 
-def ksj_folder_to_chunks(in_folder: str, out_folder: str, max_tokens: int) -> None:
+def load_registries() -> tuple[dict[str, str], dict[str, str]]:
+    """
+    :return: the location and name registries from the project root (VN_LOCATIONS and VN_NAMES).
+    """
+    registries = []
+    for path in [VN_LOCATIONS, VN_NAMES]:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                registries.append(json.load(f))
+        else:
+            registries.append({})
+    locations_map, all_names = registries
+    return locations_map, all_names
+
+
+def save_registries(locations_map: dict[str, str], all_names: dict[str, str]):
+    with open(VN_LOCATIONS, 'w') as f:
+        json.dump(locations_map, f, ensure_ascii=False, indent=2)
+    with open(VN_NAMES, 'w') as f:
+        json.dump(all_names, f, ensure_ascii=False, indent=2)
+
+
+def merge_discoveries(locations_map: dict[str, str], all_names: dict[str, str],
+                      discoveries: list[tuple[dict[str, str], dict[str, str]]]):
+    """
+    Add each script's new locations and names to the registries. Scripts are merged in the order given (by filename),
+    and existing locations keep their mapping, so the result doesn't depend on which worker finished first.
+
+    :param locations_map:
+    :param all_names:
+    :param discoveries: the new locations and names of each script.
+    :return:
+    """
+    for new_locations, names in discoveries:
+        for location, location_name in new_locations.items():
+            locations_map.setdefault(location, location_name)
+        all_names.update(names)
+
+
+# the location registry of a worker process, so that it's sent to each worker once instead of with every script.
+_worker_locations_map = None  # type: Optional[dict[str, str]]
+
+
+def init_worker(locations_map: dict[str, str]):
+    global _worker_locations_map
+    _worker_locations_map = locations_map
+    init_tokenizer(1)
+
+
+def convert_ksj_script_job(in_folder: str, filename: str, out_folder: str, max_tokens: int,
+                           shard_format: Optional[str]) -> tuple[list[str], dict[str, str], dict[str, str]]:
+    result = convert_ksj_script(in_folder, filename, out_folder, max_tokens, shard_format=shard_format,
+                                locations_map=_worker_locations_map)
+    # worker processes exit without running atexit handlers, so save token counts while we can.
+    get_token_count_cache().flush()
+    return result
+
+
+def ksj_folder_to_chunks(in_folder: str, out_folder: str, max_tokens: int, shard_format: Optional[str] = None,
+                         workers: int = 1) -> None:
     """
-    take a folder of ksj scripts and write each converted script to the out folder
+    take a folder of ksj scripts and write each converted script to the out folder.
+    scripts that are unchanged since the last run (with the same settings) are skipped; see ChunkManifest.
+    the name and location registries are loaded once, and updated once with what every script discovered.
 
     :param in_folder:
     :param out_folder:
     :param max_tokens:
+    :param shard_format: see convert_ksj_script.
+    :param workers: the number of processes to split the scripts across. Every script is converted with the
+        registries from the start of the run, so the output is the same for any number of workers.
     :return:
     """
-    for filename in os.listdir(in_folder):
-        if os.path.isfile(os.path.join(in_folder, filename)):
-            output_path = get_file_output_path(filename, out_folder)
-            if not os.path.exists(output_path) and filename.endswith(".ks"):
-                convert_ksj_script(in_folder, filename, out_folder, max_tokens)
+    global _worker_locations_map
+    manifest = ChunkManifest(out_folder, {"max_tokens": max_tokens,
+                                          "shard_format": shard_format,
+                                          "tokenizer": get_tokenizer_id()})
+    filenames = sorted([f for f in os.listdir(in_folder)
+                        if os.path.isfile(os.path.join(in_folder, f)) and f.endswith(".ks")])
+    manifest.remove_deleted_inputs(filenames)
+
+    jobs = []
+    for filename in filenames:
+        if manifest.is_up_to_date(filename, os.path.join(in_folder, filename)):
+            continue
+        manifest.remove_outputs(filename)
+        jobs.append((in_folder, filename, out_folder, max_tokens, shard_format))
+
+    locations_map, all_names = load_registries()
+    # with workers <= 1, the jobs run in this process, which the initializer doesn't.
+    _worker_locations_map = locations_map
+    results = run_in_process_pool(convert_ksj_script_job, jobs, workers, "scripts",
+                                  initializer=init_worker, initargs=(locations_map,))
+    _worker_locations_map = None
+
+    for job, (output_paths, _, _) in zip(jobs, results):
+        filename = job[1]
+        manifest.record(filename, os.path.join(in_folder, filename), output_paths)
+    manifest.save()
+    merge_discoveries(locations_map, all_names, [(new_locations, names) for _, new_locations, names in results])
+    save_registries(locations_map, all_names)
 
 
 if __name__ == "__main__":
@@ -224,6 +345,10 @@ python extractors.ksj_to_chunks  --input_folder /in --output_folder /out --max_t
                         'Splits at paragraph boundaries, so the actual length of output files will vary. \n'
                         'Uses the default tokenizer for Llama and Llama2 (sentencepiece) to determine token count. \n'
                         'max_tokens should be your training length minus your expected prompt length. \n')
+    parser.add_argument('--shard_format', type=str, choices=SHARD_FORMATS, default=None, help='Writes each script to a '
+                        'single {output_folder}/Derp.chunks.jsonl (or .parquet) shard instead of a file per chunk. \n')
+    parser.add_argument('--workers', type=int, default=1, help='The number of processes to split the scripts across. \n'
+                        'Output is the same regardless of the number of workers. \n')
     args = parser.parse_args()
-    ksj_folder_to_chunks(args.input_folder, args.output_folder, args.max_tokens)
+    ksj_folder_to_chunks(args.input_folder, args.output_folder, args.max_tokens, args.shard_format, args.workers)
 
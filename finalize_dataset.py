@@ -4,9 +4,11 @@ import json
 import random
 import tqdm
 
+from library.batching_utils import ChunkInput, list_inputs
 from library.prompt_parser import generate_dataset_row_from_prompt_dict, prepare_prompt_dict_for_row,\
-    estimate_total_tokens
+    estimate_total_tokens_batch, replace_unicode_quotes
 from library.settings_manager import settings
+from library.token_count import get_token_counts, get_token_count_cache
 from library.hacks_dataset_specific import narrow_authors_in_prompt_dict, alias_similar_keys
 
 PROMPT_CACHE = {}
@@ -53,44 +55,13 @@ def make_dataset(prompts_folders, outfile_path, validation_path, info_path, max_
     info_dict = {}
     queue = []
     for prompts_folder in prompts_folders:
-        for story_name in os.listdir(prompts_folder):
-            if not os.path.isdir(os.path.join(prompts_folder, story_name)):
-                continue
-            for prompt_file in os.listdir(os.path.join(prompts_folder, story_name)):
-                prompt_fp = os.path.join(prompts_folder, story_name, prompt_file)
-                if os.path.isfile(prompt_fp) and prompt_file.endswith(".json"):
-                    queue.append(prompt_fp)
-
-    for prompt_fp in tqdm.tqdm(queue):
+        queue.extend(list_inputs(prompts_folder, extensions=(".json",)))
+
+    load_uncached_prompts(queue)
+
+    for prompt_input in tqdm.tqdm(queue):
         try:
-            if prompt_fp in PROMPT_CACHE:
-                new_prompt, tokens_used, prompt_dict, length = PROMPT_CACHE[prompt_fp]
-            else:
-                with open(prompt_fp, 'r', encoding='utf-8') as file:
-                    prompt_json = file.read()
-                prompt_dict = json.loads(prompt_json)
-                prompt_dict = prepare_prompt_dict_for_row(prompt_dict)
-                if settings.get_setting("hacks.redistribute_authors"):
-                    prompt_dict = narrow_authors_in_prompt_dict(prompt_dict)
-                if settings.get_setting("hacks.swap_tag_values"):
-                    prompt_dict = alias_similar_keys(prompt_dict)
-                try:
-                    prompt_dict, style, context, inst, length, story, system = generate_dataset_row_from_prompt_dict(
-                        prompt_dict,
-                        droppable_tags=settings.get_setting("prompt_format.droppable_tags"),
-                        drop_tags_prob=settings.get_setting("prompt_format.tag_drop_rate"))
-                    tokens_used = estimate_total_tokens([style, context, inst, story, system])
-                except Exception as e:
-                    print("Exception on:", prompt_dict)
-                    raise e
-
-                new_prompt = {'system': system,
-                              'context': context,
-                              'instruction': (style + "\n" + inst).strip(),
-                              'output': story}
-                if context is None:
-                    del new_prompt['context']
-                PROMPT_CACHE[prompt_fp] = (new_prompt, tokens_used, prompt_dict, length)
+            new_prompt, tokens_used, prompt_dict, length = PROMPT_CACHE[prompt_input.key]
 
             if max_tokens is not None:
                 if tokens_used > max_tokens:
@@ -105,7 +76,7 @@ def make_dataset(prompts_folders, outfile_path, validation_path, info_path, max_
             all_prompts.append(new_prompt)
 
         except Exception as e:
-            print("Exception while processing: ", prompt_fp)
+            print("Exception while processing: ", prompt_input.key)
             raise e
 
     validation_set, dataset = random_split(all_prompts, settings.get_setting("prompt_format.validation_set_size"))
@@ -127,6 +98,62 @@ def make_dataset(prompts_folders, outfile_path, validation_path, info_path, max_
         json.dump(final_metrics_dict, outfile, indent=2)
 
 
+def load_uncached_prompts(prompt_inputs: list[ChunkInput]):
+    """
+    Turn every prompt (file or shard record) that isn't in the PROMPT_CACHE into a dataset row and cache it.
+    Token counting is done for all the files at once, since tokenizing in batches is much faster.
+
+    :param prompt_inputs:
+    :return:
+    """
+    prompt_inputs = [i for i in prompt_inputs if i.key not in PROMPT_CACHE]
+    prompt_fps = [i.key for i in prompt_inputs]
+
+    prompt_dicts = []
+    for prompt_fp, prompt_input in tqdm.tqdm(zip(prompt_fps, prompt_inputs), "loading prompts",
+                                             total=len(prompt_inputs)):
+        try:
+            prompt_json = prompt_input.read_text()
+            prompt_dict = json.loads(prompt_json)
+            prompt_dict = prepare_prompt_dict_for_row(prompt_dict)
+            if settings.get_setting("hacks.redistribute_authors"):
+                prompt_dict = narrow_authors_in_prompt_dict(prompt_dict)
+            if settings.get_setting("hacks.swap_tag_values"):
+                prompt_dict = alias_similar_keys(prompt_dict)
+            prompt_dicts.append(replace_unicode_quotes(prompt_dict))
+        except Exception as e:
+            print("Exception while processing: ", prompt_fp)
+            raise e
+
+    story_token_counts = get_token_counts([d.get("story", "") for d in prompt_dicts])
+
+    rows = []
+    for prompt_fp, prompt_dict, story_token_count in zip(prompt_fps, prompt_dicts, story_token_counts):
+        try:
+            rows.append(generate_dataset_row_from_prompt_dict(
+                prompt_dict,
+                droppable_tags=settings.get_setting("prompt_format.droppable_tags"),
+                drop_tags_prob=settings.get_setting("prompt_format.tag_drop_rate"),
+                story_token_count=story_token_count))
+        except Exception as e:
+            print("Exception on:", prompt_dict)
+            print("Exception while processing: ", prompt_fp)
+            raise e
+
+    all_tokens_used = estimate_total_tokens_batch([[style, context, inst, story, system]
+                                                   for _, style, context, inst, _, story, system in rows])
+
+    for prompt_fp, row, tokens_used in zip(prompt_fps, rows, all_tokens_used):
+        prompt_dict, style, context, inst, length, story, system = row
+        new_prompt = {'system': system,
+                      'context': context,
+                      'instruction': (style + "\n" + inst).strip(),
+                      'output': story}
+        if context is None:
+            del new_prompt['context']
+        PROMPT_CACHE[prompt_fp] = (new_prompt, tokens_used, prompt_dict, length)
+
+
 def random_split(array, split_ratio):
     n = len(array)
     split_index = int(split_ratio * n)
@@ -171,6 +198,7 @@ def generate_datasets(input_folders, output_folder, write_all_combinations=True,
             max_tokens=max_tokens,
             min_tokens=min_tokens
         )
+    print("token count cache: ", get_token_count_cache().get_stats())
 
 
 if __name__ == "__main__":
@@ -179,7 +207,7 @@ if __name__ == "__main__":
 
 python -m finalize_dataset --input_folder user/fiction user/history --output_folder user/datasets --max_tokens 1200""")
     parser.add_argument('--input_folder', nargs='+', help='One or more folders containing subfolders'
-                        ' containing prompts.', required=True)
+                        ' containing prompts (and/or shards of prompts).', required=True)
     parser.add_argument('--output_folder', type=str, required=True,
                         help='Output folder path. Will be populated by the json file(s).')
     parser.add_argument('--min_tokens', type=int, required=False,
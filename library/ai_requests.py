@@ -1,47 +1,595 @@
-import requests
+import asyncio
+import contextlib
+import dataclasses
+import functools
 import json
+import math
 import os
-from typing import Optional
-import sseclient
-import google.generativeai as google_gen_ai
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Coroutine, Iterable, Iterator, Optional, TextIO, TypeVar, Union
 
+from library.endpoint_pool import Endpoint, EndpointPool
+from library.rate_limiter import RateLimiter, classify_error, run_with_retries, run_with_retries_async, OUTCOME_FAILED
+from library.request_batcher import RequestBatcher
+from library.stream_validator import StreamValidator, VALIDATION_ABORT, VALIDATION_STOP
+from library.response_cache import ResponseCache, MODE_OFF
 from library.settings_manager import settings, ROOT_FOLDER
-from library.token_count import get_token_count
+from library.token_count import get_token_count, get_token_counts
+
+T = TypeVar("T")
 
 
 class EmptyResponseException(ValueError):
     pass
 
 
+class BatchRejectedException(ValueError):
+    pass
+
+
+class RequestCancelledException(Exception):
+    pass
+
+
+class StreamAbortedException(ValueError):
+    def __init__(self, reason: str, text: str):
+        """
+        :param reason: why the stream was aborted, e.g. StreamValidator.abort_reason.
+        :param text: the part of the response that was received.
+        """
+        super().__init__(f"the response was aborted: {reason}")
+        self.reason = reason
+        self.text = text
+
+
+OUTPUT_MODE_SILENT = "silent"
+OUTPUT_MODE_PROGRESS = "progress"
+OUTPUT_MODE_ECHO = "echo"
+OUTPUT_MODES = [OUTPUT_MODE_SILENT, OUTPUT_MODE_PROGRESS, OUTPUT_MODE_ECHO]
+
+# see get_response_cache.
+_response_cache = None  # type: Optional[ResponseCache]
+_response_cache_lock = threading.Lock()
+
+# see get_gemini_client.
+_gemini_client = None  # type: Optional[GeminiClient]
+_gemini_client_lock = threading.Lock()
+
+# see run_on_gemini_loop.
+_gemini_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+_gemini_loop_lock = threading.Lock()
+
+# api choice -> the rate limiter for its requests; see get_rate_limiter.
+_rate_limiters = {}  # type: dict[str, RateLimiter]
+_rate_limiters_lock = threading.Lock()
+
+# see batched_requests.
+_request_batcher = None  # type: Optional[RequestBatcher]
+
+# the endpoints that don't accept a list of prompts (see run_ai_requests_ooba), so they're sent single prompts instead.
+_batches_rejected_by = set()  # type: set[str]
+
+# see get_endpoint_pool.
+_endpoint_pool = None  # type: Optional[EndpointPool]
+_endpoint_pool_config = None
+_endpoint_pool_lock = threading.Lock()
+
+# shared by every request (and thread), so that connections to the server are reused; see get_ooba_session.
+_ooba_session = None
+_ooba_session_lock = threading.Lock()
+
+
+def get_ooba_session():
+    """
+    The requests.Session used for every oobabooga request, created on first use from the [oobabooga_api] settings.
+    Its connection pool is thread-safe and holds up to pool_size connections, so up to pool_size threads can have a
+    request in flight at once (more will wait for a free connection). The session doesn't retry anything itself:
+    failures to connect are retried by run_rate_limited, with backoff and under the rate limiter.
+
+    :return: a requests.Session
+    """
+    global _ooba_session
+    with _ooba_session_lock:
+        if _ooba_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            pool_size = settings.get_setting('oobabooga_api.pool_size')
+            adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=0, pool_block=True)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.verify = False
+            if not settings.get_setting('oobabooga_api.keep_alive'):
+                session.headers["Connection"] = "close"
+            _ooba_session = session
+        return _ooba_session
+
+
+def close_ooba_session():
+    """
+    Close the pooled connections, e.g. after changing the [oobabooga_api] settings; the next request opens a new pool.
+    """
+    global _ooba_session
+    with _ooba_session_lock:
+        if _ooba_session is not None:
+            _ooba_session.close()
+            _ooba_session = None
+
+
 def run_ai_request(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
                    clean_blank_lines: bool = True, max_response: int = 1536, ban_eos_token: bool = True,
-                   print_prompt=True):
+                   print_prompt=True, stream: Optional[bool] = None, cancel_event: Optional[threading.Event] = None,
+                   validator: Optional[StreamValidator] = None):
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelledException("the request was cancelled before it was sent")
+    batcher = _request_batcher
+    if batcher is not None and cancel_event is None and validator is None:
+        # print_prompt and stream don't apply; batches are sent as a single non-streaming request. Requests that can be
+        # cancelled or validated while they stream are sent on their own, so that they still can be.
+        return batcher.run(prompt, custom_stopping_strings=custom_stopping_strings, temperature=temperature,
+                           clean_blank_lines=clean_blank_lines, max_response=max_response,
+                           ban_eos_token=ban_eos_token)
+
+    api_choice = settings.get_setting('ai_settings.api')
+    cache = get_response_cache()
+    if cache is not None:
+        cache_key = make_cache_key(cache, api_choice, prompt, custom_stopping_strings, temperature, clean_blank_lines,
+                                   max_response, ban_eos_token)
+        result = cache.get(cache_key)
+        if result is not None:
+            return result
+
+    match api_choice:
+        case "oobabooga_api":
+            def request():
+                return run_ai_request_ooba(prompt, custom_stopping_strings, temperature, clean_blank_lines,
+                                           max_response, ban_eos_token, print_prompt, stream, cancel_event,
+                                           validator)
+        case "gemini_pro":
+            def request():
+                return run_ai_request_gemini_pro(prompt, custom_stopping_strings, temperature, max_response)
+        case _:
+            raise ValueError(f"{api_choice} is unsupported for the setting ai_settings.api")
+    result = run_rate_limited(api_choice, request, [prompt], max_response)
+
+    # empty responses aren't cached, since they're usually a connection problem rather than a real response; nor are
+    # responses that the validator cut short, since they depend on the validator as well as the request.
+    if cache is not None and result and (validator is None or validator.stop_offset is None):
+        cache.put(cache_key, result)
+    return result
+
+
+def run_ai_requests(prompts: list[str], custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
+                    clean_blank_lines: bool = True, max_response: int = 1536, ban_eos_token: bool = True,
+                    batch_size: Optional[int] = None, return_exceptions: bool = False) -> list[Union[str, Exception]]:
+    """
+    Run several prompts with the same sampling parameters, each under the backend's rate limiter. For oobabooga, up to
+    batch_size prompts are sent in each (non-streaming) request, falling back to a request per prompt if the server
+    doesn't accept batches; gemini requests are run concurrently.
+
+    :param prompts:
+    :param custom_stopping_strings:
+    :param temperature:
+    :param clean_blank_lines:
+    :param max_response:
+    :param ban_eos_token:
+    :param batch_size: defaults to the setting oobabooga_api.batch_size.
+    :param return_exceptions: if true, the exception of a prompt that failed is returned in place of its response
+        (for an oobabooga batch that failed as a whole, for each of its prompts), and the other prompts carry on.
+    :return: the responses, in the same order as the prompts.
+    """
     api_choice = settings.get_setting('ai_settings.api')
+    if batch_size is None:
+        batch_size = settings.get_setting('oobabooga_api.batch_size')
+    results = [None] * len(prompts)  # type: list[Optional[str]]
+    cache = get_response_cache()
+    cache_keys = []
+    uncached = []
+    for index, prompt in enumerate(prompts):
+        if cache is not None:
+            cache_keys.append(make_cache_key(cache, api_choice, prompt, custom_stopping_strings, temperature,
+                                             clean_blank_lines, max_response, ban_eos_token))
+            results[index] = cache.get(cache_keys[-1])
+        if results[index] is None:
+            uncached.append(index)
+
+    # prompts that share a prefix (e.g. the examples of a few shot template) are sent next to each other, so that the
+    # server can reuse the prefix it cached for the previous prompt.
+    uncached.sort(key=lambda i: prompts[i])
     match api_choice:
         case "oobabooga_api":
-            return run_ai_request_ooba(prompt, custom_stopping_strings, temperature, clean_blank_lines, max_response,
-                                       ban_eos_token, print_prompt)
+            for start in range(0, len(uncached), batch_size):
+                batch = uncached[start:start + batch_size]
+                try:
+                    responses = run_ai_requests_ooba_batch([prompts[i] for i in batch], custom_stopping_strings,
+                                                           temperature, clean_blank_lines, max_response, ban_eos_token,
+                                                           return_exceptions)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    responses = [e] * len(batch)
+                for index, response in zip(batch, responses):
+                    results[index] = response
         case "gemini_pro":
-            return run_ai_request_gemini_pro(prompt, custom_stopping_strings, temperature, max_response)
+            responses = run_on_gemini_loop(run_ai_requests_gemini_pro_async([prompts[i] for i in uncached],
+                                                                            custom_stopping_strings, temperature,
+                                                                            max_response,
+                                                                            rate_limiter=get_rate_limiter(api_choice),
+                                                                            return_exceptions=return_exceptions))
+            for index, response in zip(uncached, responses):
+                results[index] = response
         case _:
             raise ValueError(f"{api_choice} is unsupported for the setting ai_settings.api")
 
+    if cache is not None:
+        for index in uncached:
+            if results[index] and isinstance(results[index], str):
+                cache.put(cache_keys[index], results[index])
+    return results
+
+
+def run_ai_requests_ooba_batch(prompts: list[str], custom_stopping_strings: Optional[list[str]], temperature: float,
+                               clean_blank_lines: bool, max_response: int, ban_eos_token: bool,
+                               return_exceptions: bool = False) -> list[Union[str, Exception]]:
+    """
+    Send the prompts in a single request (with rate limiting and retries), or one request per prompt if the server
+    rejects batches.
+    With return_exceptions, the exception of a prompt whose own request failed is returned in place of its response.
+    """
+    # checked before taking a rate limiter slot, so that a server known to reject batches costs no extra request.
+    if len(prompts) > 1 and not batches_rejected():
+        try:
+            return run_rate_limited("oobabooga_api",
+                                    lambda: run_ai_requests_ooba(prompts, custom_stopping_strings, temperature,
+                                                                 clean_blank_lines, max_response, ban_eos_token),
+                                    prompts, max_response)
+        except BatchRejectedException:
+            pass
+    responses = []
+    for prompt in prompts:
+        try:
+            responses.append(run_rate_limited("oobabooga_api",
+                                              lambda: run_ai_request_ooba(prompt, custom_stopping_strings, temperature,
+                                                                          clean_blank_lines, max_response,
+                                                                          ban_eos_token, print_prompt=False,
+                                                                          stream=False),
+                                              [prompt], max_response))
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            responses.append(e)
+    return responses
+
+
+@contextlib.contextmanager
+def batched_requests(concurrency: int, max_wait: Optional[float] = None) -> Iterator[RequestBatcher]:
+    """
+    While active, run_ai_request calls made at the same time from several threads, with the same sampling
+    parameters, are combined into batches and sent with run_ai_requests.
+    The prompts in flight are split into several batches, so that every endpoint has a batch to work on (rather than
+    one big batch being sent a sub-batch at a time): a batch holds up to concurrency / the number of endpoints prompts,
+    and at most oobabooga_api.batch_size.
+
+    :param concurrency: the most prompts in flight at once, e.g. the number of threads.
+    :param max_wait: a batch that isn't full is sent once its first prompt has waited this many seconds; defaults to
+        the setting oobabooga_api.batch_wait_seconds.
+    :return:
+    """
+    global _request_batcher
+    if max_wait is None:
+        max_wait = settings.get_setting('oobabooga_api.batch_wait_seconds')
+    max_batch_size = min(settings.get_setting('oobabooga_api.batch_size'),
+                         math.ceil(concurrency / len(get_endpoint_pool().endpoints)))
+    # a prompt that fails only fails the thread that sent it, not the rest of its batch.
+    _request_batcher = RequestBatcher(functools.partial(run_ai_requests, return_exceptions=True), max_batch_size,
+                                      max_wait)
+    try:
+        yield _request_batcher
+    finally:
+        _request_batcher = None
+
+
+def make_cache_key(cache: ResponseCache, api_choice: str, prompt: str, custom_stopping_strings: Optional[list[str]],
+                   temperature: float, clean_blank_lines: bool, max_response: int, ban_eos_token: bool) -> bytes:
+    return cache.make_key({"backend": api_choice,
+                           "model": get_model_id(api_choice),
+                           "prompt": prompt,
+                           "temperature": temperature,
+                           "stop": custom_stopping_strings or [],
+                           "max_tokens": max_response,
+                           "ban_eos_token": ban_eos_token,
+                           "clean_blank_lines": clean_blank_lines})
+
+
+def run_rate_limited(api_choice: str, request: Callable[[], T], prompts: list[str], max_response: int) -> T:
+    """
+    Run a request to a backend under its rate limiter, with retries.
+
+    :param api_choice:
+    :param request: makes the request, returning a response (or a list of responses, for several prompts).
+    :param prompts: the prompts that the request sends, for counting tokens.
+    :param max_response:
+    :return: the request's result.
+    """
+    rate_limiter = get_rate_limiter(api_choice)
+    estimated_tokens, count_tokens = estimate_tokens(rate_limiter, prompts, max_response)
+    return run_with_retries(request, rate_limiter, estimated_tokens,
+                            max_retries=settings.get_setting('rate_limit.max_retries'),
+                            backoff_base=settings.get_setting('rate_limit.backoff_base'),
+                            backoff_max=settings.get_setting('rate_limit.backoff_max'),
+                            count_tokens=count_tokens)
+
+
+async def run_rate_limited_async(rate_limiter: RateLimiter, request: Callable[[], Awaitable[T]], prompts: list[str],
+                                 max_response: int) -> T:
+    """
+    Like run_rate_limited, for requests that are run asynchronously.
+
+    :param rate_limiter: see get_rate_limiter.
+    :param request: returns an awaitable that makes the request.
+    :param prompts:
+    :param max_response:
+    :return: the request's result.
+    """
+    estimated_tokens, count_tokens = estimate_tokens(rate_limiter, prompts, max_response)
+    return await run_with_retries_async(request, rate_limiter, estimated_tokens,
+                                        max_retries=settings.get_setting('rate_limit.max_retries'),
+                                        backoff_base=settings.get_setting('rate_limit.backoff_base'),
+                                        backoff_max=settings.get_setting('rate_limit.backoff_max'),
+                                        count_tokens=count_tokens)
+
+
+def estimate_tokens(rate_limiter: RateLimiter, prompts: list[str],
+                    max_response: int) -> tuple[int, Optional[Callable[[Any], int]]]:
+    """
+    :return: the tokens a request is expected to use, and a function that counts the tokens it used from its result;
+        or 0 and None if the rate limiter doesn't count tokens.
+    """
+    if not rate_limiter.tokens_per_minute:
+        return 0, None
+    prompt_tokens = sum(get_token_counts(prompts))
+
+    def count_tokens(result) -> int:
+        return prompt_tokens + sum(get_token_counts(result if isinstance(result, list) else [result]))
+    return prompt_tokens + max_response * len(prompts), count_tokens
+
+
+def get_model_id(api_choice: str) -> str:
+    """
+    :param api_choice:
+    :return: identifies the model (and preset) that a backend generates with, as far as the settings say. not where
+        the requests are sent, so that cached responses outlive a change of server address.
+    """
+    match api_choice:
+        case "oobabooga_api":
+            return settings.get_setting('oobabooga_api.preset_name')
+        case "gemini_pro":
+            return "gemini-pro"
+        case _:
+            return api_choice
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    :return: the response cache configured by the [response_cache] settings, or None if it's off.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        mode = settings.get_setting('response_cache.mode')
+        if mode == MODE_OFF:
+            return None
+        if _response_cache is None or _response_cache.mode != mode:
+            _response_cache = ResponseCache(os.path.join(ROOT_FOLDER, settings.get_setting('response_cache.path')),
+                                            int(settings.get_setting('response_cache.max_size_mb') * 1024 * 1024),
+                                            mode)
+        return _response_cache
+
+
+def get_rate_limiter(api_choice: str) -> RateLimiter:
+    """
+    :param api_choice:
+    :return: the rate limiter shared by every request to the backend, configured by the [rate_limit] settings.
+    """
+    config = (settings.get_setting('rate_limit.requests_per_minute'),
+              settings.get_setting('rate_limit.tokens_per_minute'),
+              settings.get_setting('rate_limit.max_concurrency'))
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(api_choice, None)
+        if rate_limiter is None or (rate_limiter.requests_per_minute, rate_limiter.tokens_per_minute,
+                                    rate_limiter.max_concurrency) != config:
+            rate_limiter = RateLimiter(*config)
+            _rate_limiters[api_choice] = rate_limiter
+        return rate_limiter
+
+
+def get_endpoint_pool() -> EndpointPool:
+    """
+    :return: the oobabooga servers to send requests to: oobabooga_api.endpoints, or just oobabooga_api.request_url
+        if there aren't any.
+    """
+    global _endpoint_pool, _endpoint_pool_config
+    endpoints = settings.get_setting('oobabooga_api.endpoints')
+    if not endpoints:
+        endpoints = [{"url": settings.get_setting('oobabooga_api.request_url')}]
+    config = (endpoints,
+              settings.get_setting('oobabooga_api.endpoint_failures_to_eject'),
+              settings.get_setting('oobabooga_api.endpoint_ejection_seconds'))
+    with _endpoint_pool_lock:
+        if _endpoint_pool is None or _endpoint_pool_config != config:
+            _endpoint_pool = EndpointPool([Endpoint(e["url"], e.get("weight", 1), e.get("max_concurrency", 0))
+                                           for e in endpoints],
+                                          config[1], config[2])
+            _endpoint_pool_config = config
+        return _endpoint_pool
+
+
+def batches_rejected() -> bool:
+    """
+    :return: whether every oobabooga endpoint has rejected a batch, so prompts should only be sent one at a time.
+    """
+    return all(e.url in _batches_rejected_by for e in get_endpoint_pool().endpoints)
+
+
+def print_request_metrics():
+    """
+    Report the retries, throttling and adaptive concurrency of each backend's requests, and the throughput of each
+    oobabooga endpoint, e.g. at the end of a batch.
+    """
+    with _rate_limiters_lock:
+        rate_limiters = dict(_rate_limiters)
+    for api_choice, rate_limiter in rate_limiters.items():
+        print(f"{api_choice} requests: ", rate_limiter.get_metrics())
+    with _endpoint_pool_lock:
+        endpoint_pool = _endpoint_pool
+    if endpoint_pool is not None:
+        for url, stats in endpoint_pool.get_stats().items():
+            print(f"{url}: ", stats)
+
+
+def print_response_cache_stats():
+    """
+    Report the response cache's hit rate, e.g. at the end of a batch.
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        print(f"response cache ({cache.mode}): ", cache.get_stats())
+
 
 def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
                         clean_blank_lines: bool = True, max_response: int = 1536, ban_eos_token: bool = True,
-                        print_prompt=True):
-    request_url = settings.get_setting('oobabooga_api.request_url')
+                        print_prompt=True, stream: Optional[bool] = None,
+                        cancel_event: Optional[threading.Event] = None, validator: Optional[StreamValidator] = None):
+    """
+    :param prompt:
+    :param custom_stopping_strings:
+    :param temperature:
+    :param clean_blank_lines:
+    :param max_response:
+    :param ban_eos_token:
+    :param print_prompt: print the prompt before the response; only in the 'echo' output mode.
+    :param stream: stream the response token by token, or wait for the whole response in a single reply;
+        defaults to the setting oobabooga_api.stream.
+    :param cancel_event: once set, a streamed response is closed (so that the server stops generating it) and
+        RequestCancelledException is raised; a request that isn't streamed can only be cancelled before it's sent.
+    :param validator: checks a streamed response as it arrives; see read_completion_events.
+    :return:
+    """
+    if stream is None:
+        stream = settings.get_setting('oobabooga_api.stream')
+    headers = {
+        "Content-Type": "application/json"
+    }
+    data = make_ooba_request_data(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token, stream)
+
+    timeout = (settings.get_setting('oobabooga_api.connect_timeout'),
+               settings.get_setting('oobabooga_api.read_timeout'))
+    output_mode = get_output_mode()
+    if print_prompt and output_mode == OUTPUT_MODE_ECHO:
+        print(data['prompt'], end='')
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelledException("the request was cancelled before it was sent")
+    endpoint_pool = get_endpoint_pool()
+    endpoint = endpoint_pool.acquire()
+    start = time.perf_counter()
+    healthy = True
+    try:
+        with open_transcript(prompt) as transcript:
+            result = post_completion(endpoint.url, headers, data, timeout, output_mode, transcript, cancel_event,
+                                     validator)
+    except Exception as e:
+        # only errors that suggest the server is down count against its health: not errors that are the request's fault
+        # (e.g. a 400), nor throttling (a 429 or a timeout), which the rate limiter deals with.
+        healthy = classify_error(e) != OUTCOME_FAILED
+        raise
+    finally:
+        endpoint_pool.release(endpoint, healthy, time.perf_counter() - start)
+
+    return clean_response(result, clean_blank_lines)
+
+
+def run_ai_requests_ooba(prompts: list[str], custom_stopping_strings: Optional[list[str]] = None,
+                         temperature: float = .1, clean_blank_lines: bool = True, max_response: int = 1536,
+                         ban_eos_token: bool = True) -> list[str]:
+    """
+    Send several prompts in a single (non-streaming) completion request.
+    Raises BatchRejectedException if the server doesn't accept a list of prompts.
+
+    :return: the responses, in the same order as the prompts.
+    """
+    data = make_ooba_request_data(prompts, custom_stopping_strings, temperature, max_response, ban_eos_token, False)
+    timeout = (settings.get_setting('oobabooga_api.connect_timeout'),
+               settings.get_setting('oobabooga_api.read_timeout'))
+    endpoint_pool = get_endpoint_pool()
+    try:
+        # the batch goes to an endpoint that accepts batches, if the others are busy too.
+        endpoint = endpoint_pool.acquire(exclude=_batches_rejected_by)
+    except ValueError:
+        raise BatchRejectedException("no endpoint accepts batches")
+    start = time.perf_counter()
+    healthy = True
+    try:
+        response = get_ooba_session().post(endpoint.url, headers={"Content-Type": "application/json"}, json=data,
+                                           timeout=timeout)
+        if response.status_code in [404, 415, 501] or \
+                (response.status_code in [400, 422] and is_prompt_list_rejection(response.text)):
+            _batches_rejected_by.add(endpoint.url)
+            raise BatchRejectedException(f"{endpoint.url} rejected a batch: {response.status_code} {response.text}")
+        if response.status_code in [400, 422]:
+            # something else about the request was wrong (e.g. a prompt that's too long); single prompts will show which
+            # prompt it was, but the next batch is still worth a try.
+            raise BatchRejectedException(f"{endpoint.url} rejected a batch: {response.status_code} {response.text}")
+        response.raise_for_status()
+        results = [None] * len(prompts)  # type: list[Optional[str]]
+        for choice in response.json()['choices']:
+            index = choice.get('index', None)
+            if index is None or not 0 <= index < len(prompts):
+                break
+            results[index] = choice['text']
+        if any([r is None for r in results]):
+            # e.g. the server only completed the first prompt. that can be a one-off, so the next batch is still tried.
+            raise BatchRejectedException(f"{endpoint.url} didn't complete every prompt in a batch")
+    except Exception as e:
+        healthy = classify_error(e) != OUTCOME_FAILED
+        raise
+    finally:
+        endpoint_pool.release(endpoint, healthy, time.perf_counter() - start)
+
+    output_mode = get_output_mode()
+    for prompt, result in zip(prompts, results):
+        with open_transcript(prompt) as transcript:
+            if transcript is not None:
+                transcript.write(result)
+        if output_mode == OUTPUT_MODE_ECHO:
+            print(result)
+    if output_mode == OUTPUT_MODE_PROGRESS:
+        meter = TokenRateMeter()
+        meter.update(sum(get_token_counts(results)))
+        meter.finish()
+    return [clean_response(r, clean_blank_lines) for r in results]
+
+
+def make_ooba_request_data(prompt: Union[str, list[str]], custom_stopping_strings: Optional[list[str]],
+                           temperature: float, max_response: int, ban_eos_token: bool, stream: bool) -> dict:
+    """
+    :param prompt: a prompt, or a list of prompts to complete in one request.
+    :param custom_stopping_strings:
+    :param temperature:
+    :param max_response:
+    :param ban_eos_token:
+    :param stream:
+    :return: the body of a completion request.
+    """
     max_context = settings.get_setting('oobabooga_api.context_length')
     if not custom_stopping_strings:
         custom_stopping_strings = []
-    prompt_length = get_token_count(prompt)
-    if prompt_length + max_response > max_context:
-        raise ValueError(f"run_ai_request: the prompt ({prompt_length}) and response length ({max_response}) are "
-                         f"longer than max context! ({max_context})")
+    for prompt_length in get_token_counts(prompt if isinstance(prompt, list) else [prompt]):
+        if prompt_length + max_response > max_context:
+            raise ValueError(f"run_ai_request: the prompt ({prompt_length}) and response length ({max_response}) "
+                             f"are longer than max context! ({max_context})")
 
-    headers = {
-        "Content-Type": "application/json"
-    }
     data = {
         "prompt": prompt,
         'temperature': temperature,
@@ -49,8 +597,10 @@ def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]
         'truncation_length': max_context - max_response,
         'stop': custom_stopping_strings,
         'ban_eos_token': ban_eos_token,
-        "stream": True,
+        "stream": stream,
     }
+    if settings.get_setting('oobabooga_api.cache_prompt'):
+        data['cache_prompt'] = True
     preset = settings.get_setting('oobabooga_api.preset_name')
     if preset.lower() not in ['', 'none']:
         data['preset'] = preset
@@ -85,22 +635,10 @@ def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]
             'top_p': 0.98,
         }
         data.update(extra_settings)
+    return data
 
-    stream_response = requests.post(request_url, headers=headers, json=data, verify=False, stream=True)
-    client = sseclient.SSEClient(stream_response)
-
-    result = ""
-    if print_prompt:
-        print(data['prompt'], end='')
-    with open(os.path.join(ROOT_FOLDER, "response.txt"), "w", encoding='utf-8') as f:
-        for event in client.events():
-            payload = json.loads(event.data)
-            new_text = payload['choices'][0]['text']
-            print(new_text, end='')
-            f.write(new_text)
-            result += new_text
-    print()
 
+def clean_response(result: str, clean_blank_lines: bool) -> str:
     if clean_blank_lines:
         result = "\n".join([l for l in result.splitlines() if len(l.strip()) > 0])
 
@@ -110,21 +648,296 @@ def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]
     return result
 
 
+def post_completion(request_url: str, headers: dict, data: dict, timeout: tuple[float, float], output_mode: str,
+                    transcript: Optional[TextIO] = None, cancel_event: Optional[threading.Event] = None,
+                    validator: Optional[StreamValidator] = None) -> str:
+    """
+    :param request_url:
+    :param headers:
+    :param data: the completion request; data['stream'] chooses between a streamed response and a single reply.
+    :param timeout: the (connect, read) timeouts.
+    :param output_mode: one of OUTPUT_MODES.
+    :param transcript: a file to write the response to, if any.
+    :param cancel_event: see read_completion_events.
+    :param validator: see read_completion_events; only streamed responses are validated.
+    :return: the text of the completion.
+    """
+    if data['stream']:
+        # imported here so that only scripts making requests pay for loading a backend
+        import sseclient
+
+        # the response is closed (returning its connection to the pool) even if reading the stream fails.
+        with get_ooba_session().post(request_url, headers=headers, json=data, stream=True, timeout=timeout) \
+                as stream_response:
+            stream_response.raise_for_status()
+            client = sseclient.SSEClient(stream_response)
+            return read_completion_events(client.events(), output_mode, transcript, cancel_event, validator)
+
+    response = get_ooba_session().post(request_url, headers=headers, json=data, timeout=timeout)
+    response.raise_for_status()
+    result = response.json()['choices'][0]['text']
+    if transcript is not None:
+        transcript.write(result)
+    if output_mode == OUTPUT_MODE_ECHO:
+        print(result)
+    elif output_mode == OUTPUT_MODE_PROGRESS:
+        meter = TokenRateMeter()
+        meter.update(get_token_count(result))
+        meter.finish()
+    return result
+
+
+def is_prompt_list_rejection(error: str) -> bool:
+    """
+    :param error: the body of a 400 or 422 response to a batch.
+    :return: true if the error is about the prompt being a list, i.e. the server doesn't accept batches at all, e.g.
+        pydantic's "Input should be a valid string" for the 'prompt' field.
+    """
+    error = error.lower()
+    return "prompt" in error and any([word in error for word in ["str", "list", "array", "batch"]])
+
+
+def get_output_mode() -> str:
+    """
+    :return: how much of a response is printed while it's generated; one of OUTPUT_MODES.
+    """
+    output_mode = settings.get_setting('ai_settings.output_mode')
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"{output_mode} is unsupported for the setting ai_settings.output_mode; expected one of "
+                         f"{OUTPUT_MODES}")
+    return output_mode
+
+
+def read_completion_events(events: Iterable, output_mode: str, transcript: Optional[TextIO] = None,
+                           cancel_event: Optional[threading.Event] = None,
+                           validator: Optional[StreamValidator] = None) -> str:
+    """
+    :param events: the server sent events of a streamed completion.
+    :param output_mode: one of OUTPUT_MODES.
+    :param transcript: a file to write the response to as it's received, if any.
+    :param cancel_event: checked before each event; once it's set, RequestCancelledException is raised (and the caller
+        closes the stream).
+    :param validator: fed each part of the response. If it finds the response is junk, StreamAbortedException is
+        raised (and the caller closes the stream); if it finds the response is complete, the rest isn't read.
+    :return: the full text of the completion.
+    """
+    chunks = []
+    meter = TokenRateMeter() if output_mode == OUTPUT_MODE_PROGRESS else None
+    for event in events:
+        if cancel_event is not None and cancel_event.is_set():
+            raise RequestCancelledException(f"the request was cancelled after {len(chunks)} tokens")
+        payload = json.loads(event.data)
+        new_text = payload['choices'][0]['text']
+        chunks.append(new_text)
+        if output_mode == OUTPUT_MODE_ECHO:
+            print(new_text, end='')
+        if transcript is not None:
+            transcript.write(new_text)
+        if meter is not None:
+            meter.update(1)
+        if validator is not None:
+            action = validator.feed(new_text)
+            if action == VALIDATION_ABORT:
+                raise StreamAbortedException(validator.abort_reason, "".join(chunks))
+            elif action == VALIDATION_STOP:
+                chunks = [validator.text[:validator.stop_offset]]
+                break
+    if output_mode == OUTPUT_MODE_ECHO:
+        print()
+    if meter is not None:
+        meter.finish()
+    return "".join(chunks)
+
+
+@contextlib.contextmanager
+def open_transcript(prompt: str) -> Iterator[Optional[TextIO]]:
+    """
+    Open a new transcript file for a request, if ai_settings.transcript_folder is set. Every request gets its own
+    file, so that concurrent requests don't write over each other.
+
+    :param prompt: written at the top of the transcript, followed by the response.
+    :return: the open transcript, or None if transcripts are disabled.
+    """
+    transcript_folder = settings.get_setting('ai_settings.transcript_folder')
+    if not transcript_folder:
+        yield None
+        return
+    transcript_folder = os.path.join(ROOT_FOLDER, transcript_folder)
+    os.makedirs(transcript_folder, exist_ok=True)
+    filename = f"response_{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}.txt"
+    with open(os.path.join(transcript_folder, filename), "w", encoding='utf-8') as f:
+        f.write(prompt)
+        f.write("\n\n----- response -----\n\n")
+        yield f
+
+
+class TokenRateMeter:
+    """ Prints a running count of the tokens received, and the rate they were received at, on a single line. """
+    def __init__(self, update_interval: float = .5):
+        self._start = time.perf_counter()
+        self._last_print = self._start
+        self._update_interval = update_interval
+        self.tokens = 0
+
+    def update(self, tokens: int):
+        self.tokens += tokens
+        now = time.perf_counter()
+        if now - self._last_print >= self._update_interval:
+            self._last_print = now
+            self._print(now, end='')
+
+    def finish(self):
+        self._print(time.perf_counter(), end='\n')
+
+    def _print(self, now: float, end: str):
+        elapsed = now - self._start
+        rate = self.tokens / elapsed if elapsed > 0 else 0
+        print(f"\rreceived {self.tokens} tokens ({rate:.1f} tokens/s)", end=end, flush=True)
+
+
 def run_ai_request_gemini_pro(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
                               max_response: int = 1536):
-    google_gen_ai.configure(api_key=settings.get_setting('gemini_pro_api.api_key'))
-    model = google_gen_ai.GenerativeModel('gemini-pro')
-    generation_config = google_gen_ai.types.GenerationConfig()
-    generation_config.stop_sequences = custom_stopping_strings
-    generation_config.max_output_tokens = max_response
-    generation_config.temperature = temperature
-    safety_options = {
-        google_gen_ai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
-        google_gen_ai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
-        google_gen_ai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT:
-            google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
-        google_gen_ai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT:
-            google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
-    }
-    response = model.generate_content(prompt, generation_config=generation_config, safety_settings=safety_options)
-    return response.text
+    return get_gemini_client().generate(prompt, custom_stopping_strings, temperature, max_response)
+
+
+async def run_ai_requests_gemini_pro_async(prompts: list[str], custom_stopping_strings: Optional[list[str]] = None,
+                                           temperature: float = .1, max_response: int = 1536,
+                                           concurrency: Optional[int] = None, timeout: Optional[float] = None,
+                                           client: Optional["GeminiClient"] = None,
+                                           rate_limiter: Optional[RateLimiter] = None,
+                                           return_exceptions: bool = False) -> list[Union[str, Exception]]:
+    """
+    Run many gemini requests at once, from a single thread.
+
+    :param prompts:
+    :param custom_stopping_strings:
+    :param temperature:
+    :param max_response:
+    :param concurrency: the most requests in flight; defaults to the setting gemini_pro_api.concurrency.
+    :param timeout: seconds to wait for each response; defaults to the setting gemini_pro_api.timeout.
+    :param client: defaults to get_gemini_client().
+    :param rate_limiter: if given, each request is run under it, with retries (see run_rate_limited_async).
+    :param return_exceptions: if true, a failed request's exception is returned in place of its response, and the
+        other requests carry on.
+    :return: the responses, in the same order as the prompts. Unless return_exceptions is true, if any request fails
+        (or times out), the others are cancelled and the error is raised.
+    """
+    if concurrency is None:
+        concurrency = settings.get_setting('gemini_pro_api.concurrency')
+    if timeout is None:
+        timeout = settings.get_setting('gemini_pro_api.timeout')
+    if client is None:
+        client = get_gemini_client()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(prompt: str) -> str:
+        async with semaphore:
+            return await client.generate_async(prompt, custom_stopping_strings, temperature, max_response, timeout)
+
+    async def run(prompt: str) -> str:
+        if rate_limiter is None:
+            return await request(prompt)
+        return await run_rate_limited_async(rate_limiter, lambda: request(prompt), [prompt], max_response)
+
+    tasks = [asyncio.ensure_future(run(prompt)) for prompt in prompts]
+    try:
+        return list(await asyncio.gather(*tasks, return_exceptions=return_exceptions))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def run_on_gemini_loop(coroutine: Coroutine[Any, Any, T]) -> T:
+    """
+    Run a coroutine on the event loop that all the async gemini requests share, which runs on its own thread.
+    google.generativeai's async client is tied to the event loop it's first used on, so the shared client can't be used
+    from a new loop for every batch (e.g. with asyncio.run).
+
+    :param coroutine:
+    :return: the coroutine's result.
+    """
+    global _gemini_loop
+    with _gemini_loop_lock:
+        if _gemini_loop is None:
+            _gemini_loop = asyncio.new_event_loop()
+            threading.Thread(target=_gemini_loop.run_forever, name="gemini_loop", daemon=True).start()
+        loop = _gemini_loop
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def get_gemini_client() -> "GeminiClient":
+    """
+    :return: the gemini client shared by every request; it's only rebuilt if the api key changes.
+    """
+    global _gemini_client
+    api_key = settings.get_setting('gemini_pro_api.api_key')
+    with _gemini_client_lock:
+        if _gemini_client is None or _gemini_client.api_key != api_key:
+            _gemini_client = GeminiClient(api_key)
+        return _gemini_client
+
+
+class GeminiClient:
+    """
+    The configured gemini model, along with the generation config and safety options that every request starts from.
+    """
+    def __init__(self, api_key: str, model: Optional[Any] = None):
+        """
+        :param api_key:
+        :param model: a google.generativeai.GenerativeModel (or a stand-in for one, e.g. for tests); by default, the
+            library is configured with the api key and a 'gemini-pro' model is created.
+        """
+        import google.generativeai as google_gen_ai
+
+        if model is None:
+            google_gen_ai.configure(api_key=api_key)
+            model = google_gen_ai.GenerativeModel('gemini-pro')
+        self.api_key = api_key
+        self.model = model
+        self.generation_config = google_gen_ai.types.GenerationConfig()
+        self.safety_options = {
+            google_gen_ai.types.HarmCategory.HARM_CATEGORY_HARASSMENT:
+                google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
+            google_gen_ai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH:
+                google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
+            google_gen_ai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT:
+                google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
+            google_gen_ai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT:
+                google_gen_ai.types.HarmBlockThreshold.BLOCK_NONE,
+        }
+
+    def get_generation_config(self, custom_stopping_strings: Optional[list[str]], temperature: float,
+                              max_response: int):
+        return dataclasses.replace(self.generation_config, stop_sequences=custom_stopping_strings,
+                                   max_output_tokens=max_response, temperature=temperature)
+
+    def generate(self, prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
+                 max_response: int = 1536) -> str:
+        response = self.model.generate_content(
+            prompt, generation_config=self.get_generation_config(custom_stopping_strings, temperature, max_response),
+            safety_settings=self.safety_options)
+        return response.text
+
+    async def generate_async(self, prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                             temperature: float = .1, max_response: int = 1536,
+                             timeout: Optional[float] = None) -> str:
+        """
+        :param prompt:
+        :param custom_stopping_strings:
+        :param temperature:
+        :param max_response:
+        :param timeout: seconds to wait for the response before cancelling the request and raising
+            asyncio.TimeoutError; None waits forever.
+        :return:
+        """
+        response = await asyncio.wait_for(self.model.generate_content_async(
+            prompt, generation_config=self.get_generation_config(custom_stopping_strings, temperature, max_response),
+            safety_settings=self.safety_options), timeout)
+        return response.text
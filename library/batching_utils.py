@@ -1,29 +1,219 @@
+import json
 import os
+import threading
+import tqdm
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
 
+from library.chunk_manifest import MANIFEST_FILENAME
+from library.prompt_parser import parse_prompt_text
 
-def get_subpaths_to_process(in_folder: str, out_folder: str) -> list[str]:
+SHARD_FORMAT_JSONL = "jsonl"
+SHARD_FORMAT_PARQUET = "parquet"
+SHARD_FORMATS = [SHARD_FORMAT_JSONL, SHARD_FORMAT_PARQUET]
+SHARD_SUFFIX = ".chunks."
+
+
+class ChunkInput(NamedTuple):
     """
-    for every file in a subfolder of in_folder, return the subpath relative to in_folder.
-    except if a parallel file exists in the out_folder.
-    assumes the output file will be a json.
+    One input of a batch process: a file in a subfolder of the input folder, or a chunk in a shard.
+    subpath is relative to the input folder and decides where the outputs go. A chunk gets the subpath it would have
+    been written to as a file: "{source}/chunk_{chunk_index}.txt" in a shard in the input folder (like books_to_chunks'
+    folder per book), or "{subfolder}/{source}_chunk_{chunk_index}.txt" in a shard in a subfolder (like
+    ksj_to_chunks' files per script).
+    A chunk's text isn't kept: offset locates its record in the shard (see iter_shard_records), and it's read when it's
+    needed.
+    """
+    subpath: str
+    path: str
+    offset: Optional[int] = None
+
+    @property
+    def key(self) -> str:
+        """ Identifies the input, e.g. for caching; unique across files and shards. """
+        if self.offset is None:
+            return self.path
+        return f"{self.path}:{self.subpath}"
+
+    def read_text(self) -> str:
+        if self.offset is not None:
+            return read_shard_text(self.path, self.offset)
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def load(self) -> tuple[str, Optional[dict]]:
+        """
+        Like load_prompt_file.
+
+        :return: the file (or chunk) contents, and the contents as a prompt dict if they're a json.
+        """
+        print("Processing file:", self.key)
+        script_chunk = self.read_text()
+        return script_chunk, parse_prompt_text(script_chunk)
+
+
+def list_inputs(in_folder: str, extensions: Optional[tuple[str, ...]] = None) -> list[ChunkInput]:
+    """
+    every file in a subfolder of in_folder, and every chunk in the shards in in_folder and its subfolders, sorted by
+    subpath.
+    folder trees and shards can be mixed, so that consumers don't need to know how their inputs were written.
 
     :param in_folder:
-    :param out_folder:
+    :param extensions: if given, only files (and chunks, by their subpaths, which are always .txt) with these
+        extensions are included.
     :return:
     """
-    subpaths_filenames = []
-
+    inputs = []
     for subfolder in os.listdir(in_folder):
-        if not os.path.isdir(os.path.join(in_folder, subfolder)):
+        subfolder_path = os.path.join(in_folder, subfolder)
+        if is_shard(subfolder_path):
+            inputs.extend(iter_shard_inputs(subfolder_path, extensions=extensions))
+        if not os.path.isdir(subfolder_path):
             continue
-        for filename in os.listdir(os.path.join(in_folder, subfolder)):
-            if os.path.isdir(os.path.join(in_folder, subfolder, filename)):
+        for filename in os.listdir(subfolder_path):
+            path = os.path.join(subfolder_path, filename)
+            if is_shard(path):
+                inputs.extend(iter_shard_inputs(path, subfolder, extensions))
                 continue
-            out_path = os.path.join(out_folder, subfolder, filename.replace(".txt", ".json"))
-            if os.path.isfile(out_path):
+            if os.path.isdir(path) or filename == MANIFEST_FILENAME:
                 continue
-            subpaths_filenames.append(os.path.join(subfolder, filename))
-    return sorted(subpaths_filenames)
+            if extensions is not None and not filename.endswith(extensions):
+                continue
+            inputs.append(ChunkInput(os.path.join(subfolder, filename), path))
+    return sorted(inputs, key=lambda i: i.subpath)
+
+
+def get_inputs_to_process(in_folder: str, out_folder: str) -> list[ChunkInput]:
+    """
+    list_inputs, except if a parallel file exists in the out_folder.
+    assumes the output file will be a json.
+
+    :param in_folder:
+    :param out_folder:
+    :return:
+    """
+    return [i for i in list_inputs(in_folder)
+            if not os.path.isfile(os.path.join(out_folder, i.subpath.replace(".txt", ".json")))]
+
+
+def get_shard_path(folder: str, source: str, shard_format: str) -> str:
+    return os.path.join(folder, f"{source}{SHARD_SUFFIX}{shard_format}")
+
+
+def is_shard(path: str) -> bool:
+    return os.path.isfile(path) and any([path.endswith(SHARD_SUFFIX + f) for f in SHARD_FORMATS])
+
+
+def read_shard(path: str) -> list[dict[str, Any]]:
+    """
+    :param path:
+    :return: the records in the shard; see ShardWriter.
+    """
+    return [record for _, record in iter_shard_records(path)]
+
+
+def iter_shard_records(path: str, columns: Optional[list[str]] = None) -> Iterator[tuple[int, dict[str, Any]]]:
+    """
+    :param path:
+    :param columns: if given, only these fields of a parquet shard's records are read (jsonl records always have all
+        of their fields).
+    :return: (offset, record) for each record in the shard: the byte offset of its line in a jsonl shard, or its row in
+        a parquet shard.
+    """
+    if path.endswith(SHARD_FORMAT_PARQUET):
+        import pandas as pd
+        for row, r in enumerate(pd.read_parquet(path, columns=columns).to_dict("records")):
+            yield row, {k: int(v) if k in ["chunk_index", "token_count"] else v for k, v in r.items()}
+        return
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                yield offset, json.loads(line)
+            offset += len(line)
+
+
+# the text column of the last parquet shard that read_shard_text read from, since its chunks are read one after another.
+_parquet_texts = (None, [])  # type: tuple[Optional[str], list[str]]
+_parquet_texts_lock = threading.Lock()
+
+
+def read_shard_text(path: str, offset: int) -> str:
+    """
+    :param path:
+    :param offset: see iter_shard_records.
+    :return: the text of the record.
+    """
+    global _parquet_texts
+    if path.endswith(SHARD_FORMAT_PARQUET):
+        with _parquet_texts_lock:
+            if _parquet_texts[0] != path:
+                import pandas as pd
+                _parquet_texts = (path, pd.read_parquet(path, columns=["text"])["text"].tolist())
+            return _parquet_texts[1][offset]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline())["text"]
+
+
+def iter_shard_inputs(path: str, subfolder: Optional[str] = None,
+                      extensions: Optional[tuple[str, ...]] = None) -> Iterator[ChunkInput]:
+    """
+    :param path:
+    :param subfolder: the subfolder of the input folder that the shard is in, if any; see ChunkInput.
+    :param extensions: see list_inputs.
+    :return: the shard's chunks, without their texts.
+    """
+    # chunks always get .txt subpaths.
+    if extensions is not None and not ".txt".endswith(extensions):
+        return
+    for offset, r in iter_shard_records(path, columns=["source", "chunk_index"]):
+        if subfolder is None:
+            yield ChunkInput(os.path.join(r["source"], f"chunk_{r['chunk_index']}.txt"), path, offset)
+        else:
+            yield ChunkInput(os.path.join(subfolder, f"{r['source']}_chunk_{r['chunk_index']}.txt"), path, offset)
+
+
+class ShardWriter:
+    """
+    Writes chunks to a single shard file instead of a file per chunk, which is much cheaper at millions of chunks.
+    Each record is {"source", "chunk_index", "text", "token_count"}; the token count is the one the extractor added up
+    while it built the chunk, which can be over the count of the whole text by up to a token per line. jsonl shards are
+    written as chunks arrive; parquet shards are written on close. No file is created if no chunks are written.
+    """
+    def __init__(self, path: str, shard_format: str):
+        if shard_format not in SHARD_FORMATS:
+            raise ValueError(f"{shard_format} is an unsupported shard format; expected one of {SHARD_FORMATS}")
+        self.path = path
+        self.shard_format = shard_format
+        self.record_count = 0
+        self._file = None
+        self._records = []  # type: list[dict[str, Any]]
+
+    def write(self, source: str, chunk_index: int, text: str, token_count: int):
+        record = {"source": source, "chunk_index": chunk_index, "text": text, "token_count": token_count}
+        self.record_count += 1
+        if self.shard_format == SHARD_FORMAT_PARQUET:
+            self._records.append(record)
+            return
+        if self._file is None:
+            self._file = open(self.path, 'w', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._records:
+            import pandas as pd
+            pd.DataFrame(self._records, columns=["source", "chunk_index", "text", "token_count"]).to_parquet(self.path)
+            self._records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def write_output_and_debug_files(out_folder: str, filename: str, result: str, debug_files: dict[str,str]):
@@ -42,3 +232,58 @@ def write_output_and_debug_files(out_folder: str, filename: str, result: str, de
                                            filename.replace(".json", f"{suffix}.json"))
                 with open(output_path, 'w', encoding='utf-8') as file:
                     file.writelines(contents)
+
+
+def run_in_process_pool(function: Callable, jobs: list[tuple], workers: int, desc: str,
+                        initializer: Optional[Callable] = None, initargs: tuple = ()) -> list[Any]:
+    """
+    Run function(*job) for every job, spread across a pool of worker processes.
+    Progress is shown as jobs complete, but the results are returned in the same order as jobs, so that callers
+    don't depend on how the work was scheduled.
+    With workers <= 1, the jobs are run one at a time in this process instead.
+
+    :param function: must be a module-level function, so that worker processes can import it.
+    :param jobs: the arguments for each call to function.
+    :param workers: the number of worker processes.
+    :param desc: the progress bar description.
+    :param initializer: called once in each worker process, e.g. to load a tokenizer.
+    :param initargs: the arguments to initializer.
+    :return: the result of each job.
+    """
+    if workers <= 1:
+        return [function(*job) for job in tqdm.tqdm(jobs, desc)]
+
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        future_to_index = {executor.submit(function, *job): index for index, job in enumerate(jobs)}
+        for future in tqdm.tqdm(as_completed(future_to_index), desc, total=len(jobs)):
+            results[future_to_index[future]] = future.result()
+    return results
+
+
+def iter_in_thread_pool(function: Callable, jobs: Iterable[tuple], concurrency: int) -> Iterator[tuple[tuple, Any]]:
+    """
+    Run function(*job) for every job with up to concurrency calls in flight, e.g. to keep several AI requests running
+    at once. Jobs are only taken from the iterable when there's room for them, so preparing a job (e.g. loading its
+    file) happens in the calling thread, in order. With concurrency <= 1, each job is run in the calling thread.
+
+    :param function: must be thread-safe.
+    :param jobs: the arguments for each call to function.
+    :param concurrency: the maximum number of calls in flight.
+    :return: (job, result) as each call completes, which isn't necessarily the order of jobs.
+    """
+    if concurrency <= 1:
+        for job in jobs:
+            yield job, function(*job)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        future_to_job = {}
+        for job in jobs:
+            if len(future_to_job) >= concurrency:
+                done, _ = wait(future_to_job, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future_to_job.pop(future), future.result()
+            future_to_job[executor.submit(function, *job)] = job
+        for future in as_completed(future_to_job):
+            yield future_to_job[future], future.result()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any
+
+MANIFEST_FILENAME = "chunks_manifest.json"
+MANIFEST_VERSION = 1
+
+
+class ChunkManifest:
+    """
+    Records, in the output folder of an extractor, what each input file was converted into: the input's content hash,
+    the settings it was converted with (e.g. max_tokens and the tokenizer id) and the output paths it produced.
+    An input is only reconverted if its contents or the settings changed, and the outputs of inputs that no longer
+    exist are removed.
+    Inputs are hashed in full unless their size and modification time match the manifest, so that a rerun over an
+    unchanged corpus doesn't have to read it.
+    """
+    def __init__(self, out_folder: str, conversion_settings: dict[str, Any]):
+        self.out_folder = out_folder
+        self.path = os.path.join(out_folder, MANIFEST_FILENAME)
+        self.conversion_settings = conversion_settings
+        self.entries = {}  # type: dict[str, dict[str, Any]]
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest["inputs"]
+        self._fingerprints = {}  # type: dict[str, dict[str, Any]]
+
+    def is_up_to_date(self, name: str, input_path: str) -> bool:
+        """
+        :param name: identifies the input within the manifest, e.g. its filename.
+        :param input_path:
+        :return: true if the input was already converted, with the same contents and settings, and its outputs exist.
+        """
+        entry = self.entries.get(name, None)
+        if entry is None or entry["settings"] != self.conversion_settings:
+            return False
+        if self._get_fingerprint(name, input_path)["sha256"] != entry["sha256"]:
+            return False
+        return all([os.path.exists(os.path.join(self.out_folder, p)) for p in entry["outputs"]])
+
+    def record(self, name: str, input_path: str, outputs: list[str]):
+        """
+        :param name:
+        :param input_path:
+        :param outputs: the paths written for this input, either absolute or relative to the output folder.
+            A folder is treated as belonging entirely to this input.
+        :return:
+        """
+        self.entries[name] = {
+            **self._get_fingerprint(name, input_path),
+            "settings": self.conversion_settings,
+            "outputs": sorted([os.path.relpath(p, self.out_folder) if os.path.isabs(p) else p for p in outputs]),
+        }
+
+    def remove_outputs(self, name: str):
+        """
+        Delete the outputs recorded for an input (e.g. before it's reconverted, since it may produce fewer chunks).
+
+        :param name:
+        :return:
+        """
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        for output in entry["outputs"]:
+            path = os.path.join(self.out_folder, output)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.isfile(path):
+                os.remove(path)
+
+    def remove_deleted_inputs(self, names: list[str]) -> list[str]:
+        """
+        :param names: every input that currently exists.
+        :return: the inputs that were removed from the manifest, along with their outputs.
+        """
+        deleted = sorted(set(self.entries.keys()).difference(names))
+        for name in deleted:
+            self.remove_outputs(name)
+        return deleted
+
+    def save(self):
+        os.makedirs(self.out_folder, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": MANIFEST_VERSION, "inputs": self.entries}, f, ensure_ascii=False, indent=2,
+                      sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def _get_fingerprint(self, name: str, input_path: str) -> dict[str, Any]:
+        if name in self._fingerprints:
+            return self._fingerprints[name]
+        stat = os.stat(input_path)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        entry = self.entries.get(name, None)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            fingerprint["sha256"] = entry["sha256"]
+        else:
+            fingerprint["sha256"] = hash_file(input_path)
+        self._fingerprints[name] = fingerprint
+        return fingerprint
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import Any, Collection, Optional
+
+
+class Endpoint:
+    def __init__(self, url: str, weight: float = 1, max_concurrency: int = 0):
+        """
+        :param url:
+        :param weight: the endpoint's share of the requests, relative to the other endpoints'.
+        :param max_concurrency: the most requests in flight to this endpoint; 0 is unlimited.
+        """
+        if weight <= 0:
+            raise ValueError(f"the endpoint {url} should have a positive weight, not {weight}")
+        self.url = url
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.stats = {"requests": 0, "failures": 0, "ejections": 0, "seconds": 0.0}
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def is_full(self) -> bool:
+        return 0 < self.max_concurrency <= self.outstanding
+
+
+class EndpointPool:
+    """
+    Spreads requests across several servers: each request goes to the healthy endpoint with the fewest outstanding
+    requests for its weight, without going over an endpoint's max_concurrency (if every endpoint is full, acquire
+    waits for a request to finish).
+    An endpoint that fails failures_to_eject requests in a row (e.g. it's down or overloaded) is ejected for
+    ejection_seconds; after that, it's sent a single request to check its health, and it's ejected again if that fails.
+    Safe to share between threads.
+    """
+    def __init__(self, endpoints: list[Endpoint], failures_to_eject: int = 3, ejection_seconds: float = 30):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.failures_to_eject = failures_to_eject
+        self.ejection_seconds = ejection_seconds
+        self._condition = threading.Condition()
+        self._start = time.monotonic()
+
+    def acquire(self, exclude: Collection[str] = ()) -> Endpoint:
+        """
+        Block until an endpoint can take another request.
+
+        :param exclude: the urls of endpoints that can't take this request.
+        :return: the endpoint to send the request to; it should be passed to release once the request finishes.
+        """
+        with self._condition:
+            while True:
+                if all(e.url in exclude for e in self.endpoints):
+                    raise ValueError("every endpoint is excluded")
+                now = time.monotonic()
+                endpoint = self._choose(now, exclude)
+                if endpoint is not None:
+                    break
+                # wait for a request to finish, or for an ejected endpoint to come back.
+                ejections = [e.ejected_until - now for e in self.endpoints if e.is_ejected(now)]
+                self._condition.wait(min(ejections) if ejections else None)
+            endpoint.outstanding += 1
+            endpoint.stats["requests"] += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, healthy: bool, seconds: float = 0):
+        """
+        :param endpoint: from acquire.
+        :param healthy: false if the request failed in a way that suggests the endpoint is unhealthy, i.e. a dropped
+            connection or a 5xx response (not a 429 or a timeout, which only mean that it's busy).
+        :param seconds: how long the request took.
+        :return:
+        """
+        with self._condition:
+            endpoint.outstanding -= 1
+            endpoint.stats["seconds"] += seconds
+            if healthy:
+                endpoint.consecutive_failures = 0
+            else:
+                endpoint.stats["failures"] += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failures_to_eject:
+                    endpoint.ejected_until = time.monotonic() + self.ejection_seconds
+                    endpoint.stats["ejections"] += 1
+            self._condition.notify_all()
+
+    def get_stats(self) -> dict[str, dict[str, Any]]:
+        """
+        :return: url -> the endpoint's request counts, mean latency and throughput since the pool was created.
+        """
+        with self._condition:
+            now = time.monotonic()
+            elapsed = now - self._start
+            stats = {}
+            for e in self.endpoints:
+                finished = e.stats["requests"] - e.outstanding
+                stats[e.url] = {**e.stats,
+                                "seconds": round(e.stats["seconds"], 2),
+                                "mean_latency": round(e.stats["seconds"] / finished, 3) if finished else 0,
+                                "requests_per_second": round(finished / elapsed, 3) if elapsed > 0 else 0,
+                                "outstanding": e.outstanding,
+                                "ejected": e.is_ejected(now)}
+            return stats
+
+    def _choose(self, now: float, exclude: Collection[str]) -> Optional[Endpoint]:
+        candidates = []
+        for index, e in enumerate(self.endpoints):
+            if e.url in exclude or e.is_ejected(now) or e.is_full():
+                continue
+            # an endpoint back from an ejection gets a single request, until that request shows it's healthy.
+            if e.consecutive_failures >= self.failures_to_eject and e.outstanding > 0:
+                continue
+            candidates.append((e.outstanding / e.weight, e.stats["requests"] / e.weight, index))
+        if not candidates:
+            return None
+        return self.endpoints[min(candidates)[2]]
@@ -1,11 +1,20 @@
 import json
 import os
+import string
+import threading
+from typing import Any, Optional
 
-from library.ai_requests import run_ai_request, EmptyResponseException
+from library.ai_requests import run_ai_request, get_output_mode, EmptyResponseException, OUTPUT_MODE_ECHO
+from library.stream_validator import StreamValidator
 from library.token_count import get_token_count
 
+# see get_few_shot_template.
+_templates = {}  # type: dict[str, FewShotTemplate]
+_templates_lock = threading.Lock()
 
-def few_shot_request(template_filepath: str, replacements: dict) -> dict:
+
+def few_shot_request(template_filepath: str, replacements: dict, cancel_event: Optional[threading.Event] = None,
+                     validator: Optional[StreamValidator] = None) -> dict:
     """
 We're expecting the template file to be of a format like this:
     >name: John
@@ -22,32 +31,29 @@ So, the format is:
 - we rely on dummy '>key:value' lines to terminate multiline elements.
 - a blank line signifies the end of one entry.
 - the final entry is expected to be filled out by the AI, we should make sure not to mess it up with excess spacing.
-    """
-    assert os.path.exists(template_filepath)
-    with open(template_filepath, 'r', encoding='utf-8') as file:
-        template = file.read()
-    if len(template) > 0 and template[-1] == "\n":
-        template = template[:-1]
-
-    template_settings = template_filepath.replace(".txt", ".params.json")
-    assert os.path.exists(template_settings)
-    with open(template_settings, 'r', encoding='utf-8') as file:
-        settings_json = json.loads(file.read())
 
+cancel_event can be set (e.g. from another thread) to cancel the AI request; see ai_requests.run_ai_request_ooba.
+validator checks the response while it's streamed (see ai_requests.read_completion_events); it's told to expect the
+keys of the template's examples that the final entry doesn't have yet, and to ignore the keys removed from the result.
+    """
+    template = get_few_shot_template(template_filepath)
+    settings_json = template.params
     if not settings_json.get("enable_context", False):
-        del replacements["context"]
+        replacements.pop("context", None)
+    request = template.render(replacements)
 
-    request = template.format_map(replacements)
-    remove_keys = settings_json.get("remove_keys_from_prompt", [])
-    if remove_keys:
-        request = edit_few_shot_request(request, remove_keys)
+    if validator is not None:
+        validator.expect_keys(template.response_keys, settings_json.get("remove_keys_from_result", []))
 
-    print("running request of size, ", get_token_count(request))
+    if get_output_mode() == OUTPUT_MODE_ECHO:
+        print("running request of size, ", get_token_count(request))
     result = run_ai_request(request,
                             custom_stopping_strings=settings_json.get("stopping_strings", ["\n\n"]),
                             temperature=settings_json.get("temperature", .2),
                             max_response=settings_json.get("response_length", 600),
-                            ban_eos_token=True)
+                            ban_eos_token=True,
+                            cancel_event=cancel_event,
+                            validator=validator)
     if len(result) == 0:
         raise EmptyResponseException("AI request returned an empty response. Is the connection to the AI working?")
 
@@ -68,6 +74,108 @@ So, the format is:
     return result_dict
 
 
+class FewShotTemplate:
+    """
+    A few shot template and its .params.json, loaded once: remove_keys_from_prompt is applied to the template itself
+    (rather than to every request, story and all), and the template is split at its placeholders into literal
+    segments, so that rendering a request only has to join the segments with the replacements.
+    A FewShotTemplate doesn't change once it's loaded; see get_few_shot_template for reloading it.
+    """
+    def __init__(self, template_filepath: str):
+        self.template_filepath = template_filepath
+        self.params_filepath = template_filepath.replace(".txt", ".params.json")
+        # read before the files, so that a change while they're read makes the template stale.
+        self.file_versions = get_file_versions([self.template_filepath, self.params_filepath])
+        with open(self.params_filepath, 'r', encoding='utf-8') as file:
+            self.params = json.loads(file.read())  # type: dict[str, Any]
+        with open(self.template_filepath, 'r', encoding='utf-8') as file:
+            template = file.read()
+        if len(template) > 0 and template[-1] == "\n":
+            template = template[:-1]
+
+        remove_keys = self.params.get("remove_keys_from_prompt", [])
+        if remove_keys:
+            template = edit_few_shot_request(template, remove_keys)
+        self.template = template
+        self.response_keys = get_response_keys(template, remove_keys)
+
+        # (literal text, field name, conversion, format spec) for each placeholder, then the text after the last one.
+        self._formatter = string.Formatter()
+        self._segments = []  # type: list[tuple[str, Optional[str], Optional[str], str]]
+        for literal, field_name, format_spec, conversion in self._formatter.parse(template):
+            self._segments.append((literal, field_name, conversion, format_spec or ""))
+
+    @property
+    def prefix(self) -> str:
+        """
+        :return: the text before the first placeholder, which is the same for every request.
+        """
+        # a literal is split at each escaped brace ('{{' or '}}'), where parse yields a segment without a field.
+        parts = []
+        for literal, field_name, _, _ in self._segments:
+            parts.append(literal)
+            if field_name is not None:
+                break
+        return "".join(parts)
+
+    def render(self, replacements: dict[str, Any]) -> str:
+        """
+        :param replacements: placeholder -> value.
+        :return: the same as template.format_map(replacements).
+        """
+        parts = []
+        for literal, field_name, conversion, format_spec in self._segments:
+            parts.append(literal)
+            if field_name is not None:
+                value = self._formatter.get_field(field_name, (), replacements)[0]
+                value = self._formatter.convert_field(value, conversion)
+                parts.append(self._formatter.format_field(value, format_spec))
+        return "".join(parts)
+
+    def is_stale(self) -> bool:
+        """
+        :return: true if the template or its params changed since they were loaded.
+        """
+        return get_file_versions([self.template_filepath, self.params_filepath]) != self.file_versions
+
+
+def get_few_shot_template(template_filepath: str) -> FewShotTemplate:
+    """
+    :param template_filepath:
+    :return: the template, loaded once for each process; it's loaded again if its files are changed.
+    """
+    with _templates_lock:
+        template = _templates.get(template_filepath, None)
+        if template is None or template.is_stale():
+            template = FewShotTemplate(template_filepath)
+            _templates[template_filepath] = template
+        return template
+
+
+def get_file_versions(filepaths: list[str]) -> list[tuple[int, int]]:
+    """
+    :return: the modification time and size of each file.
+    """
+    versions = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        versions.append((stat.st_mtime_ns, stat.st_size))
+    return versions
+
+
+def get_response_keys(template: str, remove_keys: list[str]) -> Optional[list[str]]:
+    """
+    :param template:
+    :param remove_keys: the keys that are removed from the prompt.
+    :return: the keys that the AI should fill out: those of the template's last complete example that the final entry
+        doesn't have. None if the template doesn't have a complete example.
+    """
+    all_examples = parse_few_shot_format(template)
+    if len(all_examples) < 2:
+        return None
+    return [k for k in all_examples[-2] if k not in all_examples[-1] and k not in remove_keys]
+
+
 def edit_few_shot_request(prompt: str, remove_keys: list[str]) -> str:
     all_examples = parse_few_shot_format(prompt)
     result_lines = []
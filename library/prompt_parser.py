@@ -1,7 +1,8 @@
 import json
 import random
+from typing import Optional
 
-from library.token_count import get_token_count
+from library.token_count import get_token_count, get_token_counts
 from library.settings_manager import settings
 from library.hacks_dataset_specific import prompt_dict_to_style_string, undo_hyphens
 
@@ -40,11 +41,25 @@ def prepare_prompt_dict_for_row(prompt_dict: dict):
     return new_dict
 
 
-def generate_dataset_row_from_prompt_dict(prompt_dict: dict, drop_tags_prob: float, droppable_tags: list):
+def replace_unicode_quotes(prompt_dict: dict) -> dict:
     for field in settings.get_setting("prompt_format.replace_unicode_quotes_fields"):
         val = prompt_dict.get(field, None)
         if val:
             prompt_dict[field] = val.replace("\u201d", "\"").replace("\u201c", "\"")
+    return prompt_dict
+
+
+def generate_dataset_row_from_prompt_dict(prompt_dict: dict, drop_tags_prob: float, droppable_tags: list,
+                                          story_token_count: Optional[int] = None):
+    """
+    :param prompt_dict:
+    :param drop_tags_prob:
+    :param droppable_tags:
+    :param story_token_count: the token count of the story (after replace_unicode_quotes), if it was already counted
+        as part of a batch.
+    :return:
+    """
+    prompt_dict = replace_unicode_quotes(prompt_dict)
 
     context = prompt_dict.get("context", None)
     if context is not None and (len(context.strip()) == 0 or context == "N\A"):
@@ -77,7 +92,9 @@ def generate_dataset_row_from_prompt_dict(prompt_dict: dict, drop_tags_prob: flo
 
     length = ""
     if len(style) > 0:
-        token_count = get_token_count(story)
+        token_count = story_token_count
+        if token_count is None:
+            token_count = get_token_count(story)
         if token_count < 300:
             length = "short"
         elif token_count < 500:
@@ -114,13 +131,23 @@ def estimate_total_tokens(all_strs: list[str]):
     return get_token_count("".join([s for s in all_strs if s is not None])) + format_tokens
 
 
+def estimate_total_tokens_batch(all_rows: list[list[str]]) -> list[int]:
+    format_tokens = 50  # the isolated "### System..."
+    counts = get_token_counts(["".join([s for s in all_strs if s is not None]) for all_strs in all_rows])
+    return [c + format_tokens for c in counts]
+
+
 def load_prompt_file(filepath: str) -> tuple[str, dict]:
     print("Processing file:", filepath)
     with open(filepath, 'r', encoding='utf-8') as file:
         script_chunk = file.read()
+    return script_chunk, parse_prompt_text(script_chunk)
+
+
+def parse_prompt_text(script_chunk: str) -> Optional[dict]:
     prompt_dict = None
     try:
         prompt_dict = json.loads(script_chunk)
     except ValueError:  # as a convenience, try to load the script as a dictionary
         pass
-    return script_chunk, prompt_dict
+    return prompt_dict
@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_THROTTLED = "throttled"
+OUTCOME_FAILED = "failed"
+
+
+class RateLimiter:
+    """
+    Paces requests to an AI backend, whatever the backend is:
+    - at most requests_per_minute requests and tokens_per_minute tokens are started within any window_seconds; 0 is
+      unlimited.
+    - the number of requests in flight is adapted AIMD style: it grows by one for every 'limit' successful requests,
+      up to max_concurrency, and is halved whenever the backend throttles a request (a 429 or a timeout).
+    Safe to share between threads.
+    """
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, max_concurrency: int = 64,
+                 min_concurrency: int = 1, window_seconds: float = 60):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.window_seconds = window_seconds
+        self.concurrency_limit = float(max_concurrency)
+        self._condition = threading.Condition()
+        self._active = 0
+        self._window = collections.deque()  # type: collections.deque[list]
+        self._window_tokens = 0
+        self.metrics = {"requests": 0, "successes": 0, "failures": 0, "retries": 0, "throttle_events": 0,
+                        "rate_limited_waits": 0, "seconds_waited": 0.0}
+
+    def acquire(self, tokens: int = 0) -> list:
+        """
+        Block until a request can be started.
+
+        :param tokens: an estimate of the tokens the request will use (the prompt and the response).
+        :return: a ticket, to be passed to release once the request finishes.
+        """
+        start = time.monotonic()
+        waited = False
+        with self._condition:
+            while True:
+                ticket, timeout = self._try_acquire(tokens, start, waited)
+                if ticket is not None:
+                    return ticket
+                waited = True
+                self._condition.wait(timeout)
+
+    async def acquire_async(self, tokens: int = 0, poll_seconds: float = .05) -> list:
+        """
+        Like acquire, but waits without blocking the event loop, for requests that are run asynchronously.
+
+        :param tokens:
+        :param poll_seconds: how often to check whether a request has finished, while waiting for one.
+        :return: a ticket, to be passed to release once the request finishes.
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self._condition:
+                ticket, timeout = self._try_acquire(tokens, start, waited)
+            if ticket is not None:
+                return ticket
+            waited = True
+            await asyncio.sleep(poll_seconds if timeout is None else min(timeout, poll_seconds))
+
+    def _try_acquire(self, tokens: int, start: float, waited: bool) -> tuple[Optional[list], Optional[float]]:
+        # with the lock held. returns a ticket if the request can start, or else the seconds to wait (see _get_wait).
+        now = time.monotonic()
+        self._expire(now)
+        timeout = self._get_wait(now, tokens)
+        if timeout != 0:
+            return None, timeout
+        self._active += 1
+        ticket = [now, tokens, True]  # start time, tokens, whether it's still in the window
+        self._window.append(ticket)
+        self._window_tokens += tokens
+        self.metrics["requests"] += 1
+        if waited:
+            self.metrics["rate_limited_waits"] += 1
+            self.metrics["seconds_waited"] += time.monotonic() - start
+        return ticket, None
+
+    def release(self, ticket: list, outcome: str, tokens: Optional[int] = None):
+        """
+        :param ticket: from acquire.
+        :param outcome: OUTCOME_SUCCESS, OUTCOME_THROTTLED or OUTCOME_FAILED.
+        :param tokens: the tokens the request actually used, if they're known; replaces acquire's estimate.
+        :return:
+        """
+        with self._condition:
+            self._active -= 1
+            if tokens is not None and ticket[2]:
+                self._window_tokens += tokens - ticket[1]
+                ticket[1] = tokens
+            if outcome == OUTCOME_SUCCESS:
+                self.metrics["successes"] += 1
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+            elif outcome == OUTCOME_THROTTLED:
+                self.metrics["throttle_events"] += 1
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+            else:
+                self.metrics["failures"] += 1
+            self._condition.notify_all()
+
+    def record_retry(self):
+        with self._condition:
+            self.metrics["retries"] += 1
+
+    def get_metrics(self) -> dict[str, Any]:
+        with self._condition:
+            return {**self.metrics,
+                    "seconds_waited": round(self.metrics["seconds_waited"], 2),
+                    "concurrency_limit": round(self.concurrency_limit, 2)}
+
+    def _expire(self, now: float):
+        while self._window and self._window[0][0] <= now - self.window_seconds:
+            expired = self._window.popleft()
+            expired[2] = False
+            self._window_tokens -= expired[1]
+
+    def _get_wait(self, now: float, tokens: int) -> Optional[float]:
+        # returns 0 if the request can start, None to wait for a request to finish, or else the seconds to wait.
+        if self._active >= int(self.concurrency_limit):
+            return None
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            return self._window[0][0] + self.window_seconds - now
+        # a single request bigger than the budget is let through on its own, rather than waiting forever.
+        if self.tokens_per_minute and self._window and self._window_tokens + tokens > self.tokens_per_minute:
+            return self._window[0][0] + self.window_seconds - now
+        return 0
+
+
+def classify_error(e: Exception) -> Optional[str]:
+    """
+    :param e: an exception raised by a request to an AI backend.
+    :return: OUTCOME_THROTTLED if the backend is overloaded (a 429 or a timeout), OUTCOME_FAILED for other errors
+        that are worth retrying (dropped connections and 5xx responses), or None if retrying won't help.
+    """
+    import requests
+
+    status = None
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+    elif isinstance(getattr(e, "code", None), int):
+        status = e.code  # google.api_core exceptions, e.g. ResourceExhausted is a 429
+    if status == 429 or isinstance(e, (requests.Timeout, TimeoutError)) or type(e).__name__ == "DeadlineExceeded":
+        return OUTCOME_THROTTLED
+    if isinstance(e, (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, ConnectionError)) or \
+            (status is not None and 500 <= status < 600):
+        return OUTCOME_FAILED
+    return None
+
+
+def run_with_retries(function: Callable[[], T], rate_limiter: RateLimiter, tokens: int = 0, max_retries: int = 5,
+                     backoff_base: float = 1, backoff_max: float = 60,
+                     count_tokens: Optional[Callable[[T], int]] = None) -> T:
+    """
+    Run a request under the rate limiter, retrying retryable errors (see classify_error) with exponential backoff and
+    full jitter.
+
+    :param function: makes the request.
+    :param rate_limiter:
+    :param tokens: an estimate of the tokens the request will use.
+    :param max_retries:
+    :param backoff_base: the first retry waits up to this many seconds; each later retry waits up to twice as long.
+    :param backoff_max: the most seconds to wait before a retry.
+    :param count_tokens: counts the tokens a request actually used, from its result.
+    :return: the result of function.
+    """
+    attempt = 0
+    while True:
+        ticket = rate_limiter.acquire(tokens)
+        try:
+            result = function()
+        except Exception as e:
+            outcome = classify_error(e)
+            rate_limiter.release(ticket, outcome or OUTCOME_FAILED)
+            if outcome is None or attempt >= max_retries:
+                raise
+            delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+            print(f"request failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s "
+                  f"(retry {attempt + 1}/{max_retries})")
+            rate_limiter.record_retry()
+            time.sleep(delay)
+            attempt += 1
+            continue
+        rate_limiter.release(ticket, OUTCOME_SUCCESS, count_tokens(result) if count_tokens else None)
+        return result
+
+
+async def run_with_retries_async(function: Callable[[], Awaitable[T]], rate_limiter: RateLimiter, tokens: int = 0,
+                                 max_retries: int = 5, backoff_base: float = 1, backoff_max: float = 60,
+                                 count_tokens: Optional[Callable[[T], int]] = None) -> T:
+    """
+    Like run_with_retries, for requests that are run asynchronously.
+
+    :param function: returns an awaitable that makes the request; it's called again for each retry.
+    :param rate_limiter:
+    :param tokens:
+    :param max_retries:
+    :param backoff_base:
+    :param backoff_max:
+    :param count_tokens:
+    :return: the result of the request.
+    """
+    attempt = 0
+    while True:
+        ticket = await rate_limiter.acquire_async(tokens)
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            rate_limiter.release(ticket, OUTCOME_FAILED)
+            raise
+        except Exception as e:
+            outcome = classify_error(e)
+            rate_limiter.release(ticket, outcome or OUTCOME_FAILED)
+            if outcome is None or attempt >= max_retries:
+                raise
+            delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+            print(f"request failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s "
+                  f"(retry {attempt + 1}/{max_retries})")
+            rate_limiter.record_retry()
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        rate_limiter.release(ticket, OUTCOME_SUCCESS, count_tokens(result) if count_tokens else None)
+        return result
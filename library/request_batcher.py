@@ -0,0 +1,79 @@
+import json
+import threading
+from typing import Any, Callable, Optional
+
+
+class _BatchItem:
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        self.done = threading.Event()
+        self.result = None  # type: Optional[str]
+        self.error = None  # type: Optional[BaseException]
+
+
+class RequestBatcher:
+    """
+    Combines the prompts that several threads submit at about the same time, with the same parameters, into batches
+    for run_batch (e.g. ai_requests.run_ai_requests).
+    A batch is sent as soon as it has max_batch_size prompts, or once its first prompt has waited max_wait seconds.
+    There's no background thread: the thread that fills (or times out) a batch sends it, and hands the results to the
+    other threads waiting on that batch.
+    """
+    def __init__(self, run_batch: Callable[..., list[str]], max_batch_size: int, max_wait: float = .05):
+        """
+        :param run_batch: called as run_batch(prompts, **parameters), returning a response for each prompt, or an
+            exception for a prompt that failed on its own.
+        :param max_batch_size:
+        :param max_wait:
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = {}  # type: dict[str, list[_BatchItem]]
+        self.batch_sizes = []  # type: list[int]
+
+    def run(self, prompt: str, **parameters: Any) -> str:
+        """
+        :param prompt:
+        :param parameters: keyword arguments for run_batch; only prompts with the same parameters are batched together.
+        :return: the response to the prompt.
+        """
+        key = json.dumps(parameters, sort_keys=True)
+        item = _BatchItem(prompt)
+        with self._lock:
+            batch = self._pending.setdefault(key, [])
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                del self._pending[key]
+            else:
+                batch = None
+
+        if batch is None and not item.done.wait(self.max_wait):
+            with self._lock:
+                pending = self._pending.get(key, None)
+                if pending is not None and item in pending:
+                    batch = self._pending.pop(key)
+        if batch is not None:
+            self._send(batch, parameters)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _send(self, batch: list[_BatchItem], parameters: dict[str, Any]):
+        with self._lock:
+            self.batch_sizes.append(len(batch))
+        try:
+            results = self.run_batch([i.prompt for i in batch], **parameters)
+            for item, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    item.error = result
+                else:
+                    item.result = result
+        except BaseException as e:
+            for item in batch:
+                item.error = e
+        finally:
+            for item in batch:
+                item.done.set()
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+MODE_OFF = "off"
+MODE_READ_WRITE = "read-write"
+MODE_REPLAY_ONLY = "replay-only"
+MODES = [MODE_OFF, MODE_READ_WRITE, MODE_REPLAY_ONLY]
+
+
+class ResponseCacheMissException(ValueError):
+    pass
+
+
+class ResponseCache:
+    """
+    Stores AI responses in an sqlite file, keyed by a hash of the request (the backend, model, prompt and sampling
+    parameters), so that rerunning a batch doesn't pay for the same generations again.
+    Identical requests made more than once in a run (e.g. retrying a junk response) are told apart by how many times
+    they've been made so far, so a rerun replays the same sequence of responses instead of the first one every time.
+    The least recently used responses are evicted once the stored responses exceed max_bytes.
+    Safe to share between threads; each process opens its own connection to the sqlite file.
+    """
+    def __init__(self, db_path: str, max_bytes: int, mode: str = MODE_READ_WRITE):
+        if mode not in MODES:
+            raise ValueError(f"{mode} is an unsupported response cache mode; expected one of {MODES}")
+        self._db_path = db_path
+        self._max_bytes = max_bytes
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._connection = None  # type: Optional[sqlite3.Connection]
+        self._connection_pid = None  # type: Optional[int]
+        self._total_bytes = None  # type: Optional[int]
+        self._request_counts = {}  # type: dict[bytes, int]
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, request: dict[str, Any]) -> bytes:
+        """
+        :param request: everything that affects the response, e.g. {"backend", "model", "prompt", "temperature", ...}
+        :return: the key for the next occurrence of this request.
+        """
+        h = hashlib.blake2b(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8'), digest_size=16)
+        request_key = h.digest()
+        with self._lock:
+            occurrence = self._request_counts.get(request_key, 0)
+            self._request_counts[request_key] = occurrence + 1
+        return hashlib.blake2b(request_key + occurrence.to_bytes(4, "little"), digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        """
+        :param key:
+        :return: the cached response, or None. In replay-only mode, a miss raises ResponseCacheMissException instead.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == MODE_REPLAY_ONLY:
+                    raise ResponseCacheMissException("the response cache is in replay-only mode and doesn't have a "
+                                                     "response for this request")
+                return None
+            self.hits += 1
+            with connection:
+                connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: bytes, response: str):
+        if self.mode != MODE_READ_WRITE:
+            return
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                old_size = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) "
+                                   "VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self._total_bytes += size - (old_size[0] if old_size else 0)
+            if self._total_bytes > self._max_bytes:
+                self._evict()
+
+    def get_stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0}
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _evict(self):
+        # evict down to 90% of the limit, so that eviction doesn't run again on the very next response.
+        connection = self._get_connection()
+        target = self._max_bytes * 0.9
+        evicted_keys = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self._total_bytes <= target:
+                break
+            evicted_keys.append((key,))
+            self._total_bytes -= size
+        with connection:
+            connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # a connection can't be shared with a forked worker process, so each process opens its own.
+        if self._connection is None or self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self._db_path)), exist_ok=True)
+            self._connection = sqlite3.connect(self._db_path, timeout=60, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                     "(key BLOB PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._connection_pid = os.getpid()
+            self._total_bytes = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._connection
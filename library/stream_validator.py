@@ -0,0 +1,131 @@
+import json
+from typing import Iterable, Optional
+
+VALIDATION_CONTINUE = "continue"
+VALIDATION_ABORT = "abort"
+VALIDATION_STOP = "stop"
+
+
+class StreamValidator:
+    """
+    Parses a few shot response (">key: value" lines, see few_shot_request.parse_few_shot_format) while it's streamed,
+    to find out as early as possible whether it's junk:
+    - a value contains a blacklisted string (checked as the value grows, since it can't go away), or
+    - a value is shorter than min_value_length once it's complete (i.e. the next key has started).
+    Once every expected key has a complete value, or a key comes back a second time, the response has run past the end
+    of its entry, so the rest of it isn't needed.
+    A validator holds the state of a single response.
+    """
+    def __init__(self, blacklist: Iterable[str] = (), min_value_length: int = 2,
+                 expected_keys: Optional[list[str]] = None, ignored_keys: Iterable[str] = ()):
+        """
+        :param blacklist: strings that make a response junk if they appear in any value.
+        :param min_value_length: shorter values (e.g. blank values and placeholders like "-") make a response junk.
+        :param expected_keys: the keys of a complete response, if they're known.
+        :param ignored_keys: keys whose values aren't checked, e.g. because they're removed from the result.
+        """
+        self.blacklist = list(blacklist)
+        self.min_value_length = min_value_length
+        self.expected_keys = expected_keys
+        self.ignored_keys = set(ignored_keys)
+        self.text = ""
+        self.keys = []  # type: list[str]
+        self.abort_reason = None  # type: Optional[str]
+        self.stop_offset = None  # type: Optional[int]
+        self._line_start = 0
+        self._key_line_start = None  # type: Optional[int]
+        self._value = None  # type: Optional[str]
+
+    def expect_keys(self, expected_keys: Optional[list[str]], ignored_keys: Iterable[str] = ()):
+        self.expected_keys = expected_keys
+        self.ignored_keys = set(ignored_keys)
+
+    def feed(self, new_text: str) -> str:
+        """
+        :param new_text: the next part of the response.
+        :return: VALIDATION_CONTINUE; VALIDATION_ABORT if the response is junk (see abort_reason); or VALIDATION_STOP
+            if the response is complete, and only text[:stop_offset] belongs to it.
+        """
+        self.text += new_text
+        while True:
+            line_end = self.text.find("\n", self._line_start)
+            line = self.text[self._line_start:line_end] if line_end != -1 else self.text[self._line_start:]
+            action = self._read_line(line, self._line_start, line_end != -1)
+            if action != VALIDATION_CONTINUE or line_end == -1:
+                return action
+            self._line_start = line_end + 1
+
+    def _read_line(self, line: str, offset: int, complete: bool) -> str:
+        """
+        :param line:
+        :param offset: where the line starts in text.
+        :param complete: false for the line in progress, which is read again once it's longer.
+        :return: see feed.
+        """
+        # blank lines are removed from responses before they're parsed (see ai_requests.clean_response).
+        if not line.strip():
+            return VALIDATION_CONTINUE
+        if not is_key_line(line):
+            if self._value is None or (line.startswith(">") and not complete):
+                # text before the first key isn't part of the result; and the line in progress could become a key.
+                return VALIDATION_CONTINUE
+            value = self._value + "\n" + line
+            if complete:
+                self._value = value
+            return self._check_blacklist(self.keys[-1], value)
+
+        if self._key_line_start != offset:
+            # a new key means the previous key's value is complete.
+            key = get_key(line)
+            if self._value is not None:
+                action = self._check_value(self.keys[-1], self._value)
+                if action != VALIDATION_CONTINUE:
+                    return action
+            if self._runs_past(key):
+                self.stop_offset = offset
+                return VALIDATION_STOP
+            self.keys.append(key)
+            self._key_line_start = offset
+            self._value = None
+        value = get_value(line)
+        if complete:
+            self._value = value
+        return self._check_blacklist(self.keys[-1], value)
+
+    def _runs_past(self, key: str) -> bool:
+        """
+        :return: true if a line with this key is past the end of the response's entry.
+        """
+        return key in self.keys or bool(self.expected_keys and all([k in self.keys for k in self.expected_keys]))
+
+    def _check_value(self, key: str, value: str) -> str:
+        if key in self.ignored_keys:
+            return VALIDATION_CONTINUE
+        if len(value) < self.min_value_length:
+            return self._abort(f"the value of '{key}' is too short: {json.dumps(value)}")
+        return self._check_blacklist(key, value)
+
+    def _check_blacklist(self, key: str, value: str) -> str:
+        if key in self.ignored_keys:
+            return VALIDATION_CONTINUE
+        for banned in self.blacklist:
+            if banned in value:
+                return self._abort(f"the value of '{key}' contains the blacklisted {json.dumps(banned)}")
+        return VALIDATION_CONTINUE
+
+    def _abort(self, reason: str) -> str:
+        self.abort_reason = reason
+        return VALIDATION_ABORT
+
+
+def is_key_line(line: str) -> bool:
+    return line.startswith(">") and ":" in line
+
+
+def get_key(key_line: str) -> str:
+    return key_line.split(":", 1)[0][1:].strip()
+
+
+def get_value(key_line: str) -> str:
+    value = key_line.split(":", 1)[1]
+    return value[1:] if value.startswith(" ") else value
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class TokenCountCache:
+    """
+    Memoizes token counts, keyed by a hash of the text and the tokenizer that counted it.
+    Counts are kept in a bounded in-memory LRU and, if db_path is given, in an sqlite file that survives across runs.
+    Safe to share between threads; each process opens its own connection to the sqlite file.
+    """
+    def __init__(self, tokenizer_id: str, max_entries: int, db_path: Optional[str] = None):
+        self._tokenizer_id = tokenizer_id.encode('utf-8')
+        self._max_entries = max_entries
+        self._db_path = db_path
+        self._lru = OrderedDict()  # type: OrderedDict[bytes, int]
+        self._pending_writes = {}  # type: dict[bytes, int]
+        self._lock = threading.Lock()
+        self._connection = None  # type: Optional[sqlite3.Connection]
+        self._connection_pid = None  # type: Optional[int]
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, text: str) -> bytes:
+        h = hashlib.blake2b(self._tokenizer_id, digest_size=16)
+        h.update(text.encode('utf-8', errors='surrogatepass'))
+        return h.digest()
+
+    def get_many(self, keys: list[bytes]) -> list[Optional[int]]:
+        with self._lock:
+            results = [self._lru_get(k) for k in keys]
+            missing = [k for k, v in zip(keys, results) if v is None]
+            if missing and self._db_path:
+                from_disk = self._db_get(missing)
+                for k, v in from_disk.items():
+                    self._lru_put(k, v)
+                results = [from_disk.get(k, None) if v is None else v for k, v in zip(keys, results)]
+            found = len([v for v in results if v is not None])
+            self.hits += found
+            self.misses += len(results) - found
+            return results
+
+    def put_many(self, counts: dict[bytes, int]):
+        with self._lock:
+            for k, v in counts.items():
+                self._lru_put(k, v)
+            if self._db_path:
+                self._pending_writes.update(counts)
+                if len(self._pending_writes) >= 1000:
+                    self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def get_stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._lru)}
+
+    def _lru_get(self, key: bytes) -> Optional[int]:
+        value = self._lru.get(key, None)
+        if value is not None:
+            self._lru.move_to_end(key)
+        return value
+
+    def _lru_put(self, key: bytes, value: int):
+        if self._max_entries <= 0:
+            return
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self._max_entries:
+            self._lru.popitem(last=False)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # a connection can't be shared with a forked worker process, so each process opens its own.
+        if self._connection is None or self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self._db_path)), exist_ok=True)
+            self._connection = sqlite3.connect(self._db_path, timeout=60, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS token_counts (key BLOB PRIMARY KEY, count INTEGER)")
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _db_get(self, keys: list[bytes]) -> dict[bytes, int]:
+        connection = self._get_connection()
+        result = {}
+        batch_size = 500  # sqlite limits the number of parameters in a query
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            rows = connection.execute(
+                f"SELECT key, count FROM token_counts WHERE key IN ({','.join(['?'] * len(batch))})", batch)
+            for key, count in rows:
+                result[key] = count
+        return result
+
+    def _flush(self):
+        if not self._pending_writes:
+            return
+        connection = self._get_connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO token_counts (key, count) VALUES (?, ?)",
+                                   self._pending_writes.items())
+        self._pending_writes = {}
@@ -1,18 +1,226 @@
-import sentencepiece as spm
+import abc
+import atexit
+import hashlib
+import os
+from typing import Optional
 
+from library.settings_manager import settings, ROOT_FOLDER
+from library.token_cache import TokenCountCache
 
-sp = spm.SentencePieceProcessor(
-    model_file=r'library\tokenizer\tokenizer.model')
+
+TOKENIZER_FOLDER = os.path.join(ROOT_FOLDER, "library", "tokenizer")
+BACKEND_SENTENCEPIECE = "sentencepiece"
+BACKEND_TOKENIZERS = "tokenizers"
+
+# loaded on first use, so that scripts that never tokenize anything don't pay for it.
+_tokenizer = None  # type: Optional[Tokenizer]
+_token_count_cache = None  # type: Optional[TokenCountCache]
+_num_threads_override = None  # type: Optional[int]
+
+
+class Tokenizer(abc.ABC):
+    """
+    The interface shared by the tokenizer backends. Tokens are the string pieces (e.g. '▁The'), which are the same
+    across backends for the same model.
+    """
+    def __init__(self, model_file: str):
+        self.model_file = model_file
+        self._id = None  # type: Optional[str]
+
+    @abc.abstractmethod
+    def encode_batch(self, texts: list[str], num_threads: int) -> list[list[str]]:
+        pass
+
+    @abc.abstractmethod
+    def count_batch(self, texts: list[str], num_threads: int) -> list[int]:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, tokens: list[str]) -> str:
+        pass
+
+    def get_id(self) -> str:
+        """
+        Identifies the backend and the model, so that results (like cached token counts) from a different tokenizer
+        aren't reused. The model file is only hashed the first time.
+        """
+        if self._id is None:
+            with open(self.model_file, "rb") as f:
+                self._id = f"{self.__class__.__name__}:" + hashlib.sha256(f.read()).hexdigest()
+        return self._id
+
+
+class SentencePieceTokenizer(Tokenizer):
+    def __init__(self, model_file: str = os.path.join(TOKENIZER_FOLDER, "tokenizer.model")):
+        super().__init__(model_file)
+        import sentencepiece as spm
+        self._sp = spm.SentencePieceProcessor(model_file=model_file)
+
+    def encode_batch(self, texts: list[str], num_threads: int) -> list[list[str]]:
+        return self._sp.encode(texts, out_type=str, num_threads=num_threads)
+
+    def count_batch(self, texts: list[str], num_threads: int) -> list[int]:
+        return [len(t) for t in self._sp.encode(texts, out_type=int, num_threads=num_threads)]
+
+    def decode(self, tokens: list[str]) -> str:
+        return self._sp.Decode(tokens)
+
+
+class FastTokenizer(Tokenizer):
+    """
+    The Rust 'tokenizers' library, using the bundled tokenizer.json. Batches are encoded in parallel; its thread pool
+    is created once per process, sized by RAYON_NUM_THREADS (see init_tokenizer), so num_threads only chooses between
+    that pool and encoding on the calling thread.
+    """
+    def __init__(self, model_file: str = os.path.join(TOKENIZER_FOLDER, "tokenizer.json")):
+        super().__init__(model_file)
+        try:
+            import tokenizers
+        except ImportError as e:
+            raise ImportError(f"tokenizer.backend '{BACKEND_TOKENIZERS}' requires the tokenizers package: "
+                              f"pip install tokenizers") from e
+        self._tokenizer = tokenizers.Tokenizer.from_file(model_file)
+
+    def encode_batch(self, texts: list[str], num_threads: int) -> list[list[str]]:
+        return [e.tokens for e in self._encode_batch(texts, num_threads)]
+
+    def count_batch(self, texts: list[str], num_threads: int) -> list[int]:
+        return [len(e.ids) for e in self._encode_batch(texts, num_threads)]
+
+    def decode(self, tokens: list[str]) -> str:
+        return self._tokenizer.decode([self._tokenizer.token_to_id(t) for t in tokens], skip_special_tokens=False)
+
+    def _encode_batch(self, texts: list[str], num_threads: int):
+        if num_threads == 1:
+            return [self._tokenizer.encode(t, add_special_tokens=False) for t in texts]
+        return self._tokenizer.encode_batch(texts, add_special_tokens=False)
+
+
+TOKENIZER_BACKENDS = {
+    BACKEND_SENTENCEPIECE: SentencePieceTokenizer,
+    BACKEND_TOKENIZERS: FastTokenizer,
+}
 
 
 def get_token_count(text: str) -> int:
-    tokenized = sp.encode(text, out_type=str)
-    return len(tokenized)
+    return get_token_counts([text])[0]
+
+
+def get_token_counts(texts: list[str], num_threads: Optional[int] = None) -> list[int]:
+    """
+    Batched version of get_token_count. The whole list is handed to the tokenizer in one call, which splits the work
+    across num_threads. Counts are memoized by the token count cache (see the [tokenizer] settings).
+
+    :param texts:
+    :param num_threads: defaults to the tokenizer.num_threads setting; -1 uses every core.
+    :return: the token count of each text, in the same order as texts.
+    """
+    if len(texts) == 0:
+        return []
+    cache = get_token_count_cache()
+    keys = [cache.make_key(t) for t in texts]
+    counts = cache.get_many(keys)
+
+    # texts can repeat within a batch (e.g. blank lines), so only tokenize each missing text once.
+    missing = {}
+    for key, text, count in zip(keys, texts, counts):
+        if count is None:
+            missing[key] = text
+    if missing:
+        missing_counts = get_tokenizer().count_batch(list(missing.values()), _get_num_threads(num_threads))
+        new_counts = dict(zip(missing.keys(), missing_counts))
+        cache.put_many(new_counts)
+        counts = [new_counts[k] if c is None else c for k, c in zip(keys, counts)]
+    return counts
+
+
+def get_continued_token_counts(texts: list[str]) -> list[int]:
+    """
+    Token counts for texts that follow a newline in a larger document. The tokenizer prefixes the start of a text with
+    a space, but not text that comes after a newline, and newlines are always their own token. So the token count of
+    "\n".join(lines) is get_token_count(lines[0]) + the continued counts of the remaining lines + 1 per newline.
+
+    :param texts:
+    :return: the token count of each text, in the same order as texts.
+    """
+    newline_token_count = get_token_count("\n")
+    return [c - newline_token_count for c in get_token_counts(["\n" + t for t in texts])]
 
 
 def get_tokens(text: str) -> list[str]:
-    return sp.encode(text, out_type=str)
+    return get_tokens_batch([text])[0]
+
+
+def get_tokens_batch(texts: list[str], num_threads: Optional[int] = None) -> list[list[str]]:
+    """
+    Batched version of get_tokens; see get_token_counts. The token counts are added to the token count cache, since
+    callers usually want those next.
+    """
+    if len(texts) == 0:
+        return []
+    tokenized = get_tokenizer().encode_batch(texts, _get_num_threads(num_threads))
+    cache = get_token_count_cache()
+    cache.put_many({cache.make_key(text): len(tokens) for text, tokens in zip(texts, tokenized)})
+    return tokenized
 
 
 def decode_tokens(tokens: list[str]) -> str:
-    return sp.Decode(tokens)
+    return get_tokenizer().decode(tokens)
+
+
+def init_tokenizer(num_threads: Optional[int] = None):
+    """
+    Load the tokenizer up front, e.g. as the initializer of each worker process in a pool.
+
+    :param num_threads: overrides the tokenizer.num_threads setting for this process; worker processes should usually
+        use 1, since the pool is already using every core.
+    :return:
+    """
+    global _num_threads_override
+    _num_threads_override = num_threads
+    _set_thread_pool_size()
+    get_tokenizer()
+
+
+def get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    if _tokenizer is None:
+        backend = settings.get_setting('tokenizer.backend')
+        if backend not in TOKENIZER_BACKENDS:
+            raise ValueError(f"{backend} is unsupported for the setting tokenizer.backend")
+        _set_thread_pool_size()
+        _tokenizer = TOKENIZER_BACKENDS[backend]()
+    return _tokenizer
+
+
+def get_token_count_cache() -> TokenCountCache:
+    global _token_count_cache
+    if _token_count_cache is None:
+        cache_path = settings.get_setting('tokenizer.cache_path')
+        if cache_path:
+            cache_path = os.path.join(ROOT_FOLDER, cache_path)
+        _token_count_cache = TokenCountCache(get_tokenizer_id(),
+                                             settings.get_setting('tokenizer.cache_size'),
+                                             cache_path)
+        atexit.register(_token_count_cache.flush)
+    return _token_count_cache
+
+
+def get_tokenizer_id() -> str:
+    return get_tokenizer().get_id()
+
+
+def _get_num_threads(num_threads: Optional[int]) -> int:
+    if num_threads is None:
+        num_threads = _num_threads_override
+    if num_threads is None:
+        num_threads = settings.get_setting('tokenizer.num_threads')
+    return num_threads
+
+
+def _set_thread_pool_size():
+    # the tokenizers backend creates its thread pool on the first batch a process encodes, sized by RAYON_NUM_THREADS;
+    # a RAYON_NUM_THREADS that's already set (e.g. by the user) wins.
+    num_threads = _get_num_threads(None)
+    if num_threads > 0 and "RAYON_NUM_THREADS" not in os.environ:
+        os.environ["RAYON_NUM_THREADS"] = str(num_threads)
@@ -1,13 +1,17 @@
 import argparse
+import contextlib
 import os
 import tqdm
 import time
 import json
 import random
+from typing import Optional
 
-from library.batching_utils import get_subpaths_to_process, write_output_and_debug_files
+from library.batching_utils import ChunkInput, get_inputs_to_process, iter_in_thread_pool, \
+    write_output_and_debug_files
+from library.ai_requests import batched_requests, print_request_metrics, print_response_cache_stats
 from library.settings_manager import settings, ROOT_FOLDER
-from library.prompt_parser import sort_keys, get_full_text_from_prompt_dict, load_prompt_file
+from library.prompt_parser import sort_keys, get_full_text_from_prompt_dict
 from processors.analyze_writing import count_phrases, generate_prompts, finalize_count_phrases
 from processors.edit_writing import randomize_names
 
@@ -29,9 +33,9 @@ def sleep_for_x_hours(duration):
     print("Finished sleeping.")
 
 
-def process_prompts(in_folder: str, out_folder: str, mode: str):
+def process_prompts(in_folder: str, out_folder: str, mode: str, concurrency: int = 1):
     if mode == MODE_GENERATE_PROMPT:
-        batch_generate_prompts(in_folder, out_folder)
+        batch_generate_prompts(in_folder, out_folder, concurrency=concurrency)
     elif mode == MODE_COUNT_PHRASES:
         batch_count_phrases(in_folder, out_folder)
     elif mode == MODE_RANDOMIZE_NAMES:
@@ -40,46 +44,70 @@ def process_prompts(in_folder: str, out_folder: str, mode: str):
         raise ValueError(f"process_chunk got unexpected mode: {mode}")
 
 
-def batch_generate_prompts(in_folder: str, out_folder: str):
-    subpaths = get_subpaths_to_process(in_folder, out_folder)
+def batch_generate_prompts(in_folder: str, out_folder: str, concurrency: int = 1):
+    """
+    :param in_folder:
+    :param out_folder:
+    :param concurrency: the number of files to generate prompts for at once, i.e. the number of AI requests in flight.
+        Each file is written as soon as it's done, so files finish out of order when concurrency > 1.
+        Requests made at the same time are batched together (see ai_requests.batched_requests).
+    :return:
+    """
+    chunk_inputs = get_inputs_to_process(in_folder, out_folder)
+    jobs = (prepare_generate_prompts_job(chunk_input) for chunk_input in chunk_inputs)
+
+    with batched_requests(concurrency) if concurrency > 1 else contextlib.nullcontext():
+        for job, (new_values, debug_files) in tqdm.tqdm(iter_in_thread_pool(generate_prompts_job, jobs, concurrency),
+                                                        total=len(chunk_inputs)):
+            chunk_input, prompt_dict = job[0], job[1]
+            if new_values is None or len(new_values) == 0:
+                print(f"No data from AI request; skipping {chunk_input.key}")
+                continue
+            for k, v in new_values.items():
+                prompt_dict[k] = v
+
+            directory, filename = os.path.split(chunk_input.subpath)
+            result = json.dumps(sort_keys(prompt_dict), indent=4)
+            write_output_and_debug_files(os.path.join(out_folder, directory),
+                                         filename.replace(".txt", f".json"),
+                                         result,
+                                         debug_files)
+    print_request_metrics()
+    print_response_cache_stats()
+
+
+def prepare_generate_prompts_job(chunk_input: ChunkInput) -> tuple[ChunkInput, dict, str, Optional[str], bool]:
+    script_chunk, prompt_dict = chunk_input.load()
+    story = script_chunk
+    context = None
+    if prompt_dict:
+        story = get_full_text_from_prompt_dict(prompt_dict)
+    else:
+        prompt_dict = {}
 
-    for subpath in tqdm.tqdm(subpaths):
-        script_chunk, prompt_dict = load_prompt_file(os.path.join(in_folder, subpath))
-        story = script_chunk
-        context = None
-        if prompt_dict:
-            story = get_full_text_from_prompt_dict(prompt_dict)
-        else:
-            prompt_dict = {}
-
-        continuation = (random.random() < settings.get_setting("prompt_gen.continuation_likelyhood"))
-        if "story" in prompt_dict:
-            # if we're redoing part of a prompt, we want to preserve the existing split between context/story
-            continuation = False
-            story = prompt_dict["story"]
-            context = prompt_dict.get("context", None)
-
-        new_values, debug_files = generate_prompts(story, context=context, attempts=3, continuation=continuation)
-        if new_values is None or len(new_values) == 0:
-            print(f"No data from AI request; skipping {os.path.join(in_folder, subpath)}")
-            continue
-        for k, v in new_values.items():
-            prompt_dict[k] = v
-
-        directory, filename = os.path.split(subpath)
-        result = json.dumps(sort_keys(prompt_dict), indent=4)
-        write_output_and_debug_files(os.path.join(out_folder, directory),
-                                     filename.replace(".txt", f".json"),
-                                     result,
-                                     debug_files)
+    continuation = (random.random() < settings.get_setting("prompt_gen.continuation_likelyhood"))
+    if "story" in prompt_dict:
+        # if we're redoing part of a prompt, we want to preserve the existing split between context/story
+        continuation = False
+        story = prompt_dict["story"]
+        context = prompt_dict.get("context", None)
+    return chunk_input, prompt_dict, story, context, continuation
+
+
+def generate_prompts_job(chunk_input: ChunkInput, prompt_dict: dict, story: str, context: Optional[str],
+                         continuation: bool) -> tuple[Optional[dict], dict]:
+    return generate_prompts(story, context=context, attempts=3, continuation=continuation,
+                            parallel_attempts=settings.get_setting("prompt_gen.parallel_attempts"),
+                            best_of_seconds=settings.get_setting("prompt_gen.best_of_seconds"),
+                            validate_stream=settings.get_setting("prompt_gen.validate_stream"))
 
 
 def batch_count_phrases(in_folder: str, out_folder: str):
-    subpaths = get_subpaths_to_process(in_folder, out_folder)
+    chunk_inputs = get_inputs_to_process(in_folder, out_folder)
 
     count_dict = {}
-    for subpath in tqdm.tqdm(subpaths):
-        script_chunk, prompt_dict = load_prompt_file(os.path.join(in_folder, subpath))
+    for chunk_input in tqdm.tqdm(chunk_inputs):
+        script_chunk, prompt_dict = chunk_input.load()
         story = script_chunk
         if prompt_dict:
             story = get_full_text_from_prompt_dict(prompt_dict)
@@ -94,7 +122,7 @@ def batch_count_phrases(in_folder: str, out_folder: str):
 
 
 def batch_randomize_names(in_folder: str, out_folder: str):
-    subpaths = get_subpaths_to_process(in_folder, out_folder)
+    chunk_inputs = get_inputs_to_process(in_folder, out_folder)
 
     with open("library/names_female.json", "r", encoding='utf-8') as f:
         female_names = json.load(f)
@@ -102,9 +130,9 @@ def batch_randomize_names(in_folder: str, out_folder: str):
         male_names = json.load(f)
 
     replaced_names = {}
-    for subpath in tqdm.tqdm(subpaths):
-        full_path = os.path.join(in_folder, subpath)
-        script_chunk, prompt_dict = load_prompt_file(full_path)
+    for chunk_input in tqdm.tqdm(chunk_inputs):
+        full_path = chunk_input.key
+        script_chunk, prompt_dict = chunk_input.load()
 
         if not prompt_dict:
             raise ValueError(f"batch_randomize_names: expected prompt files to contain a json: {full_path}")
@@ -116,7 +144,7 @@ def batch_randomize_names(in_folder: str, out_folder: str):
         for k in all_replacements:
             replaced_names[k] = all_replacements[k]
 
-        directory, filename = os.path.split(subpath)
+        directory, filename = os.path.split(chunk_input.subpath)
         result = json.dumps(sort_keys(prompt_dict), indent=4)
         write_output_and_debug_files(os.path.join(out_folder, directory),
                                      filename.replace(".txt", f".json"),
@@ -143,13 +171,16 @@ Useful if the dataset has a bias towards particular names.
 python -m process_prompts --input_folder in --output_folder out --keys MODE_GENERATE_PROMPT""")
     parser.add_argument('--input_folder', type=str, required=True,
                         help='Input folder path. Should contain subfolders containing story chunks (.txt) or prompt'
-                             ' (.json) files.')
+                             ' (.json) files, and/or chunk shards (.chunks.jsonl, .chunks.parquet).')
     parser.add_argument('--output_folder', type=str, required=True,
                         help='Output folder path. Will be populated by a mirrored structure as the input folder, with '
                              'modified json files.')
     parser.add_argument('--mode', type=str, required=True,
                         help='Determines what processing to apply: MODE_GENERATE_PROMPT, MODE_COUNT_PHRASES, '
                              'MODE_RANDOMIZE_NAMES.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='MODE_GENERATE_PROMPT only. The number of AI requests to keep in flight; servers that '
+                             'batch requests (e.g. vLLM) are much faster with 8 or more.')
     args = parser.parse_args()
 
-    process_prompts(args.input_folder, args.output_folder, args.mode)
+    process_prompts(args.input_folder, args.output_folder, args.mode, args.concurrency)
@@ -1,17 +1,22 @@
+import concurrent.futures
 import json
 import re
 import os
-from typing import Union
+import threading
+import time
+from typing import Optional, Union
 
 from library.few_shot_request import few_shot_request
 from library.settings_manager import settings
-from library.ai_requests import EmptyResponseException
-from library.token_count import get_token_count
+from library.ai_requests import EmptyResponseException, StreamAbortedException
+from library.stream_validator import StreamValidator
+from library.token_count import get_token_count, get_token_counts
 from library.english_constants import indirect_person_words, lazy_contraction_mapping
 
 
 def generate_prompts(story, context=None, blacklist=[], continuation=False, attempts=1, context_length=2000,
-                     override_prompt_path=None) -> (Union[None, dict], dict):
+                     override_prompt_path=None, parallel_attempts=False, best_of_seconds=None, validate_stream=False) \
+        -> (Union[None, dict], dict):
     """
     :param story: The text to generate a prompt dictionary for.
     :param context: The text preceding the story, if any.
@@ -22,29 +27,19 @@ def generate_prompts(story, context=None, blacklist=[], continuation=False, atte
         length will win.
     :param override_prompt_path: The filepath for a few shot prompt to send to the AI. It should have a {story}
         template value.
+    :param parallel_attempts: If true, all the attempts are made at once rather than one after another; the first
+        valid result wins, and the other attempts are cancelled (a streamed response is closed part way through).
+    :param best_of_seconds: With parallel_attempts, keep collecting valid results for this many seconds (or until every
+        attempt is done) and choose between them by context_length, instead of taking the first valid result.
+    :param validate_stream: If true, a streamed response is checked as it arrives, and closed as soon as it's junk; the
+        junk output then records why (see StreamValidator).
     :return: A tuple where:
         The first element is None in the case of failure, or the result as a dict[str, str]
         The second element is a dict[str, str], intended to be debug outputs (filename -> content)
     """
 
     if continuation and context is None:
-        context_lines = []
-        generated_lines = []
-        all_lines = story.splitlines(keepends=False)
-
-        def token_count_lines(line_list):
-            return sum([get_token_count(l) for l in line_list])
-
-        front, back = 0, len(all_lines) - 1
-        for _ in range(len(all_lines)):
-            if token_count_lines(generated_lines) <= token_count_lines(context_lines):
-                generated_lines.insert(0, all_lines[back])
-                back -= 1
-            else:
-                context_lines.append(all_lines[front])
-                front += 1
-        context = "\n".join(context_lines)
-        story = "\n".join(generated_lines)
+        context, story = split_context_and_story(story)
 
     if context is None:
         context = "N/A"
@@ -53,17 +48,19 @@ def generate_prompts(story, context=None, blacklist=[], continuation=False, atte
     if not prompt_path:
         prompt_path = settings.get_setting('prompt_gen.prompt_file_path')
 
-    junk_outputs = []
-    full_outputs = []
-    for i in range(attempts):
+    def attempt(cancel_event: Optional[threading.Event] = None) -> tuple[dict, bool]:
+        validator = StreamValidator(blacklist) if validate_stream else None
+        is_junk = False
+        result_dict = {}
         try:
-            response_dict = few_shot_request(prompt_path,
-                                             {"story": story, "context": context})
+            response_dict = few_shot_request(prompt_path, {"story": story, "context": context}, cancel_event,
+                                             validator)
         except EmptyResponseException:
             response_dict = {}
+        except StreamAbortedException as e:
+            response_dict = {}
+            result_dict = {"abort reason": e.reason, "partial response": e.text}
 
-        is_junk = False
-        result_dict = {}
         if len(response_dict) == 0:
             is_junk = True
         else:
@@ -78,12 +75,20 @@ def generate_prompts(story, context=None, blacklist=[], continuation=False, atte
         if continuation:
             result_dict["context"] = context.strip()
         result_dict["story"] = story.strip()
+        return result_dict, is_junk or any([k for k in result_dict if result_dict[k] is None])
 
-        if is_junk or any([k for k in result_dict if result_dict[k] is None]):
-            junk_outputs.append(result_dict)
-        else:
-            full_outputs.append(result_dict)
-            break
+    junk_outputs = []
+    full_outputs = []
+    if parallel_attempts and attempts > 1:
+        run_parallel_attempts(attempt, attempts, best_of_seconds, junk_outputs, full_outputs)
+    else:
+        for i in range(attempts):
+            result_dict, is_junk = attempt()
+            if is_junk:
+                junk_outputs.append(result_dict)
+            else:
+                full_outputs.append(result_dict)
+                break
 
     best_length = 0
     best_result = None
@@ -104,6 +109,67 @@ def generate_prompts(story, context=None, blacklist=[], continuation=False, atte
     return best_result, junk_dict
 
 
+def run_parallel_attempts(attempt, attempts: int, best_of_seconds: Optional[float], junk_outputs: list[dict],
+                          full_outputs: list[dict]):
+    """
+    Run the attempts at once, until one of them is valid (or, with best_of_seconds, until best_of_seconds have passed
+    since the start and at least one is valid); then, the rest are cancelled.
+
+    :param attempt: called as attempt(cancel_event), returning (result_dict, is_junk).
+    :param attempts:
+    :param best_of_seconds:
+    :param junk_outputs: the junk results are appended to this.
+    :param full_outputs: the valid results are appended to this.
+    :return:
+    """
+    cancel_event = threading.Event()
+    collect_until = time.monotonic() + best_of_seconds if best_of_seconds else None
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=attempts)
+    try:
+        pending = {executor.submit(attempt, cancel_event) for _ in range(attempts)}
+        while pending:
+            timeout = None
+            if collect_until is not None and full_outputs:
+                timeout = max(0.0, collect_until - time.monotonic())
+            done, pending = concurrent.futures.wait(pending, timeout, concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result_dict, is_junk = future.result()
+                if is_junk:
+                    junk_outputs.append(result_dict)
+                else:
+                    full_outputs.append(result_dict)
+            if full_outputs and (collect_until is None or time.monotonic() >= collect_until):
+                break
+    finally:
+        cancel_event.set()
+        # the cancelled attempts finish in the background, raising RequestCancelledException.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def split_context_and_story(story: str) -> tuple[str, str]:
+    """
+    Split the story's lines into a 'context' and a 'story' with about the same token count.
+    While the story has no more tokens than the context, it takes the next line from the back; otherwise the context
+    takes the next line from the front. Runs in a single pass over the per-line token counts.
+
+    :param story:
+    :return: A tuple of (context, story).
+    """
+    all_lines = story.splitlines(keepends=False)
+    line_token_counts = get_token_counts(all_lines)
+
+    front, back = 0, len(all_lines)
+    context_token_count, story_token_count = 0, 0
+    while front < back:
+        if story_token_count <= context_token_count:
+            back -= 1
+            story_token_count += line_token_counts[back]
+        else:
+            context_token_count += line_token_counts[front]
+            front += 1
+    return "\n".join(all_lines[:front]), "\n".join(all_lines[back:])
+
+
 def count_phrases(story, story_counts, global_counts, count_state,
                   book_mode=False, book_prune_sentences=400, chunk_prune_chunks=20):
     CHUNKS_SINCE_PRUNE = "CHUNKS_SINCE_PRUNE"
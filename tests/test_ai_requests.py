@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+import requests
+
+from library import ai_requests, settings_manager
+from library.response_cache import ResponseCacheMissException
+
+
+class StreamingCompletionHandler(BaseHTTPRequestHandler):
+    """ Answers every completion request with the same two tokens (streamed, if requested), counting the connections it
+    sees. """
+    protocol_version = "HTTP/1.1"
+    connections = []
+    errors_to_send = []  # status codes to answer the next requests with, instead of a completion
+
+    def setup(self):
+        super().setup()
+        StreamingCompletionHandler.connections.append(self.client_address)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if StreamingCompletionHandler.errors_to_send:
+            self.send_response(StreamingCompletionHandler.errors_to_send.pop(0))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if request["stream"]:
+            body = "".join([f"data: {json.dumps({'choices': [{'text': t}]})}\n\n" for t in [">Prompt:", " hello"]])
+            content_type = "text/event-stream"
+        else:
+            body = json.dumps({'choices': [{'text': ">Prompt: hello"}]})
+            content_type = "application/json"
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def completion_server(tmp_path):
+    StreamingCompletionHandler.connections = []
+    StreamingCompletionHandler.errors_to_send = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StreamingCompletionHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def use_settings(keep_alive: bool = True, response_cache_mode: str = "off", output_mode: str = "echo",
+                     transcript_folder: str = ""):
+        settings_path = os.path.join(tmp_path, "test_settings.toml")
+        with open(settings_path, "w", encoding="utf-8") as f:
+            f.write(f"[ai_settings]\n"
+                    f"output_mode = '{output_mode}'\n"
+                    f"transcript_folder = '{transcript_folder}'\n"
+                    f"[oobabooga_api]\n"
+                    f"request_url = 'http://127.0.0.1:{server.server_address[1]}/v1/completions'\n"
+                    f"keep_alive = {str(keep_alive).lower()}\n"
+                    f"[rate_limit]\n"
+                    f"backoff_base = 0\n"
+                    f"[response_cache]\n"
+                    f"mode = '{response_cache_mode}'\n"
+                    f"path = {json.dumps(os.path.join(tmp_path, 'responses.sqlite'))}\n")
+        settings_manager.settings.override_settings(settings_path)
+        ai_requests.close_ooba_session()
+
+    with mock.patch.object(ai_requests, "ROOT_FOLDER", str(tmp_path)):
+        yield use_settings
+
+    settings_manager.settings.remove_override_settings()
+    ai_requests.close_ooba_session()
+    server.shutdown()
+    server.server_close()
+
+
+def test_ooba_requests_reuse_connections(completion_server):
+    completion_server(keep_alive=True)
+    for _ in range(3):
+        assert ai_requests.run_ai_request_ooba("prompt", print_prompt=False) == ">Prompt: hello"
+    assert len(StreamingCompletionHandler.connections) == 1
+
+
+def test_ooba_requests_without_keep_alive(completion_server):
+    completion_server(keep_alive=False)
+    for _ in range(3):
+        assert ai_requests.run_ai_request_ooba("prompt", print_prompt=False) == ">Prompt: hello"
+    assert len(StreamingCompletionHandler.connections) == 3
+
+
+def test_ooba_session_is_shared_between_threads(completion_server):
+    completion_server(keep_alive=True)
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(ai_requests.get_ooba_session())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set([id(s) for s in sessions])) == 1
+    adapter = sessions[0].get_adapter("http://127.0.0.1")
+    assert adapter._pool_maxsize == settings_manager.settings.get_setting("oobabooga_api.pool_size")
+    # retries are left to run_rate_limited, rather than multiplying its retries.
+    assert adapter.max_retries.total == 0
+
+
+def test_response_cache_skips_the_server(completion_server):
+    completion_server(response_cache_mode="read-write")
+    assert ai_requests.run_ai_request("prompt", print_prompt=False) == ">Prompt: hello"
+    assert len(StreamingCompletionHandler.connections) == 1
+
+    # a new run replays the cached response, without any requests to the server.
+    completion_server(response_cache_mode="replay-only")
+    assert ai_requests.run_ai_request("prompt", print_prompt=False) == ">Prompt: hello"
+    assert len(StreamingCompletionHandler.connections) == 1
+    assert ai_requests.get_response_cache().get_stats()["hits"] == 1
+    with pytest.raises(ResponseCacheMissException):
+        ai_requests.run_ai_request("another prompt", print_prompt=False)
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_ooba_request_output_modes(completion_server, capsys, stream):
+    completion_server(output_mode="echo")
+    assert ai_requests.run_ai_request_ooba("prompt", stream=stream) == ">Prompt: hello"
+    assert capsys.readouterr().out == "prompt>Prompt: hello\n"
+
+    completion_server(output_mode="progress")
+    assert ai_requests.run_ai_request_ooba("prompt", stream=stream) == ">Prompt: hello"
+    output = capsys.readouterr().out
+    assert "tokens/s" in output and "hello" not in output
+
+    completion_server(output_mode="silent")
+    assert ai_requests.run_ai_request_ooba("prompt", stream=stream) == ">Prompt: hello"
+    assert capsys.readouterr().out == ""
+
+
+def test_ooba_requests_write_separate_transcripts(completion_server, tmp_path):
+    completion_server(output_mode="silent", transcript_folder="transcripts")
+    for prompt in ["first prompt", "second prompt"]:
+        ai_requests.run_ai_request_ooba(prompt)
+    transcripts = []
+    for filename in os.listdir(os.path.join(tmp_path, "transcripts")):
+        with open(os.path.join(tmp_path, "transcripts", filename), "r", encoding="utf-8") as f:
+            transcripts.append(f.read())
+    assert sorted([t.split("\n")[0] for t in transcripts]) == ["first prompt", "second prompt"]
+    assert all([t.endswith(">Prompt: hello") for t in transcripts])
+
+
+def test_requests_are_retried(completion_server):
+    completion_server(output_mode="silent")
+    before = ai_requests.get_rate_limiter("oobabooga_api").get_metrics()
+    StreamingCompletionHandler.errors_to_send = [429, 503]
+    assert ai_requests.run_ai_request("prompt") == ">Prompt: hello"
+    metrics = ai_requests.get_rate_limiter("oobabooga_api").get_metrics()
+    assert metrics["retries"] - before["retries"] == 2
+    assert metrics["throttle_events"] - before["throttle_events"] == 1
+
+    StreamingCompletionHandler.errors_to_send = [400]
+    with pytest.raises(requests.HTTPError):
+        ai_requests.run_ai_request("prompt")
+
+
+class StubGeminiModel:
+    """ Stands in for google.generativeai.GenerativeModel, echoing prompts back after a delay. """
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+        self.requests = []
+
+    def generate_content(self, prompt, generation_config=None, safety_settings=None):
+        self.requests.append((prompt, generation_config, safety_settings))
+        return mock.Mock(text=f"response to {prompt}")
+
+    async def generate_content_async(self, prompt, generation_config=None, safety_settings=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if prompt == "fail":
+                await asyncio.sleep(0)
+                raise ValueError("failed")
+            await asyncio.sleep(self.delay)
+            return self.generate_content(prompt, generation_config, safety_settings)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+
+def test_gemini_client_is_reused():
+    client = ai_requests.get_gemini_client()
+    assert ai_requests.get_gemini_client() is client
+
+    client = ai_requests.GeminiClient("key", model=StubGeminiModel())
+    assert client.generate("a", ["\n\n"], temperature=.5, max_response=10) == "response to a"
+    assert client.generate("b", temperature=.2) == "response to b"
+    (_, first_config, first_safety), (_, second_config, second_safety) = client.model.requests
+    assert (first_config.stop_sequences, first_config.temperature, first_config.max_output_tokens) == (["\n\n"], .5, 10)
+    assert second_config.temperature == .2 and second_config.stop_sequences is None
+    assert first_safety is second_safety
+    assert client.generation_config.temperature is None
+
+
+def test_gemini_async_requests():
+    client = ai_requests.GeminiClient("key", model=StubGeminiModel(delay=.01))
+    prompts = [str(i) for i in range(10)]
+    responses = asyncio.run(ai_requests.run_ai_requests_gemini_pro_async(prompts, concurrency=3, client=client))
+    assert responses == [f"response to {p}" for p in prompts]
+    assert client.model.max_in_flight == 3
+
+
+def test_gemini_async_requests_are_cancelled():
+    client = ai_requests.GeminiClient("key", model=StubGeminiModel(delay=.05))
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(ai_requests.run_ai_requests_gemini_pro_async(["a"], timeout=.01, client=client))
+    assert client.model.cancelled == 1
+
+    # one request failing cancels the rest.
+    client = ai_requests.GeminiClient("key", model=StubGeminiModel(delay=.05))
+    with pytest.raises(ValueError):
+        asyncio.run(ai_requests.run_ai_requests_gemini_pro_async(["fail", "a", "b", "c"], concurrency=2, client=client))
+    assert client.model.cancelled >= 1 and client.model.in_flight == 0
+    assert len(client.model.requests) == 0
+
+
+class LoopBoundGeminiModel(StubGeminiModel):
+    """ Like google.generativeai's async client, which only works on the event loop it was first used on. """
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    async def generate_content_async(self, prompt, generation_config=None, safety_settings=None):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if asyncio.get_running_loop() is not self.loop:
+            raise RuntimeError("attached to a different loop")
+        return await super().generate_content_async(prompt, generation_config, safety_settings)
+
+
+def test_gemini_batches_share_an_event_loop(tmp_path):
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "w", encoding="utf-8") as f:
+        f.write("[ai_settings]\napi = 'gemini_pro'\n[response_cache]\nmode = 'off'\n")
+    settings_manager.settings.override_settings(settings_path)
+    client = ai_requests.GeminiClient("key", model=LoopBoundGeminiModel())
+    results = []
+    try:
+        with mock.patch.object(ai_requests, "get_gemini_client", return_value=client):
+            # each batch from a different thread, like the threads of a RequestBatcher.
+            for batch in [["a", "b"], ["c"], ["d", "e"]]:
+                thread = threading.Thread(target=lambda b=batch: results.append(ai_requests.run_ai_requests(b)))
+                thread.start()
+                thread.join()
+    finally:
+        settings_manager.settings.remove_override_settings()
+    assert results == [["response to a", "response to b"], ["response to c"], ["response to d", "response to e"]]
+
+
+class ResourceExhausted(Exception):
+    """ Like google.api_core's 429. """
+    code = 429
+
+
+def test_gemini_batches_are_rate_limited(tmp_path):
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "w", encoding="utf-8") as f:
+        f.write("[ai_settings]\napi = 'gemini_pro'\n[rate_limit]\nbackoff_base = 0\n[response_cache]\nmode = 'off'\n")
+    settings_manager.settings.override_settings(settings_path)
+    model = StubGeminiModel()
+    generate_content_async = model.generate_content_async
+    throttled = []
+
+    async def throttle_once(prompt, generation_config=None, safety_settings=None):
+        if prompt == "busy" and not throttled:
+            throttled.append(prompt)
+            raise ResourceExhausted("quota exceeded")
+        return await generate_content_async(prompt, generation_config, safety_settings)
+
+    model.generate_content_async = throttle_once
+    try:
+        with mock.patch.object(ai_requests, "get_gemini_client", return_value=ai_requests.GeminiClient("key", model)):
+            responses = ai_requests.run_ai_requests(["a", "busy", "fail"], return_exceptions=True)
+            with pytest.raises(ValueError):
+                ai_requests.run_ai_requests(["a", "fail"])
+        metrics = ai_requests.get_rate_limiter("gemini_pro").get_metrics()
+    finally:
+        settings_manager.settings.remove_override_settings()
+    assert responses[:2] == ["response to a", "response to busy"]
+    assert isinstance(responses[2], ValueError)
+    assert metrics["throttle_events"] == 1 and metrics["retries"] == 1
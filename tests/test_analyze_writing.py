@@ -0,0 +1,89 @@
+import threading
+import time
+from unittest import mock
+
+from library.ai_requests import RequestCancelledException
+from library.token_count import get_token_count
+from processors.analyze_writing import generate_prompts, split_context_and_story
+
+
+def split_context_and_story_reference(story):
+    # the original (quadratic) split, which recounted both halves after every line
+    context_lines = []
+    generated_lines = []
+    all_lines = story.splitlines(keepends=False)
+    front, back = 0, len(all_lines) - 1
+    for _ in range(len(all_lines)):
+        if sum([get_token_count(l) for l in generated_lines]) <= sum([get_token_count(l) for l in context_lines]):
+            generated_lines.insert(0, all_lines[back])
+            back -= 1
+        else:
+            context_lines.append(all_lines[front])
+            front += 1
+    return "\n".join(context_lines), "\n".join(generated_lines)
+
+
+def test_split_context_and_story_matches_reference():
+    with open("tests/books_to_chunks/in/the_bible.txt", "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    for length in [0, 1, 2, 3, 10, 25, len(lines)]:
+        story = "\n".join(lines[:length])
+        assert split_context_and_story(story) == split_context_and_story_reference(story)
+
+
+def test_split_context_and_story_favors_story():
+    context, story = split_context_and_story("apple\nbanana")
+    assert context == "apple"
+    assert story == "banana"
+
+    context, story = split_context_and_story("apple")
+    assert context == ""
+    assert story == "apple"
+
+
+def make_attempts(*attempts):
+    """
+    :param attempts: (seconds, response) for each call to few_shot_request, in order; a response of None waits until
+        the request is cancelled.
+    :return: a stand-in for few_shot_request, and a list that records each cancelled call.
+    """
+    lock = threading.Lock()
+    remaining = list(attempts)
+    cancelled = []
+
+    def run_few_shot_request(template_filepath, replacements, cancel_event=None, validator=None):
+        with lock:
+            seconds, response = remaining.pop(0)
+        if response is None:
+            assert cancel_event.wait(10)
+            cancelled.append(True)
+            raise RequestCancelledException("cancelled")
+        time.sleep(seconds)
+        return response
+    return run_few_shot_request, cancelled
+
+
+def test_generate_prompts_parallel_attempts_first_valid_wins():
+    few_shot_request, cancelled = make_attempts((0, {"prompt": "-"}), (.1, {"prompt": "a scene"}), (0, None))
+    with mock.patch("processors.analyze_writing.few_shot_request", few_shot_request):
+        start = time.perf_counter()
+        result, junk = generate_prompts("a story", attempts=3, parallel_attempts=True)
+        assert time.perf_counter() - start < 5
+    assert result == {"prompt": "a scene", "story": "a story"}
+    assert list(junk) == ["junk_prompt#0"]
+    for _ in range(100):
+        if cancelled:
+            break
+        time.sleep(.01)
+    assert cancelled == [True]
+
+
+def test_generate_prompts_parallel_attempts_best_of_seconds():
+    short, long = {"prompt": "a scene"}, {"prompt": "a much longer scene " * 20}
+    few_shot_request, cancelled = make_attempts((0, short), (.2, long), (0, None))
+    with mock.patch("processors.analyze_writing.few_shot_request", few_shot_request):
+        result, junk = generate_prompts("a story", attempts=3, context_length=100, parallel_attempts=True,
+                                        best_of_seconds=1)
+    # both valid results arrived before the deadline, and the longer one is closer to context_length.
+    assert result["prompt"] == long["prompt"]
+    assert junk == {}
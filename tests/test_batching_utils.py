@@ -0,0 +1,39 @@
+import os
+
+from library.batching_utils import ShardWriter, get_inputs_to_process, get_shard_path, list_inputs
+
+
+def test_list_inputs_mixes_folders_and_shards(tmp_path):
+    in_folder = os.path.join(tmp_path, "in")
+    os.makedirs(os.path.join(in_folder, "book_a"))
+    with open(os.path.join(in_folder, "book_a", "chunk_1.txt"), "w", encoding="utf-8") as f:
+        f.write("a1")
+    with open(os.path.join(in_folder, "book_a", "chunk_2.json"), "w", encoding="utf-8") as f:
+        f.write('{"story": "a2"}')
+    with ShardWriter(get_shard_path(in_folder, "book_b", "jsonl"), "jsonl") as shard:
+        shard.write("book_b", 1, "b1", 2)
+        shard.write("book_b", 2, "b2", 2)
+    with ShardWriter(get_shard_path(in_folder, "empty", "jsonl"), "jsonl"):
+        pass
+
+    inputs = list_inputs(in_folder)
+    assert [i.subpath for i in inputs] == [os.path.join("book_a", "chunk_1.txt"), os.path.join("book_a", "chunk_2.json"),
+                                           os.path.join("book_b", "chunk_1.txt"), os.path.join("book_b", "chunk_2.txt")]
+    assert [i.load() for i in inputs] == [("a1", None), ('{"story": "a2"}', {"story": "a2"}), ("b1", None),
+                                          ("b2", None)]
+    assert len(set([i.key for i in inputs])) == len(inputs)
+    # listing doesn't keep the chunks' texts; they're read from the shard when they're loaded.
+    assert "b1" not in repr(inputs)
+    # the extensions apply to the chunks' .txt subpaths too.
+    assert [i.subpath for i in list_inputs(in_folder, extensions=(".json",))] == \
+           [os.path.join("book_a", "chunk_2.json")]
+    assert len(list_inputs(in_folder, extensions=(".txt",))) == 3
+
+    # inputs that already have an output are skipped, whether they came from a file or a shard.
+    out_folder = os.path.join(tmp_path, "out")
+    for subpath in [os.path.join("book_a", "chunk_1.json"), os.path.join("book_b", "chunk_2.json")]:
+        os.makedirs(os.path.dirname(os.path.join(out_folder, subpath)), exist_ok=True)
+        with open(os.path.join(out_folder, subpath), "w", encoding="utf-8") as f:
+            f.write("{}")
+    assert [i.subpath for i in get_inputs_to_process(in_folder, out_folder)] == \
+           [os.path.join("book_a", "chunk_2.json"), os.path.join("book_b", "chunk_1.txt")]
@@ -1,6 +1,12 @@
-from extractors.books_to_chunks import books_to_chunks
+from extractors import books_to_chunks as books_to_chunks_module
+from extractors.books_to_chunks import books_to_chunks, apply_token_cap_to_paragraphs, split_tokens
+from library.batching_utils import list_inputs, read_shard
+from library.token_count import get_tokens, get_token_count
 from tests import folder_utils
 import os
+import pytest
+import shutil
+from unittest import mock
 
 
 def test_books_to_chunks_basic():
@@ -58,3 +64,109 @@ def test_books_to_chunks_long_paragraph_exclude():
     books_to_chunks(in_folder, out_folder, 200, exclude_if_too_long=True)
     folder_utils.compare_folders(os.path.join(out_folder, "the_bible"), os.path.join(expected_folder, "the_bible"))
     folder_utils.reset_test_folder(out_folder)
+
+
+def test_books_to_chunks_streaming(tmp_path):
+    for test_folder, max_tokens in [("books_to_chunks", 200), ("books_to_chunks2", 300)]:
+        in_folder = os.path.join("tests", test_folder, "in")
+        out_folder = os.path.join(tmp_path, test_folder)
+        expected_folder = os.path.join("tests", test_folder, "expected")
+
+        books_to_chunks(in_folder, out_folder, max_tokens, streaming=True)
+
+        folder_utils.compare_folders(os.path.join(out_folder, "the_bible"),
+                                     os.path.join(expected_folder, "the_bible"))
+
+
+def test_books_to_chunks_workers(tmp_path):
+    in_folder = os.path.join(tmp_path, "in")
+    os.makedirs(in_folder)
+    for test_folder in ["books_to_chunks", "books_to_chunks2"]:
+        shutil.copy(os.path.join("tests", test_folder, "in", "the_bible.txt"),
+                    os.path.join(in_folder, f"{test_folder}.txt"))
+
+    books_to_chunks(in_folder, os.path.join(tmp_path, "out1"), 300, workers=1)
+    books_to_chunks(in_folder, os.path.join(tmp_path, "out2"), 300, workers=2)
+
+    for test_folder in ["books_to_chunks", "books_to_chunks2"]:
+        folder_utils.compare_folders(os.path.join(tmp_path, "out1", test_folder),
+                                     os.path.join(tmp_path, "out2", test_folder))
+
+
+def test_apply_token_cap_to_paragraphs():
+    with open(os.path.join("tests", "books_to_chunks2", "in", "the_bible.txt"), "r", encoding="utf-8") as f:
+        paragraphs = [p for p in f.read().split("\n") if p]
+
+    # 199 tokens is the length where the paragraph's remainder used to run past the end of its tokens
+    for max_tokens in [50, 199, 299]:
+        result = apply_token_cap_to_paragraphs(paragraphs, False, max_tokens)
+        assert len(result) > len(paragraphs)
+        for paragraph in result:
+            assert paragraph.tokens == get_tokens(paragraph.text)
+            assert paragraph.token_count == get_token_count(paragraph.text)
+            assert paragraph.token_count <= max_tokens
+
+    assert apply_token_cap_to_paragraphs(paragraphs, True, 50) == []
+
+
+def test_split_tokens_without_boundaries():
+    tokens = ["a", "b", "c", "d", "e", "f", "g"]
+    assert split_tokens(tokens, 4) == [["a", "b", "c"], ["d", "e", "f"], ["g"]]
+    assert split_tokens(["▁The", "▁car", "▁sk", "id", "ded", "."], 4) == [["▁The", "▁car"], ["▁sk", "id", "ded", "."]]
+
+
+def test_books_to_chunks_incremental(tmp_path):
+    in_folder = os.path.join(tmp_path, "in")
+    out_folder = os.path.join(tmp_path, "out")
+    os.makedirs(in_folder)
+    for test_folder in ["books_to_chunks", "books_to_chunks2", "books_to_chunks3"]:
+        shutil.copy(os.path.join("tests", test_folder, "in", "the_bible.txt"),
+                    os.path.join(in_folder, f"{test_folder}.txt"))
+
+    def run(max_tokens: int) -> list[str]:
+        job = books_to_chunks_module.break_text_into_chunks_job
+        with mock.patch.object(books_to_chunks_module, "break_text_into_chunks_job", side_effect=job) as mocked:
+            books_to_chunks(in_folder, out_folder, max_tokens)
+        return [os.path.basename(c.args[0]) for c in mocked.call_args_list]
+
+    assert run(300) == ["books_to_chunks.txt", "books_to_chunks2.txt", "books_to_chunks3.txt"]
+    assert run(300) == []
+
+    # a changed book is rebuilt from scratch, so chunks from the old version don't linger.
+    shutil.copy(os.path.join("tests", "books_to_chunks", "in", "the_bible.txt"),
+                os.path.join(in_folder, "books_to_chunks2.txt"))
+    assert run(300) == ["books_to_chunks2.txt"]
+    folder_utils.compare_folders(os.path.join(out_folder, "books_to_chunks2"),
+                                 os.path.join(out_folder, "books_to_chunks"))
+
+    os.remove(os.path.join(in_folder, "books_to_chunks3.txt"))
+    assert run(300) == []
+    assert not os.path.exists(os.path.join(out_folder, "books_to_chunks3"))
+
+    assert run(200) == ["books_to_chunks.txt", "books_to_chunks2.txt"]
+    folder_utils.compare_folders(os.path.join(out_folder, "books_to_chunks"),
+                                 os.path.join("tests", "books_to_chunks", "expected", "the_bible"))
+
+
+@pytest.mark.parametrize("shard_format", ["jsonl", "parquet"])
+def test_books_to_chunks_shards(tmp_path, shard_format):
+    if shard_format == "parquet":
+        pytest.importorskip("pyarrow")
+    in_folder = os.path.join("tests", "books_to_chunks", "in")
+    expected_folder = os.path.join("tests", "books_to_chunks", "expected")
+    out_folder = os.path.join(tmp_path, "out")
+
+    books_to_chunks(in_folder, out_folder, 200, shard_format=shard_format)
+
+    assert sorted(os.listdir(out_folder)) == ["chunks_manifest.json", f"the_bible.chunks.{shard_format}"]
+    records = read_shard(os.path.join(out_folder, f"the_bible.chunks.{shard_format}"))
+    assert [r["chunk_index"] for r in records] == list(range(1, len(os.listdir(expected_folder + "/the_bible")) + 1))
+    for record in records:
+        assert record["source"] == "the_bible"
+        assert record["text"] == folder_utils.read_file(expected_folder, f"the_bible/chunk_{record['chunk_index']}.txt")
+        # added up from the paragraphs, rather than counted again.
+        assert 0 <= record["token_count"] - get_token_count(record["text"]) <= record["text"].count("\n")
+
+    # the shard is read back the same way as the folder of chunks.
+    assert [(i.subpath, i.read_text()) for i in list_inputs(out_folder)] == \
+           [(i.subpath, i.read_text()) for i in list_inputs(expected_folder)]
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from library.endpoint_pool import Endpoint, EndpointPool
+
+
+def test_endpoint_pool_prefers_least_outstanding_by_weight():
+    pool = EndpointPool([Endpoint("a", weight=2), Endpoint("b", weight=1)])
+    acquired = [pool.acquire() for _ in range(6)]
+    assert [e.url for e in acquired].count("a") == 4
+    for endpoint in acquired:
+        pool.release(endpoint, healthy=True)
+
+    # sequential requests are spread by weight too.
+    urls = []
+    for _ in range(30):
+        endpoint = pool.acquire()
+        urls.append(endpoint.url)
+        pool.release(endpoint, healthy=True)
+    assert urls.count("a") == 20
+
+
+def test_endpoint_pool_respects_max_concurrency():
+    pool = EndpointPool([Endpoint("a", max_concurrency=1), Endpoint("b", max_concurrency=1)])
+    first, second = pool.acquire(), pool.acquire()
+    assert {first.url, second.url} == {"a", "b"}
+
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    thread.start()
+    time.sleep(.05)
+    assert acquired == []
+    pool.release(second, healthy=True)
+    thread.join()
+    assert acquired == [second]
+
+
+def test_endpoint_pool_ejects_failing_endpoints():
+    pool = EndpointPool([Endpoint("a"), Endpoint("b")], failures_to_eject=2, ejection_seconds=.1)
+    for _ in range(2):
+        endpoint = pool.acquire()
+        assert endpoint.url == "a"
+        pool.release(endpoint, healthy=False)
+        other = pool.acquire()
+        assert other.url == "b"
+        pool.release(other, healthy=True)
+    assert pool.get_stats()["a"]["ejected"]
+    assert {pool.acquire().url for _ in range(3)} == {"b"}
+
+    # once the ejection is over, a single request checks the endpoint's health.
+    time.sleep(.1)
+    probe = pool.acquire()
+    assert probe.url == "a"
+    assert pool.acquire().url == "b"
+    pool.release(probe, healthy=True)
+    assert pool.acquire().url == "a"
+    stats = pool.get_stats()
+    assert (stats["a"]["requests"], stats["a"]["failures"], stats["a"]["ejections"]) == (4, 2, 1)
+
+
+def test_endpoint_pool_waits_for_an_ejected_endpoint():
+    pool = EndpointPool([Endpoint("a")], failures_to_eject=1, ejection_seconds=.1)
+    pool.release(pool.acquire(), healthy=False)
+    start = time.monotonic()
+    assert pool.acquire().url == "a"
+    assert time.monotonic() - start >= .09
+
+
+def test_endpoint_pool_skips_excluded_endpoints():
+    pool = EndpointPool([Endpoint("a"), Endpoint("b")])
+    assert {pool.acquire(exclude={"a"}).url for _ in range(3)} == {"b"}
+    with pytest.raises(ValueError):
+        pool.acquire(exclude={"a", "b"})
+
+
+def test_endpoint_weight_should_be_positive():
+    with pytest.raises(ValueError):
+        Endpoint("a", weight=0)
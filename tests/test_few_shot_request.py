@@ -1,6 +1,11 @@
+import os
+import shutil
 from unittest import mock
 
-from library.few_shot_request import edit_few_shot_request, parse_few_shot_format, few_shot_request
+import pytest
+
+from library.few_shot_request import edit_few_shot_request, parse_few_shot_format, few_shot_request, \
+    get_few_shot_template, FewShotTemplate
 
 
 def test_parse_few_shot_format_single_entry():
@@ -130,6 +135,61 @@ blah"""
         custom_stopping_strings=["\n>Name:", "Name:"],
         temperature=0.7,
         max_response=600,
-        ban_eos_token=True)
+        ban_eos_token=True,
+        cancel_event=None,
+        validator=None)
 
     assert result == {"Taste": "Dirty", "Location": "Earth"}
+
+
+@pytest.mark.parametrize("template_filepath, field", [("tests/few_shot_request_data/test_request.txt", "name"),
+                                                      ("processors/few_shot_templates/full_prompt.txt", "story")])
+def test_few_shot_template_render(template_filepath, field):
+    with open(template_filepath, 'r', encoding='utf-8') as file:
+        template_text = file.read()
+    if template_text.endswith("\n"):
+        template_text = template_text[:-1]
+    template = get_few_shot_template(template_filepath)
+    remove_keys = template.params.get("remove_keys_from_prompt", [])
+
+    # the same as formatting the whole template, then removing keys from the request.
+    replacements = {field: "It was a dark night.", "context": "unused"}
+    expected = template_text.format_map(replacements)
+    if remove_keys:
+        expected = edit_few_shot_request(expected, remove_keys)
+    assert template.render(replacements) == expected
+    assert template.prefix == expected[:expected.index("It was a dark night.")]
+
+    # the keys are removed from the template, rather than the request, so the value isn't edited.
+    value = "It was a dark night.\n\n>Junk1: not a key\n{name}"
+    assert value in template.render({field: value})
+    with pytest.raises(KeyError):
+        template.render({})
+
+
+def test_few_shot_template_prefix_with_escaped_braces(tmp_path):
+    template_filepath = os.path.join(tmp_path, "template.txt")
+    with open(template_filepath, "w", encoding="utf-8") as f:
+        f.write("Reply in JSON: {{\"key\": \"value\"}}\n{story}\n{{end}}\n")
+    with open(template_filepath.replace(".txt", ".params.json"), "w", encoding="utf-8") as f:
+        f.write("{}")
+    template = FewShotTemplate(template_filepath)
+    assert template.prefix == 'Reply in JSON: {"key": "value"}\n'
+    assert template.render({"story": "story"}) == 'Reply in JSON: {"key": "value"}\nstory\n{end}'
+
+
+def test_few_shot_template_is_cached_until_its_files_change(tmp_path):
+    template_filepath = os.path.join(tmp_path, "template.txt")
+    shutil.copy("tests/few_shot_request_data/test_request.txt", template_filepath)
+    shutil.copy("tests/few_shot_request_data/test_request.params.json", os.path.join(tmp_path, "template.params.json"))
+
+    template = get_few_shot_template(template_filepath)
+    assert get_few_shot_template(template_filepath) is template
+    assert template.response_keys == ["Taste", "Location", "Excess2"]
+
+    with open(template_filepath, 'a', encoding='utf-8') as file:
+        file.write("\n>Taste: {taste}")
+    new_template = get_few_shot_template(template_filepath)
+    assert new_template is not template
+    assert new_template.render({"name": "Steve", "taste": "Sweet"}).endswith(">Taste: Sweet")
+    assert get_few_shot_template(template_filepath) is new_template
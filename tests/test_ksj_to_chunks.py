@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+from unittest import mock
+
+from extractors import ksj_to_chunks
+from library import token_count
+from library.batching_utils import get_inputs_to_process, list_inputs, read_shard
+from library.token_count import get_token_count
+from tests import folder_utils
+
+
+def test_ksj_folder_to_chunks(tmp_path):
+    in_folder = "tests/ksj_to_chunks/in"
+    out_folder = os.path.join(tmp_path, "out")
+    expected_folder = "tests/ksj_to_chunks/expected"
+    locations_path = os.path.join(tmp_path, "ksj_locations.json")
+    names_path = os.path.join(tmp_path, "ksj_names.json")
+    with open(locations_path, "w", encoding="utf-8") as f:
+        json.dump({";◇◇◇：教室／昼": "INT. CLASSROOM - DAY", ";◇◇◇：屋上／夕": "EXT. ROOFTOP - EVENING"}, f)
+
+    with mock.patch.object(ksj_to_chunks, "VN_LOCATIONS", locations_path), \
+            mock.patch.object(ksj_to_chunks, "VN_NAMES", names_path), \
+            mock.patch.object(token_count, "get_token_counts", wraps=token_count.get_token_counts) as get_token_counts:
+        ksj_to_chunks.ksj_folder_to_chunks(in_folder, out_folder, 60)
+
+    folder_utils.compare_folders(os.path.join(out_folder, "roleplay"), os.path.join(expected_folder, "roleplay"))
+    expected_chunks = sorted([f for f in os.listdir(expected_folder) if f.endswith(".txt")])
+    # the script is tokenized once, a line at a time; then only the start (location and first line) of each chunk,
+    # and the newline that get_continued_token_counts subtracts.
+    chunk_count = len(expected_chunks) + len(os.listdir(os.path.join(expected_folder, "roleplay")))
+    batch_sizes = [len(c.args[0]) for c in get_token_counts.call_args_list]
+    assert sum(batch_sizes) - max(batch_sizes) <= 2 * chunk_count + 1
+    assert sorted([f for f in os.listdir(out_folder) if f.endswith(".txt")]) == expected_chunks
+    for filename in expected_chunks:
+        assert folder_utils.read_file(out_folder, filename) == folder_utils.read_file(expected_folder, filename)
+
+    with open(names_path, "r", encoding="utf-8") as f:
+        assert json.load(f) == {"Sensei": "Sensei", "Taro": "Taro", "Yuki": "Yuki"}
+
+
+def test_ksj_folder_to_chunks_incremental(tmp_path):
+    in_folder = os.path.join(tmp_path, "in")
+    out_folder = os.path.join(tmp_path, "out")
+    os.makedirs(in_folder)
+    shutil.copy("tests/ksj_to_chunks/in/test_script.ks", os.path.join(in_folder, "a.ks"))
+    shutil.copy("tests/ksj_to_chunks/in/test_script.ks", os.path.join(in_folder, "b.ks"))
+
+    def run(max_tokens: int) -> list[str]:
+        convert = ksj_to_chunks.convert_ksj_script
+        with mock.patch.object(ksj_to_chunks, "VN_LOCATIONS", os.path.join(tmp_path, "ksj_locations.json")), \
+                mock.patch.object(ksj_to_chunks, "VN_NAMES", os.path.join(tmp_path, "ksj_names.json")), \
+                mock.patch.object(ksj_to_chunks, "convert_ksj_script", side_effect=convert) as mocked:
+            ksj_to_chunks.ksj_folder_to_chunks(in_folder, out_folder, max_tokens)
+        return [c.args[1] for c in mocked.call_args_list]
+
+    def list_chunks() -> list[str]:
+        return sorted([f for f in os.listdir(out_folder) if f.endswith(".txt")] +
+                      os.listdir(os.path.join(out_folder, "roleplay")))
+
+    assert run(60) == ["a.ks", "b.ks"]
+    chunks = list_chunks()
+    assert run(60) == []
+    assert list_chunks() == chunks
+
+    # a larger max_tokens produces fewer chunks, and the extra chunks from the previous run are removed.
+    assert run(250) == ["a.ks", "b.ks"]
+    assert len(list_chunks()) < len(chunks)
+
+    os.remove(os.path.join(in_folder, "b.ks"))
+    assert run(250) == []
+    assert len(list_chunks()) > 0
+    assert not [f for f in list_chunks() if f.startswith("b_")]
+
+
+def test_ksj_folder_to_chunks_shards(tmp_path):
+    out_folder = os.path.join(tmp_path, "out")
+    expected_folder = "tests/ksj_to_chunks/expected"
+    locations_path = os.path.join(tmp_path, "ksj_locations.json")
+    with open(locations_path, "w", encoding="utf-8") as f:
+        json.dump({";◇◇◇：教室／昼": "INT. CLASSROOM - DAY", ";◇◇◇：屋上／夕": "EXT. ROOFTOP - EVENING"}, f)
+
+    with mock.patch.object(ksj_to_chunks, "VN_LOCATIONS", locations_path), \
+            mock.patch.object(ksj_to_chunks, "VN_NAMES", os.path.join(tmp_path, "ksj_names.json")):
+        ksj_to_chunks.ksj_folder_to_chunks("tests/ksj_to_chunks/in", out_folder, 60, shard_format="jsonl")
+
+    for folder in [out_folder, os.path.join(out_folder, "roleplay")]:
+        expected = os.path.join(expected_folder, os.path.relpath(folder, out_folder))
+        expected_chunks = sorted([f for f in os.listdir(expected) if f.endswith(".txt")])
+        records = read_shard(os.path.join(folder, "test_script.chunks.jsonl"))
+        assert sorted([f"{r['source']}_chunk_{r['chunk_index']}.txt" for r in records]) == expected_chunks
+        for record in records:
+            filename = f"test_script_chunk_{record['chunk_index']}.txt"
+            assert record["text"] == folder_utils.read_file(expected, filename)
+            assert 0 <= record["token_count"] - get_token_count(record["text"]) <= record["text"].count("\n")
+
+
+def test_ksj_folder_to_chunks_shards_are_listed_like_files(tmp_path):
+    locations_path = os.path.join(tmp_path, "ksj_locations.json")
+    with open(locations_path, "w", encoding="utf-8") as f:
+        json.dump({";◇◇◇：教室／昼": "INT. CLASSROOM - DAY", ";◇◇◇：屋上／夕": "EXT. ROOFTOP - EVENING"}, f)
+    with mock.patch.object(ksj_to_chunks, "VN_LOCATIONS", locations_path), \
+            mock.patch.object(ksj_to_chunks, "VN_NAMES", os.path.join(tmp_path, "ksj_names.json")):
+        ksj_to_chunks.ksj_folder_to_chunks("tests/ksj_to_chunks/in", os.path.join(tmp_path, "files", "vn"), 60)
+        ksj_to_chunks.ksj_folder_to_chunks("tests/ksj_to_chunks/in", os.path.join(tmp_path, "shards", "vn"), 60,
+                                           shard_format="jsonl")
+
+    def read_inputs(in_folder: str) -> list[tuple[str, str]]:
+        return [(i.subpath, i.read_text()) for i in list_inputs(in_folder)]
+
+    # e.g. vn/test_script_chunk_0.txt
+    file_inputs = read_inputs(os.path.join(tmp_path, "files"))
+    assert len(file_inputs) > 0
+    assert read_inputs(os.path.join(tmp_path, "shards")) == file_inputs
+    # e.g. roleplay/test_script_chunk_2.txt
+    roleplay_inputs = read_inputs(os.path.join(tmp_path, "files", "vn"))
+    assert len(roleplay_inputs) > 0
+    assert [i for i in read_inputs(os.path.join(tmp_path, "shards", "vn")) if i[0].startswith("roleplay")] == \
+           roleplay_inputs
+
+    out_folder = os.path.join(tmp_path, "out")
+    os.makedirs(os.path.join(out_folder, "vn"))
+    with open(os.path.join(out_folder, file_inputs[0][0].replace(".txt", ".json")), "w", encoding="utf-8") as f:
+        f.write("{}")
+    assert [i.subpath for i in get_inputs_to_process(os.path.join(tmp_path, "shards"), out_folder)] == \
+           [subpath for subpath, _ in file_inputs[1:]]
+
+
+def test_ksj_folder_to_chunks_workers(tmp_path):
+    in_folder = os.path.join(tmp_path, "in")
+    os.makedirs(in_folder)
+    shutil.copy("tests/ksj_to_chunks/in/test_script.ks", os.path.join(in_folder, "a.ks"))
+    with open(os.path.join(in_folder, "b.ks"), "w", encoding="utf-16") as f:
+        f.write(';◇◇◇：廊下／夜\n@nm t="Hana" s=hana001\n"Is anyone there?"[np]\nThe hallway was empty.[np]\n'
+                ';◇◇◇：教室／昼\n@nm t="Taro" s=taro001\n"Over here."[np]\n')
+
+    registries = []
+    for workers in [1, 2]:
+        locations_path = os.path.join(tmp_path, f"ksj_locations_{workers}.json")
+        names_path = os.path.join(tmp_path, f"ksj_names_{workers}.json")
+        with open(locations_path, "w", encoding="utf-8") as f:
+            json.dump({";◇◇◇：教室／昼": "INT. CLASSROOM - DAY"}, f)
+        with mock.patch.object(ksj_to_chunks, "VN_LOCATIONS", locations_path), \
+                mock.patch.object(ksj_to_chunks, "VN_NAMES", names_path):
+            ksj_to_chunks.ksj_folder_to_chunks(in_folder, os.path.join(tmp_path, f"out{workers}"), 60,
+                                               workers=workers)
+        with open(locations_path, "r", encoding="utf-8") as f1, open(names_path, "r", encoding="utf-8") as f2:
+            registries.append((f1.read(), f2.read()))
+
+    folder_utils.compare_folders(os.path.join(tmp_path, "out1", "roleplay"), os.path.join(tmp_path, "out2", "roleplay"))
+    for filename in os.listdir(os.path.join(tmp_path, "out1")):
+        if filename.endswith(".txt"):
+            assert folder_utils.read_file(os.path.join(tmp_path, "out1"), filename) == \
+                   folder_utils.read_file(os.path.join(tmp_path, "out2"), filename)
+    assert registries[0] == registries[1]
+    locations, names = json.loads(registries[0][0]), json.loads(registries[0][1])
+    assert locations[";◇◇◇：教室／昼"] == "INT. CLASSROOM - DAY"
+    assert locations[";◇◇◇：廊下／夜"] == ";◇◇◇：廊下／夜"
+    assert names == {"Hana": "Hana", "Sensei": "Sensei", "Taro": "Taro", "Yuki": "Yuki"}
+    assert folder_utils.read_file(os.path.join(tmp_path, "out1"), "b_chunk_0.txt").startswith(";◇◇◇：廊下／夜\nHANA")
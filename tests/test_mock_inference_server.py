@@ -0,0 +1,323 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+from library import ai_requests, settings_manager
+from library.response_cache import ResponseCacheMissException
+from library.stream_validator import StreamValidator
+from process_prompts import batch_generate_prompts
+from processors.analyze_writing import generate_prompts
+from tools import benchmark_generate_prompts
+from tools.mock_inference_server import MockInferenceServer, DEFAULT_RESPONSES, split_into_tokens
+
+
+@pytest.fixture()
+def mock_server(tmp_path):
+    servers = []
+
+    def start(**kwargs) -> MockInferenceServer:
+        server = MockInferenceServer(("127.0.0.1", 0), **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        settings_path = os.path.join(tmp_path, "test_settings.toml")
+        with open(settings_path, "w", encoding="utf-8") as f:
+            f.write(f"[ai_settings]\n"
+                    f"output_mode = 'silent'\n"
+                    f"[oobabooga_api]\n"
+                    f"request_url = 'http://127.0.0.1:{server.server_address[1]}/v1/completions'\n")
+        settings_manager.settings.override_settings(settings_path)
+        ai_requests.close_ooba_session()
+        return server
+
+    yield start
+
+    settings_manager.settings.remove_override_settings()
+    ai_requests.close_ooba_session()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_mock_inference_server_responses(mock_server, stream):
+    server = mock_server(tokens_per_second=1000, time_to_first_token=.01)
+    for response in DEFAULT_RESPONSES:
+        assert ai_requests.run_ai_request_ooba("prompt", stream=stream) == response
+    assert ai_requests.run_ai_request_ooba("prompt", max_response=3, stream=stream) == ">Prompt: Write a"
+    assert server.stats["requests"] == 3
+
+
+def test_mock_inference_server_errors(mock_server):
+    server = mock_server(error_rate=1, error_status=429)
+    with pytest.raises(requests.HTTPError) as e:
+        ai_requests.run_ai_request_ooba("prompt")
+    assert e.value.response.status_code == 429
+    assert server.stats == {"requests": 1, "errors": 1, "prompts": 0, "tokens_sent": 0, "prompt_tokens": 0,
+                            "prompt_tokens_processed": 0, "disconnects": 0, "max_in_flight": 1}
+
+
+@pytest.mark.parametrize("cache_prompt", [True, False])
+def test_mock_inference_server_prompt_cache(mock_server, tmp_path, cache_prompt):
+    server = mock_server(prompt_cache_slots=1)
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "a", encoding="utf-8") as f:
+        f.write(f"cache_prompt = {str(cache_prompt).lower()}\n")
+    settings_manager.settings.override_settings(settings_path)
+    examples = "an example of the few shot template " * 10
+    for story in ["the first story", "the second story", "the first story"]:
+        ai_requests.run_ai_request_ooba(f"{examples}>Story: {story}", stream=False)
+    # 70 words of examples, then '>Story:', 'the' and the rest of the story.
+    assert server.stats["prompt_tokens"] == 3 * 74
+    if cache_prompt:
+        # the whole of the first prompt is processed; after that, only the words that differ from the previous prompt
+        # (the only cached prompt, so the third prompt can't reuse the first).
+        assert server.stats["prompt_tokens_processed"] == 74 + 2 + 2
+    else:
+        assert server.stats["prompt_tokens_processed"] == 3 * 74
+
+    stats_url = ai_requests.settings.get_setting('oobabooga_api.request_url').replace("/v1/completions", "/stats")
+    assert requests.get(stats_url).json() == server.stats
+
+
+def test_cancelled_stream_is_closed(mock_server):
+    server = mock_server(tokens_per_second=20)
+    cancel_event = threading.Event()
+    threading.Timer(.2, cancel_event.set).start()
+    start = time.perf_counter()
+    with pytest.raises(ai_requests.RequestCancelledException):
+        ai_requests.run_ai_request(DEFAULT_RESPONSES[0], stream=True, cancel_event=cancel_event)
+    # the whole response would take more than 4 seconds.
+    assert time.perf_counter() - start < 2
+    assert server.stats["requests"] == 1
+    # the server notices at its next token.
+    for _ in range(100):
+        if server.stats["disconnects"]:
+            break
+        time.sleep(.02)
+    assert server.stats["disconnects"] == 1
+    assert server.stats["tokens_sent"] < len(split_into_tokens(DEFAULT_RESPONSES[0])) / 2
+
+    with pytest.raises(ai_requests.RequestCancelledException):
+        ai_requests.run_ai_request("prompt", cancel_event=cancel_event)
+    assert server.stats["requests"] == 1
+
+
+
+def test_cancellable_requests_bypass_the_batcher(mock_server):
+    junk_response = DEFAULT_RESPONSES[0].replace(">Pacing: medium", ">Pacing: -")
+    server = mock_server(tokens_per_second=20, responses=[junk_response])
+    # a batch would wait for more prompts, then be sent as a single request that can't be cancelled or validated.
+    with ai_requests.batched_requests(concurrency=4, max_wait=5) as batcher:
+        cancel_event = threading.Event()
+        threading.Timer(.2, cancel_event.set).start()
+        start = time.perf_counter()
+        with pytest.raises(ai_requests.RequestCancelledException):
+            ai_requests.run_ai_request("prompt", stream=True, cancel_event=cancel_event)
+        with pytest.raises(ai_requests.StreamAbortedException):
+            ai_requests.run_ai_request("prompt", stream=True, validator=StreamValidator())
+        assert time.perf_counter() - start < 4
+    assert batcher.batch_sizes == []
+    assert server.stats["requests"] == 2
+
+
+def test_stopped_streams_are_not_cached(mock_server, tmp_path):
+    # the response runs on into a second entry, which the validator stops at.
+    mock_server(tokens_per_second=0, responses=[DEFAULT_RESPONSES[0] + "\n" + DEFAULT_RESPONSES[1]])
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, encoding="utf-8") as f:
+        server_settings = f.read()
+    for mode in ["read-write", "replay-only"]:
+        with open(settings_path, "w", encoding="utf-8") as f:
+            f.write(f"{server_settings}"
+                    f"[response_cache]\n"
+                    f"mode = '{mode}'\n"
+                    f"path = {json.dumps(os.path.join(tmp_path, 'responses.sqlite'))}\n")
+        settings_manager.settings.override_settings(settings_path)
+        if mode == "read-write":
+            result = ai_requests.run_ai_request("prompt", stream=True, validator=StreamValidator())
+            assert result.strip() == DEFAULT_RESPONSES[0]
+        else:
+            # a new run doesn't find the response that was cut short.
+            with pytest.raises(ResponseCacheMissException):
+                ai_requests.run_ai_request("prompt", stream=True, validator=StreamValidator())
+
+
+def test_cached_responses_survive_an_endpoint_change(mock_server, tmp_path):
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    servers = []
+    for mode in ["read-write", "replay-only"]:
+        # each server is on its own port, so the second run's requests go to a different url.
+        servers.append(mock_server())
+        with open(settings_path, "a", encoding="utf-8") as f:
+            f.write(f"[response_cache]\n"
+                    f"mode = '{mode}'\n"
+                    f"path = {json.dumps(os.path.join(tmp_path, 'responses.sqlite'))}\n")
+        settings_manager.settings.override_settings(settings_path)
+        assert ai_requests.run_ai_requests(["prompt"]) == [DEFAULT_RESPONSES[0]]
+    assert [s.stats["requests"] for s in servers] == [1, 0]
+
+
+def test_generate_prompts_aborts_junk_streams(mock_server):
+    junk_response = DEFAULT_RESPONSES[0].replace(">Pacing: medium", ">Pacing: -")
+    server = mock_server(tokens_per_second=500, responses=[junk_response, DEFAULT_RESPONSES[1]])
+    result, junk = generate_prompts("a story", attempts=2, validate_stream=True)
+    assert result["female characters"] == "unnamed woman"
+    junk_output = json.loads(junk["junk_prompt#0"])
+    assert junk_output["abort reason"] == "the value of 'Pacing' is too short: \"-\""
+    assert ">Pacing: -" in junk_output["partial response"]
+    assert "Point of View" not in junk_output["partial response"]
+    for _ in range(100):
+        if server.stats["disconnects"]:
+            break
+        time.sleep(.02)
+    assert server.stats["disconnects"] == 1
+
+
+@pytest.mark.parametrize("supports_batches", [True, False])
+def test_run_ai_requests_batches(mock_server, supports_batches):
+    server = mock_server(supports_batches=supports_batches)
+    prompts = [f"prompt {i}" for i in range(5)]
+    rate_limiter = ai_requests.get_rate_limiter("oobabooga_api")
+    rate_limited_requests = rate_limiter.get_metrics()["requests"]
+    responses = ai_requests.run_ai_requests(prompts, batch_size=3)
+    assert responses == [DEFAULT_RESPONSES[i % 2] for i in range(5)]
+    if supports_batches:
+        assert server.stats["requests"] == 2
+        assert rate_limiter.get_metrics()["requests"] - rate_limited_requests == 2
+    else:
+        # the first batch is rejected (before it's counted); after that, the server is only sent single prompts, and
+        # the second batch doesn't take a rate limiter slot of its own.
+        assert server.stats["requests"] == 5
+        assert rate_limiter.get_metrics()["requests"] - rate_limited_requests == 6
+    assert server.stats["prompts"] == 5
+
+
+
+def test_other_batch_errors_fall_back_without_giving_up_on_batches(mock_server):
+    server = mock_server(error_rate=1, error_status=422)
+    with pytest.raises(requests.HTTPError):
+        ai_requests.run_ai_requests(["a", "b"])
+    # the batch, then the first prompt on its own.
+    assert server.stats["errors"] == 2
+    assert settings_manager.settings.get_setting("oobabooga_api.request_url") not in ai_requests._batches_rejected_by
+    assert not ai_requests.is_prompt_list_rejection('{"error": "the prompt is too long"}')
+    assert ai_requests.is_prompt_list_rejection('{"detail": [{"loc": ["body", "prompt"], '
+                                                '"msg": "Input should be a valid string"}]}')
+
+
+@pytest.mark.parametrize("server_count", [1, 2])
+def test_batches_are_sent_concurrently(tmp_path, server_count):
+    servers = [MockInferenceServer(("127.0.0.1", 0), time_to_first_token=.1) for _ in range(server_count)]
+    # the requests in flight across every server.
+    in_flight = {"now": 0, "max": 0}
+    in_flight_lock = threading.Lock()
+
+    def record_in_flight(change: int):
+        with in_flight_lock:
+            in_flight["now"] += change
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+
+    for server in servers:
+        server.record_in_flight = record_in_flight
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoints = ", ".join([f"{{url = 'http://127.0.0.1:{s.server_address[1]}/v1/completions'}}" for s in servers])
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "w", encoding="utf-8") as f:
+        f.write(f"[ai_settings]\n"
+                f"output_mode = 'silent'\n"
+                f"[oobabooga_api]\n"
+                f"endpoints = [{endpoints}]\n"
+                f"batch_size = 8\n"
+                f"[prompt_gen]\n"
+                f"continuation_likelyhood = 0\n")
+    in_folder = os.path.join(tmp_path, "in")
+    benchmark_generate_prompts.make_chunk_tree(in_folder, files=32, words_per_file=50)
+    settings_manager.settings.override_settings(settings_path)
+    try:
+        batch_generate_prompts(in_folder, os.path.join(tmp_path, "out"), concurrency=16)
+    finally:
+        settings_manager.settings.remove_override_settings()
+        ai_requests.close_ooba_session()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    # the 16 prompts in flight are split into several batches that are sent at once (one per endpoint, or two batches of
+    # 8 for a single endpoint), rather than one batch of 16 that's sent 8 at a time.
+    assert sum([s.stats["prompts"] for s in servers]) == 32
+    assert in_flight["max"] >= 2
+    assert all([s.stats["requests"] > 0 for s in servers])
+
+def test_benchmark_generate_prompts():
+    results = benchmark_generate_prompts.run(files=4, words_per_file=50, concurrency_levels=[1, 2], stream=True,
+                                             server_args=["--tokens_per_second", "0"])
+    assert [r["concurrency"] for r in results] == [1, 2]
+    # with concurrency, requests are batched (how many depends on timing).
+    assert results[0]["requests"] == 4 and results[1]["requests"] <= 4
+    for r in results:
+        assert r["files"] == 4
+        assert r["files_per_second"] > 0 and r["p50"] <= r["p95"] <= r["p99"]
+    assert json.dumps(results)
+
+
+def test_benchmark_generate_prompts_cache_prompt():
+    results = benchmark_generate_prompts.run(files=3, words_per_file=50, concurrency_levels=[1], stream=False,
+                                             server_args=["--tokens_per_second", "0"],
+                                             cache_prompt_modes=[False, True])
+    assert [r["cache_prompt"] for r in results] == [False, True]
+    # the few shot template's examples are only processed for the first prompt.
+    assert results[1]["prompt_tokens_per_prompt"] < results[0]["prompt_tokens_per_prompt"] / 2
+
+
+def test_requests_are_balanced_across_endpoints(tmp_path):
+    servers = [MockInferenceServer(("127.0.0.1", 0)), MockInferenceServer(("127.0.0.1", 0), error_rate=1)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoints = ", ".join([f"{{url = 'http://127.0.0.1:{s.server_address[1]}/v1/completions', weight = 1}}"
+                           for s in servers])
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "w", encoding="utf-8") as f:
+        f.write(f"[ai_settings]\n"
+                f"output_mode = 'silent'\n"
+                f"[oobabooga_api]\n"
+                f"endpoints = [{endpoints}]\n"
+                f"endpoint_failures_to_eject = 2\n"
+                f"[rate_limit]\n"
+                f"backoff_base = 0\n")
+    settings_manager.settings.override_settings(settings_path)
+    try:
+        for _ in range(10):
+            assert ai_requests.run_ai_request("prompt") in DEFAULT_RESPONSES
+        stats = ai_requests.get_endpoint_pool().get_stats()
+    finally:
+        settings_manager.settings.remove_override_settings()
+        ai_requests.close_ooba_session()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    healthy_url, failing_url = [f"http://127.0.0.1:{s.server_address[1]}/v1/completions" for s in servers]
+    assert stats[healthy_url]["requests"] == 10 and stats[healthy_url]["failures"] == 0
+    assert stats[failing_url]["requests"] == 2 and stats[failing_url]["ejected"]
+    assert servers[1].stats["errors"] == 2
+
+
+def test_throttled_endpoints_are_not_ejected(mock_server, tmp_path):
+    server = mock_server(error_rate=1, error_status=429)
+    settings_path = os.path.join(tmp_path, "test_settings.toml")
+    with open(settings_path, "a", encoding="utf-8") as f:
+        f.write(f"endpoint_failures_to_eject = 1\n"
+                f"[rate_limit]\n"
+                f"max_retries = 2\n"
+                f"backoff_base = 0\n")
+    settings_manager.settings.override_settings(settings_path)
+    with pytest.raises(requests.HTTPError):
+        ai_requests.run_ai_request("prompt")
+    assert server.stats["errors"] == 3
+    url = settings_manager.settings.get_setting("oobabooga_api.request_url")
+    stats = ai_requests.get_endpoint_pool().get_stats()[url]
+    assert stats["failures"] == 0 and not stats["ejected"]
@@ -1,5 +1,6 @@
 import os
 import pytest
+import threading
 from unittest import mock
 
 from .. import process_prompts
@@ -47,6 +48,43 @@ def test_generate_prompts(mock_run_request, test_settings):
     folder_utils.reset_test_folder(out_folder)
 
 
+@mock.patch('library.few_shot_request.run_ai_request')
+def test_generate_prompts_concurrency(mock_run_request, tmp_path):
+    settings_manager.settings.override_settings(os.path.join("tests", "process_prompts_shared", "test_settings.toml"))
+    in_folder = os.path.join("tests", "process_prompts_generate", "in")
+    out_folder = os.path.join(tmp_path, "out")
+    expected_folder = os.path.join("tests", "process_prompts_generate", "expected")
+
+    response1 = """>Prompt: Write a scene where
+- The main character is a brave young woman named Liz who is travelling alone.
+- Liz encounters two men trying to rob her on a muddy street
+- She intimidates them into backing down without a fight
+>Male Characters: N/A
+>Female Characters: Liz"""
+    response2 = """>Prompt: Write a scene where
+- The main character is a lonely woman who sitting by the fire reading a book during a stormy night
+- the storm intensifies, causing the power to go out
+- she opens the window to feel the rain and wind
+- she tries to continue reading but can't concentrate due to the storm
+>Male Characters: N/A
+>Female Characters: unnamed woman"""
+    # both requests have to be in flight at the same time to get past the barrier.
+    barrier = threading.Barrier(2, timeout=10)
+
+    def run_request(prompt, **kwargs):
+        barrier.wait()
+        return response1 if "muddy street" in prompt else response2
+
+    mock_run_request.side_effect = run_request
+    try:
+        process_prompts.process_prompts(in_folder, out_folder, "MODE_GENERATE_PROMPT", concurrency=2)
+    finally:
+        settings_manager.settings.remove_override_settings()
+
+    assert mock_run_request.call_count == 2
+    folder_utils.compare_folders(os.path.join(out_folder, "garbage"), os.path.join(expected_folder, "garbage"))
+
+
 @mock.patch.object(process_prompts, 'randomize_names')
 def test_randomize_names(mock_randomize_names, test_settings):
     in_folder = r"tests\process_prompts_randomize\in"
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+from library.rate_limiter import RateLimiter, classify_error, run_with_retries, run_with_retries_async, OUTCOME_FAILED, \
+    OUTCOME_SUCCESS, OUTCOME_THROTTLED
+
+
+def http_error(status_code: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def test_classify_error():
+    assert classify_error(http_error(429)) == OUTCOME_THROTTLED
+    assert classify_error(requests.ReadTimeout()) == OUTCOME_THROTTLED
+    assert classify_error(http_error(503)) == OUTCOME_FAILED
+    assert classify_error(requests.ConnectionError()) == OUTCOME_FAILED
+    assert classify_error(http_error(400)) is None
+    assert classify_error(ValueError("prompt too long")) is None
+
+
+def test_adaptive_concurrency():
+    rate_limiter = RateLimiter(max_concurrency=8)
+    rate_limiter.release(rate_limiter.acquire(), OUTCOME_THROTTLED)
+    rate_limiter.release(rate_limiter.acquire(), OUTCOME_THROTTLED)
+    assert rate_limiter.concurrency_limit == 2
+    for _ in range(4):
+        rate_limiter.release(rate_limiter.acquire(), OUTCOME_SUCCESS)
+    assert 3 < rate_limiter.concurrency_limit < 4
+    for _ in range(100):
+        rate_limiter.release(rate_limiter.acquire(), OUTCOME_SUCCESS)
+    assert rate_limiter.concurrency_limit == 8
+
+
+def test_requests_per_minute():
+    rate_limiter = RateLimiter(requests_per_minute=2, window_seconds=.2)
+    start = time.monotonic()
+    for _ in range(3):
+        rate_limiter.release(rate_limiter.acquire(), OUTCOME_SUCCESS)
+    assert time.monotonic() - start >= .2
+    assert rate_limiter.get_metrics()["rate_limited_waits"] == 1
+
+
+def test_tokens_per_minute():
+    rate_limiter = RateLimiter(tokens_per_minute=100, window_seconds=.2)
+    start = time.monotonic()
+    rate_limiter.release(rate_limiter.acquire(1000), OUTCOME_SUCCESS, tokens=60)  # bigger than the budget on its own
+    rate_limiter.release(rate_limiter.acquire(40), OUTCOME_SUCCESS)
+    assert time.monotonic() - start < .2
+    rate_limiter.release(rate_limiter.acquire(10), OUTCOME_SUCCESS)
+    assert time.monotonic() - start >= .2
+
+
+def test_run_with_retries():
+    rate_limiter = RateLimiter()
+    request = mock.Mock(side_effect=[requests.ConnectionError(), http_error(429), "response"])
+    assert run_with_retries(request, rate_limiter, backoff_base=0) == "response"
+    assert request.call_count == 3
+    metrics = rate_limiter.get_metrics()
+    assert (metrics["retries"], metrics["throttle_events"], metrics["failures"], metrics["successes"]) == (2, 1, 1, 1)
+
+    request = mock.Mock(side_effect=[requests.ConnectionError(), requests.ConnectionError()])
+    with pytest.raises(requests.ConnectionError):
+        run_with_retries(request, rate_limiter, max_retries=1, backoff_base=0)
+
+    request = mock.Mock(side_effect=ValueError())
+    with pytest.raises(ValueError):
+        run_with_retries(request, rate_limiter, backoff_base=0)
+    assert request.call_count == 1
+
+
+def test_acquire_async_waits_for_requests_to_finish():
+    rate_limiter = RateLimiter(max_concurrency=1)
+
+    async def run():
+        first = await rate_limiter.acquire_async()
+        asyncio.get_running_loop().call_later(.1, rate_limiter.release, first, OUTCOME_SUCCESS)
+        start = time.monotonic()
+        rate_limiter.release(await rate_limiter.acquire_async(), OUTCOME_SUCCESS)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= .1
+    assert rate_limiter.get_metrics()["rate_limited_waits"] == 1
+
+
+def test_run_with_retries_async():
+    rate_limiter = RateLimiter()
+    results = [requests.ConnectionError(), http_error(429), "response"]
+
+    async def request():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert asyncio.run(run_with_retries_async(request, rate_limiter, backoff_base=0)) == "response"
+    metrics = rate_limiter.get_metrics()
+    assert (metrics["retries"], metrics["throttle_events"], metrics["failures"], metrics["successes"]) == (2, 1, 1, 1)
+
+    results = [ValueError()]
+    with pytest.raises(ValueError):
+        asyncio.run(run_with_retries_async(request, rate_limiter, backoff_base=0))
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from library.request_batcher import RequestBatcher
+
+
+def run_in_threads(batcher: RequestBatcher, calls: list[tuple[str, dict]]) -> list:
+    results = [None] * len(calls)
+
+    def run(index: int):
+        prompt, parameters = calls[index]
+        try:
+            results[index] = batcher.run(prompt, **parameters)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_request_batcher_combines_concurrent_prompts():
+    batches = []
+
+    def run_batch(prompts, temperature):
+        batches.append((sorted(prompts), temperature))
+        return [f"{p} at {temperature}" for p in prompts]
+
+    batcher = RequestBatcher(run_batch, max_batch_size=3, max_wait=5)
+    results = run_in_threads(batcher, [(str(i), {"temperature": .1}) for i in range(6)])
+    assert results == [f"{i} at 0.1" for i in range(6)]
+    assert sorted([len(b[0]) for b in batches]) == [3, 3]
+
+
+def test_request_batcher_separates_parameters_and_flushes_partial_batches():
+    batches = []
+
+    def run_batch(prompts, temperature):
+        batches.append((sorted(prompts), temperature))
+        return [f"{p} at {temperature}" for p in prompts]
+
+    batcher = RequestBatcher(run_batch, max_batch_size=10, max_wait=.05)
+    results = run_in_threads(batcher, [("a", {"temperature": .1}), ("b", {"temperature": .2}),
+                                       ("c", {"temperature": .1})])
+    assert results == ["a at 0.1", "b at 0.2", "c at 0.1"]
+    assert sorted(batches) == [(["a", "c"], .1), (["b"], .2)]
+
+
+def test_request_batcher_errors_reach_every_prompt():
+    def run_batch(prompts):
+        raise ValueError("the server is down")
+
+    batcher = RequestBatcher(run_batch, max_batch_size=2, max_wait=5)
+    results = run_in_threads(batcher, [("a", {}), ("b", {})])
+    assert all([isinstance(r, ValueError) for r in results])
+    with pytest.raises(ValueError):
+        RequestBatcher(run_batch, max_batch_size=1).run("c")
+
+
+def test_request_batcher_errors_of_single_prompts():
+    def run_batch(prompts):
+        return [ValueError(p) if p == "fail" else p for p in prompts]
+
+    batcher = RequestBatcher(run_batch, max_batch_size=2, max_wait=5)
+    results = run_in_threads(batcher, [("a", {}), ("fail", {})])
+    assert results[0] == "a" and isinstance(results[1], ValueError)
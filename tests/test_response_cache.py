@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from library.response_cache import ResponseCache, ResponseCacheMissException, MODE_REPLAY_ONLY
+
+REQUEST = {"backend": "oobabooga_api", "model": "m", "prompt": "p", "temperature": .1, "stop": [], "max_tokens": 10}
+
+
+def test_response_cache_hits_and_misses(tmp_path):
+    cache = ResponseCache(os.path.join(tmp_path, "responses.sqlite"), max_bytes=1000)
+    key = cache.make_key(REQUEST)
+    assert cache.get(key) is None
+    cache.put(key, "response")
+    assert cache.get(key) == "response"
+    assert cache.get(cache.make_key({**REQUEST, "temperature": .2})) is None
+    assert cache.get_stats() == {"hits": 1, "misses": 2, "hit_rate": 0.333}
+
+
+def test_response_cache_replays_repeated_requests_in_order(tmp_path):
+    db_path = os.path.join(tmp_path, "responses.sqlite")
+    cache = ResponseCache(db_path, max_bytes=1000)
+    cache.put(cache.make_key(REQUEST), "junk")
+    cache.put(cache.make_key(REQUEST), "good")
+    cache.close()
+
+    replay = ResponseCache(db_path, max_bytes=1000, mode=MODE_REPLAY_ONLY)
+    assert replay.get(replay.make_key(REQUEST)) == "junk"
+    assert replay.get(replay.make_key(REQUEST)) == "good"
+    with pytest.raises(ResponseCacheMissException):
+        replay.get(replay.make_key(REQUEST))
+    replay.put(replay.make_key(REQUEST), "not saved in replay-only mode")
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(os.path.join(tmp_path, "responses.sqlite"), max_bytes=25)
+    keys = [cache.make_key({**REQUEST, "prompt": str(i)}) for i in range(3)]
+    cache.put(keys[0], "a" * 10)
+    cache.put(keys[1], "b" * 10)
+    assert cache.get(keys[0]) == "a" * 10  # keys[1] is now the least recently used
+    cache.put(keys[2], "c" * 10)
+    assert [cache.get(k) for k in keys] == ["a" * 10, None, "c" * 10]
@@ -0,0 +1,78 @@
+import pytest
+
+from library.few_shot_request import parse_few_shot_format
+from library.stream_validator import StreamValidator, VALIDATION_CONTINUE, VALIDATION_ABORT, VALIDATION_STOP
+
+RESPONSE = """
+>Prompt: Write a scene where
+- Liz encounters two men trying to rob her on a muddy street
+>Tone: tense, ominous
+>Male Characters: N/A
+>Female Characters: Liz"""
+KEYS = ["Prompt", "Tone", "Male Characters", "Female Characters"]
+
+
+def feed_tokens(validator: StreamValidator, text: str) -> tuple[str, int]:
+    """
+    :return: the validator's last action, and the number of 2 character 'tokens' it was fed.
+    """
+    for index in range(0, len(text), 2):
+        action = validator.feed(text[index:index + 2])
+        if action != VALIDATION_CONTINUE:
+            return action, index // 2 + 1
+    return VALIDATION_CONTINUE, len(text) // 2
+
+
+def test_valid_response_continues():
+    validator = StreamValidator(["Bob"], expected_keys=KEYS)
+    assert feed_tokens(validator, RESPONSE)[0] == VALIDATION_CONTINUE
+    assert validator.keys == KEYS
+    assert validator.abort_reason is None
+
+
+@pytest.mark.parametrize("value", ["", "-", " "])
+def test_short_value_aborts_when_the_next_key_starts(value):
+    validator = StreamValidator()
+    response = RESPONSE.replace("tense, ominous", value)
+    action, tokens = feed_tokens(validator, response)
+    assert action == VALIDATION_ABORT
+    assert validator.abort_reason.startswith("the value of 'Tone' is too short")
+    assert tokens * 2 < response.index(">Female")
+
+
+def test_blacklisted_value_aborts_as_it_appears():
+    validator = StreamValidator(["muddy street"])
+    action, tokens = feed_tokens(validator, RESPONSE)
+    assert action == VALIDATION_ABORT
+    assert validator.abort_reason == "the value of 'Prompt' contains the blacklisted \"muddy street\""
+    # before the next line.
+    assert tokens * 2 <= RESPONSE.index("\n>Tone")
+
+
+def test_ignored_keys_are_not_checked():
+    validator = StreamValidator(["Liz"], ignored_keys=["Prompt", "Female Characters"])
+    assert feed_tokens(validator, RESPONSE.replace("tense", "Liz") + "\n")[0] == VALIDATION_ABORT
+    validator = StreamValidator(["Liz"], ignored_keys=["Prompt", "Female Characters"])
+    assert feed_tokens(validator, RESPONSE + "\n>Male Characters: -")[0] == VALIDATION_STOP
+
+
+@pytest.mark.parametrize("extra", ["\n>Story: more text", "\n\n>Prompt: another prompt\n>Tone: -"])
+def test_stops_after_the_expected_keys(extra):
+    validator = StreamValidator(expected_keys=KEYS)
+    action, _ = feed_tokens(validator, RESPONSE + extra)
+    assert action == VALIDATION_STOP
+    assert parse_few_shot_format(validator.text[:validator.stop_offset]) == parse_few_shot_format(RESPONSE)
+
+
+def test_stops_at_a_repeated_key():
+    # without expected keys, only a repeated key shows that the response has run past its entry.
+    validator = StreamValidator()
+    action, _ = feed_tokens(validator, RESPONSE + "\n>Story: more text\n>Prompt: another prompt")
+    assert action == VALIDATION_STOP
+    assert validator.text[:validator.stop_offset] == RESPONSE + "\n>Story: more text\n"
+
+
+def test_last_value_is_checked_before_stopping():
+    validator = StreamValidator(expected_keys=KEYS)
+    action, _ = feed_tokens(validator, RESPONSE.replace("Liz", "?") + "\n>Story:")
+    assert action == VALIDATION_ABORT
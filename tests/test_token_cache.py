@@ -0,0 +1,37 @@
+import os
+
+from library.token_cache import TokenCountCache
+
+
+def test_token_count_cache_hits_and_misses():
+    cache = TokenCountCache("tokenizer", max_entries=10)
+    keys = [cache.make_key("apple"), cache.make_key("banana")]
+    assert cache.get_many(keys) == [None, None]
+
+    cache.put_many({keys[0]: 3})
+    assert cache.get_many(keys) == [3, None]
+    assert cache.get_stats() == {"hits": 1, "misses": 3, "entries": 1}
+
+
+def test_token_count_cache_lru_eviction():
+    cache = TokenCountCache("tokenizer", max_entries=2)
+    a, b, c = cache.make_key("a"), cache.make_key("b"), cache.make_key("c")
+    cache.put_many({a: 1, b: 2})
+    assert cache.get_many([a]) == [1]  # 'a' is now the most recently used
+    cache.put_many({c: 3})
+    assert cache.get_many([a, b, c]) == [1, None, 3]
+
+
+def test_token_count_cache_key_includes_tokenizer():
+    assert TokenCountCache("tokenizer1", 10).make_key("apple") != TokenCountCache("tokenizer2", 10).make_key("apple")
+
+
+def test_token_count_cache_persists_to_disk(tmp_path):
+    db_path = os.path.join(tmp_path, "token_counts.sqlite")
+    cache = TokenCountCache("tokenizer", max_entries=10, db_path=db_path)
+    cache.put_many({cache.make_key("apple"): 3})
+    cache.flush()
+
+    new_cache = TokenCountCache("tokenizer", max_entries=10, db_path=db_path)
+    assert new_cache.get_many([new_cache.make_key("apple"), new_cache.make_key("banana")]) == [3, None]
+    assert new_cache.get_stats()["hits"] == 1
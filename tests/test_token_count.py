@@ -0,0 +1,59 @@
+import os
+from unittest import mock
+
+import pytest
+
+from library import token_count
+from library.token_count import Tokenizer, get_token_count, get_token_counts, get_continued_token_counts, get_tokens, \
+    get_tokens_batch, get_tokenizer, init_tokenizer
+
+
+TEXTS = [
+    "The car skidded to a stop, throwing Harry against the door.",
+    "",
+    "\"P-Please, miss...\" The taller one stammered.\nLiz studied him closely.",
+    "Sed ut perspiciatis, unde omnis iste natus error sit voluptatem",
+]
+
+
+def test_get_token_counts_matches_get_token_count():
+    assert get_token_counts(TEXTS) == [get_token_count(t) for t in TEXTS]
+    assert get_token_counts(TEXTS, num_threads=1) == [get_token_count(t) for t in TEXTS]
+
+
+def test_get_tokens_batch_matches_get_tokens():
+    assert get_tokens_batch(TEXTS) == [get_tokens(t) for t in TEXTS]
+
+
+def test_batch_empty_list():
+    assert get_token_counts([]) == []
+    assert get_tokens_batch([]) == []
+
+
+def test_get_continued_token_counts_add_up_to_the_joined_count():
+    lines = [line + "\n" for line in TEXTS] + [" leading space\n", "日本語\n"]
+    for start in range(len(lines)):
+        chunk_lines = lines[start:]
+        expected = get_token_count("".join(chunk_lines))
+        assert get_token_counts(chunk_lines[:1])[0] + sum(get_continued_token_counts(chunk_lines[1:])) == expected
+
+
+def test_tokenizer_backends_implement_the_interface():
+    with pytest.raises(TypeError):
+        Tokenizer("tokenizer.model")
+
+
+def test_thread_pool_size_is_set_when_the_tokenizer_is_loaded():
+    with mock.patch.dict(os.environ, clear=True), mock.patch.object(token_count, "_tokenizer", None), \
+            mock.patch.object(token_count, "_num_threads_override", None):
+        init_tokenizer(2)
+        assert os.environ["RAYON_NUM_THREADS"] == "2"
+        # later batches don't change it.
+        get_tokenizer().count_batch(TEXTS, 4)
+        assert os.environ["RAYON_NUM_THREADS"] == "2"
+
+
+def test_tokenizer_id_is_only_hashed_once():
+    tokenizer_id = token_count.get_tokenizer_id()
+    with mock.patch("builtins.open", side_effect=AssertionError("the model file was read again")):
+        assert token_count.get_tokenizer_id() == tokenizer_id
@@ -0,0 +1,56 @@
+import os
+import pytest
+
+from library.token_count import SentencePieceTokenizer, FastTokenizer
+
+pytest.importorskip("tokenizers")
+
+CORPUS_FILES = [
+    "tests/books_to_chunks/in/the_bible.txt",
+    "tests/books_to_chunks2/in/the_bible.txt",
+    "tests/books_to_chunks3/in/the_bible.txt",
+    "tests/process_prompts_generate/in/garbage/test1.txt",
+    "tests/process_prompts_generate/in/garbage/test2.json",
+    "processors/few_shot_templates/full_prompt.txt",
+]
+
+
+@pytest.fixture(scope="module")
+def corpus() -> list[str]:
+    texts = []
+    for corpus_file in CORPUS_FILES:
+        with open(corpus_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        texts.append(content)
+        texts.extend(content.split("\n"))
+    for ksj_file in os.listdir("tests/ksj_to_chunks/expected"):
+        if ksj_file.endswith(".txt"):
+            with open(os.path.join("tests/ksj_to_chunks/expected", ksj_file), "r", encoding="utf-8") as f:
+                texts.append(f.read())
+    texts.extend(["", " ", "\n", "  two leading spaces", "trailing space ", "\ttab", "ünïcödé 日本語 🙂"])
+    return texts
+
+
+@pytest.fixture(scope="module")
+def backends():
+    return SentencePieceTokenizer(), FastTokenizer()
+
+
+def test_backends_have_identical_counts(corpus, backends):
+    sentencepiece, fast = backends
+    assert fast.count_batch(corpus, -1) == sentencepiece.count_batch(corpus, -1)
+    assert fast.count_batch(corpus, 1) == sentencepiece.count_batch(corpus, 1)
+
+
+def test_backends_have_identical_tokens(corpus, backends):
+    sentencepiece, fast = backends
+    assert fast.encode_batch(corpus, -1) == sentencepiece.encode_batch(corpus, -1)
+
+
+def test_backends_decode_identically(corpus, backends):
+    sentencepiece, fast = backends
+    # books_to_chunks decodes fragments of a paragraph, which may start in the middle of a word
+    for tokens in sentencepiece.encode_batch(corpus, -1):
+        for start in [0, 1, len(tokens) // 2]:
+            fragment = tokens[start:start + 40]
+            assert fast.decode(fragment) == sentencepiece.decode(fragment)
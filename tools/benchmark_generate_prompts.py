@@ -0,0 +1,192 @@
+"""
+benchmark_generate_prompts measures the throughput of batch_generate_prompts, end to end, against
+tools.mock_inference_server (run in a subprocess, so that its cpu time isn't counted as the client's).
+A synthetic chunk tree is generated, then prompts are generated for it once per concurrency level, reporting files/s,
+the p50/p95/p99 latency of the AI requests and the client's cpu time.
+With --compare_cache_prompt, each concurrency level is run with and without oobabooga_api.cache_prompt, reporting
+the prompt tokens that the server had to process for each prompt (the rest were reused from its prompt cache).
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Sequence
+from unittest import mock
+
+import requests
+
+from library import ai_requests
+from library.settings_manager import settings, ROOT_FOLDER
+from process_prompts import batch_generate_prompts
+
+WORDS = ("the a she he they walked into room looked at door window rain night light quiet voice said asked "
+         "slowly suddenly again never always old young small dark cold warm hand eyes face heart city road").split()
+
+
+def make_chunk_tree(folder: str, files: int, words_per_file: int, seed: int = 0):
+    rng = random.Random(seed)
+    for index in range(files):
+        book_folder = os.path.join(folder, f"book_{index // 100}")
+        os.makedirs(book_folder, exist_ok=True)
+        sentences = []
+        for _ in range(0, words_per_file, 12):
+            sentence = " ".join(rng.choices(WORDS, k=12))
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        with open(os.path.join(book_folder, f"chunk_{index}.txt"), "w", encoding="utf-8") as f:
+            f.write(" ".join(sentences))
+
+
+def start_mock_server(server_args: list[str]) -> tuple[subprocess.Popen, str]:
+    """
+    :param server_args: arguments for tools.mock_inference_server.
+    :return: the server process and its completions url.
+    """
+    process = subprocess.Popen([sys.executable, "-m", "tools.mock_inference_server", "--port", "0", *server_args],
+                               cwd=ROOT_FOLDER, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise RuntimeError("tools.mock_inference_server failed to start")
+    return process, url
+
+
+def get_server_stats(request_url: str) -> dict[str, int]:
+    stats_url = request_url.rsplit("/v1/", 1)[0] + "/stats"
+    return requests.get(stats_url, timeout=10).json()
+
+
+def write_settings(path: str, request_url: str, concurrency: int, stream: bool, cache_prompt: bool = True):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"[ai_settings]\n"
+                f"output_mode = 'silent'\n"
+                f"[oobabooga_api]\n"
+                f"request_url = {json.dumps(request_url)}\n"
+                f"stream = {str(stream).lower()}\n"
+                f"cache_prompt = {str(cache_prompt).lower()}\n"
+                f"pool_size = {max(concurrency, 1)}\n"
+                f"[rate_limit]\n"
+                f"backoff_base = 0.05\n"
+                f"backoff_max = 1\n"
+                f"[prompt_gen]\n"
+                f"continuation_likelyhood = 0\n")
+
+
+def get_percentiles(latencies: list[float]) -> tuple[float, float, float]:
+    if len(latencies) < 2:
+        return (latencies[0],) * 3 if latencies else (0, 0, 0)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return quantiles[49], quantiles[94], quantiles[98]
+
+
+def run_once(in_folder: str, out_folder: str, concurrency: int) -> dict:
+    """
+    :return: the measurements of one batch_generate_prompts run.
+    """
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def timed(request_function):
+        def timed_request(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return request_function(*args, **kwargs)
+            finally:
+                with latencies_lock:
+                    latencies.append(time.perf_counter() - start)
+        return timed_request
+
+    files = sum([len(files) for _, _, files in os.walk(in_folder)])
+    ai_requests.close_ooba_session()
+    # with concurrency, requests are batched (see ai_requests.batched_requests); a batch counts as one request.
+    with mock.patch.object(ai_requests, "run_ai_request_ooba", timed(ai_requests.run_ai_request_ooba)), \
+            mock.patch.object(ai_requests, "run_ai_requests_ooba", timed(ai_requests.run_ai_requests_ooba)), \
+            open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        batch_generate_prompts(in_folder, out_folder, concurrency=concurrency)
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    p50, p95, p99 = get_percentiles(latencies)
+    return {"concurrency": concurrency, "files": files, "requests": len(latencies), "seconds": wall,
+            "files_per_second": files / wall, "p50": p50, "p95": p95, "p99": p99, "cpu_seconds": cpu,
+            "cpu_ms_per_file": 1000 * cpu / files}
+
+
+def run(files: int, words_per_file: int, concurrency_levels: list[int], stream: bool, server_args: list[str],
+        cache_prompt_modes: Sequence[bool] = (True,)) -> list[dict]:
+    """
+    :param files:
+    :param words_per_file:
+    :param concurrency_levels:
+    :param stream:
+    :param server_args: arguments for tools.mock_inference_server.
+    :param cache_prompt_modes: the values of oobabooga_api.cache_prompt to run each concurrency level with.
+    :return: the measurements of each run.
+    """
+    results = []
+    server, url = start_mock_server(server_args)
+    try:
+        with tempfile.TemporaryDirectory() as temp_folder:
+            in_folder = os.path.join(temp_folder, "in")
+            make_chunk_tree(in_folder, files, words_per_file)
+            settings_path = os.path.join(temp_folder, "benchmark_settings.toml")
+            for cache_prompt in cache_prompt_modes:
+                for concurrency in concurrency_levels:
+                    write_settings(settings_path, url, concurrency, stream, cache_prompt)
+                    settings.override_settings(settings_path)
+                    server_stats = get_server_stats(url)
+                    try:
+                        out_folder = os.path.join(temp_folder, f"out_{concurrency}_{cache_prompt}")
+                        result = run_once(in_folder, out_folder, concurrency)
+                    finally:
+                        settings.remove_override_settings()
+                        ai_requests.close_ooba_session()
+                    new_server_stats = get_server_stats(url)
+                    prompts = new_server_stats["prompts"] - server_stats["prompts"]
+                    processed = new_server_stats["prompt_tokens_processed"] - server_stats["prompt_tokens_processed"]
+                    result.update({"cache_prompt": cache_prompt,
+                                   "prompt_tokens_per_prompt": processed / prompts if prompts else 0})
+                    results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'cache_prompt':>13}{'concurrency':>12}{'files':>7}{'requests':>9}{'seconds':>9}{'files/s':>9}"
+          f"{'p50 (s)':>9}{'p95 (s)':>9}{'p99 (s)':>9}{'cpu (s)':>9}{'cpu ms/file':>12}{'prompt tok/prompt':>18}")
+    for r in results:
+        print(f"{str(r['cache_prompt']):>13}{r['concurrency']:>12}{r['files']:>7}{r['requests']:>9}"
+              f"{r['seconds']:>9.2f}{r['files_per_second']:>9.2f}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}"
+              f"{r['cpu_seconds']:>9.2f}{r['cpu_ms_per_file']:>12.2f}{r['prompt_tokens_per_prompt']:>18.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="""Benchmarks batch_generate_prompts against a local mock inference server.
+
+python -m tools.benchmark_generate_prompts --files 200 --concurrency 1 4 16 --tokens_per_second 50""")
+    parser.add_argument('--files', type=int, default=100, help='The number of synthetic chunks.')
+    parser.add_argument('--words_per_file', type=int, default=300)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16],
+                        help='The concurrency levels to try.')
+    parser.add_argument('--no_stream', action='store_true', help='Make non-streaming requests.')
+    parser.add_argument('--tokens_per_second', type=float, default=50, help='See tools.mock_inference_server.')
+    parser.add_argument('--time_to_first_token', type=float, default=0.2, help='See tools.mock_inference_server.')
+    parser.add_argument('--prompt_tokens_per_second', type=float, default=2000,
+                        help='See tools.mock_inference_server.')
+    parser.add_argument('--error_rate', type=float, default=0, help='See tools.mock_inference_server.')
+    parser.add_argument('--compare_cache_prompt', action='store_true',
+                        help='Run each concurrency level without, then with, oobabooga_api.cache_prompt.')
+    args = parser.parse_args()
+
+    run(args.files, args.words_per_file, args.concurrency, not args.no_stream,
+        ["--tokens_per_second", str(args.tokens_per_second), "--time_to_first_token", str(args.time_to_first_token),
+         "--prompt_tokens_per_second", str(args.prompt_tokens_per_second), "--error_rate", str(args.error_rate),
+         "--seed", "0"],
+        (False, True) if args.compare_cache_prompt else (True,))
@@ -0,0 +1,60 @@
+"""
+benchmark_startup measures the cold start (a fresh interpreter importing the module) of each entry point.
+Backends are loaded on first use, so the 'eager' column adds what every entry point used to pay at import time:
+the sentencepiece tokenizer and the oobabooga/gemini request libraries.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from library.settings_manager import ROOT_FOLDER
+
+ENTRY_POINTS = [
+    "process_prompts",
+    "finalize_dataset",
+    "extractors.books_to_chunks",
+    "extractors.ksj_to_chunks",
+    "tools.merge_prompts",
+    "tools.inject_hardcoded_keys",
+    "tools.examples_to_prompt_jsons",
+    "tools.prompt_tester",
+]
+
+EAGER_LOADING = "import library.token_count; library.token_count.get_tokenizer(); " \
+                "import requests, sseclient, google.generativeai"
+
+
+def time_snippet(snippet: str, runs: int) -> float:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", snippet], cwd=ROOT_FOLDER, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def run(entry_points: list[str], runs: int):
+    baseline = time_snippet("pass", runs)
+    print(f"interpreter startup: {baseline * 1000:.0f}ms (subtracted from the results below)")
+    print(f"{'entry point':<32}{'lazy (ms)':>12}{'eager (ms)':>12}{'saved (ms)':>12}")
+    for entry_point in entry_points:
+        lazy = time_snippet(f"import {entry_point}", runs) - baseline
+        eager = time_snippet(f"import {entry_point}; {EAGER_LOADING}", runs) - baseline
+        print(f"{entry_point:<32}{lazy * 1000:>12.0f}{eager * 1000:>12.0f}{(eager - lazy) * 1000:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="""Measures the import time of each entry point in a fresh interpreter, with and without loading the
+tokenizer and AI backends up front.
+
+python -m tools.benchmark_startup --runs 5""")
+    parser.add_argument('--runs', type=int, default=5, help='The number of runs per measurement; the median is used.')
+    parser.add_argument('--entry_points', nargs='+', default=ENTRY_POINTS, help='The modules to import.')
+    args = parser.parse_args()
+
+    run(args.entry_points, args.runs)
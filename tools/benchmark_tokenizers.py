@@ -0,0 +1,58 @@
+"""
+benchmark_tokenizers compares the throughput of the tokenizer backends (see tokenizer.backend in settings.toml) on a
+folder of .txt files, split into paragraphs the same way as books_to_chunks. The token count cache is bypassed.
+"""
+
+import argparse
+import os
+import time
+
+from extractors.books_to_chunks import preprocess_text
+from library.token_count import TOKENIZER_BACKENDS
+
+
+def load_paragraphs(in_folder: str) -> list[str]:
+    paragraphs = []
+    for f in sorted(os.listdir(in_folder)):
+        if not f.endswith(".txt"):
+            continue
+        with open(os.path.join(in_folder, f), 'r', encoding='utf-8', errors='ignore') as file:
+            paragraphs.extend(preprocess_text(file.read()))
+    return paragraphs
+
+
+def run(in_folder: str, backends: list[str], num_threads: list[int], repeats: int):
+    paragraphs = load_paragraphs(in_folder)
+    total_chars = sum([len(p) for p in paragraphs])
+    print(f"{len(paragraphs)} paragraphs, {total_chars} characters")
+    print(f"{'backend':<16}{'threads':>8}{'load (s)':>10}{'best (s)':>10}{'paragraphs/s':>14}{'tokens/s':>14}")
+    for backend in backends:
+        start = time.perf_counter()
+        tokenizer = TOKENIZER_BACKENDS[backend]()
+        load_time = time.perf_counter() - start
+        for threads in num_threads:
+            best = None
+            token_count = 0
+            for _ in range(repeats):
+                start = time.perf_counter()
+                token_count = sum(tokenizer.count_batch(paragraphs, threads))
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            print(f"{backend:<16}{threads:>8}{load_time:>10.3f}{best:>10.3f}{len(paragraphs) / best:>14.0f}"
+                  f"{token_count / best:>14.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="""Compares the throughput of the tokenizer backends on a folder of txt files.
+
+python -m tools.benchmark_tokenizers --input_folder tests/books_to_chunks/in --num_threads 1 -1""")
+    parser.add_argument('--input_folder', type=str, required=True, help='A folder of .txt files to tokenize.')
+    parser.add_argument('--backends', nargs='+', default=list(TOKENIZER_BACKENDS.keys()),
+                        help='The backends to compare.')
+    parser.add_argument('--num_threads', nargs='+', type=int, default=[1, -1],
+                        help='The thread counts to try; -1 uses every core.')
+    parser.add_argument('--repeats', type=int, default=3, help='The number of runs per measurement; the best is kept.')
+    args = parser.parse_args()
+
+    run(args.input_folder, args.backends, args.num_threads, args.repeats)
@@ -3,18 +3,18 @@ import os
 import tqdm
 import json
 
-from library.batching_utils import get_subpaths_to_process, write_output_and_debug_files
-from library.prompt_parser import sort_keys, load_prompt_file
+from library.batching_utils import get_inputs_to_process, write_output_and_debug_files
+from library.prompt_parser import sort_keys
 
 
 def convert_examples(in_folder: str, out_folder: str):
-    subpaths = get_subpaths_to_process(in_folder, out_folder)
+    chunk_inputs = get_inputs_to_process(in_folder, out_folder)
 
-    for subpath in tqdm.tqdm(subpaths):
-        raw_text, _ = load_prompt_file(os.path.join(in_folder, subpath))
+    for chunk_input in tqdm.tqdm(chunk_inputs):
+        raw_text, _ = chunk_input.load()
         prompt_dict = {}
 
-        assert "\n\n---\n\n" in raw_text, f"splitter not found in {subpath}"
+        assert "\n\n---\n\n" in raw_text, f"splitter not found in {chunk_input.key}"
 
         parts = raw_text.split("\n\n---\n\n", maxsplit=3)
 
@@ -23,7 +23,7 @@ def convert_examples(in_folder: str, out_folder: str):
         elif len(parts) == 2:
             prompt_dict["prompt"], prompt_dict["story"] = parts
 
-        directory, filename = os.path.split(subpath)
+        directory, filename = os.path.split(chunk_input.subpath)
         result = json.dumps(sort_keys(prompt_dict), indent=4)
         write_output_and_debug_files(os.path.join(out_folder, directory),
                                      filename.replace(".txt", f".json"),
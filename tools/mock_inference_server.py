@@ -0,0 +1,274 @@
+"""
+mock_inference_server stands in for an oobabooga (or any OpenAI compatible) server, so that the request path can be
+tested and benchmarked without a GPU: it answers POSTs to /v1/completions with canned few shot responses, either
+streamed as server sent events or in a single json reply, at a configurable speed and error rate.
+Like llama.cpp's server, it keeps the last few prompts it processed, and a request with "cache_prompt" only has to
+process the part of its prompt after the longest prefix it shares with one of them; GET /stats returns the counts.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# in the format that processors/few_shot_templates/full_prompt.txt asks for.
+DEFAULT_RESPONSES = [
+    """>Prompt: Write a scene where
+- The main character is a brave young woman named Liz who is travelling alone.
+- Liz encounters two men trying to rob her on a muddy street
+- She intimidates them into backing down without a fight
+>Tone: tense, ominous, defiant
+>Writing style: descriptive, immersive, emotional perspective
+>Pacing: medium
+>Sensory detail: High
+>Moment-to-moment detail: High
+>Point of View: Third person (Liz)
+>Male Characters: N/A
+>Female Characters: Liz""",
+    """>Prompt: Write a scene where
+- The main character is a lonely woman who sitting by the fire reading a book during a stormy night
+- the storm intensifies, causing the power to go out
+- she opens the window to feel the rain and wind
+>Tone: melancholic, cozy
+>Writing style: descriptive, introspective
+>Pacing: slow
+>Sensory detail: High
+>Moment-to-moment detail: medium
+>Point of View: Third person (woman)
+>Male Characters: N/A
+>Female Characters: unnamed woman""",
+]
+
+
+class MockInferenceServer(ThreadingHTTPServer):
+    """
+    :param address: (host, port); port 0 picks a free port (see server_address).
+    :param tokens_per_second: the generation speed of each request; 0 sends every token at once.
+    :param time_to_first_token: seconds before the first token of a response.
+    :param prompt_tokens_per_second: the prompt processing speed, which adds to time_to_first_token for the tokens
+        that aren't cached; 0 processes prompts instantly.
+    :param prompt_cache_slots: how many of the most recent prompts are kept for requests with "cache_prompt".
+    :param error_rate: the fraction of requests that fail with error_status instead of a response.
+    :param responses: the responses to cycle through; a response is split into 'tokens' at each word.
+    :param supports_batches: accept a list of prompts in a (non-streaming) request, completing each of them;
+        otherwise, a list of prompts is answered with a 400, like servers that don't support batches.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], tokens_per_second: float = 0, time_to_first_token: float = 0,
+                 error_rate: float = 0, error_status: int = 503, responses: Optional[list[str]] = None,
+                 seed: Optional[int] = None, supports_batches: bool = True, prompt_tokens_per_second: float = 0,
+                 prompt_cache_slots: int = 4):
+        super().__init__(address, MockCompletionHandler)
+        self.tokens_per_second = tokens_per_second
+        self.time_to_first_token = time_to_first_token
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.responses = responses or DEFAULT_RESPONSES
+        self.supports_batches = supports_batches
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.prompt_cache_slots = prompt_cache_slots
+        self._prompt_cache = []  # type: list[str]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_response = 0
+        self.stats = {"requests": 0, "errors": 0, "prompts": 0, "tokens_sent": 0, "prompt_tokens": 0,
+                      "prompt_tokens_processed": 0, "disconnects": 0, "max_in_flight": 0}
+        self._in_flight = 0
+
+    def next_responses(self, prompt_count: int) -> Optional[list[str]]:
+        """
+        :param prompt_count: the number of prompts in the request.
+        :return: a response for each prompt, or None if the request should fail.
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            if self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return None
+            self.stats["prompts"] += prompt_count
+            responses = []
+            for _ in range(prompt_count):
+                responses.append(self.responses[self._next_response % len(self.responses)])
+                self._next_response += 1
+            return responses
+
+    def record_in_flight(self, change: int):
+        """
+        :param change: 1 when a completion request starts, -1 when it ends.
+        """
+        with self._lock:
+            self._in_flight += change
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self._in_flight)
+
+    def record_tokens(self, token_count: int):
+        with self._lock:
+            self.stats["tokens_sent"] += token_count
+
+    def record_disconnect(self):
+        with self._lock:
+            self.stats["disconnects"] += 1
+
+    def process_prompt(self, prompt: str, cache_prompt: bool) -> int:
+        """
+        :param prompt:
+        :param cache_prompt: reuse the longest prefix that the prompt shares with a cached prompt.
+        :return: the number of the prompt's tokens that had to be processed.
+        """
+        prompt_tokens = len(split_into_tokens(prompt))
+        with self._lock:
+            cached_tokens = 0
+            if cache_prompt:
+                for cached in self._prompt_cache:
+                    # a prefix that ends part way through a word doesn't count that word.
+                    prefix = os.path.commonprefix([cached, prompt])
+                    cached_tokens = max(cached_tokens, len(re.findall(r"\s*\S+(?=\s)", prefix)))
+                if prompt in self._prompt_cache:
+                    self._prompt_cache.remove(prompt)
+                self._prompt_cache.append(prompt)
+                del self._prompt_cache[:-self.prompt_cache_slots]
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["prompt_tokens_processed"] += prompt_tokens - cached_tokens
+        return prompt_tokens - cached_tokens
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockInferenceServer
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/stats":
+            self.send_body(404, "application/json", json.dumps({"error": f"unknown path {self.path}"}))
+            return
+        self.send_body(200, "application/json", json.dumps(self.server.get_stats()))
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/completions":
+            self.send_body(404, "application/json", json.dumps({"error": f"unknown path {self.path}"}))
+            return
+        self.server.record_in_flight(1)
+        try:
+            self.complete()
+        finally:
+            self.server.record_in_flight(-1)
+
+    def complete(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        stream = request.get("stream", False)
+        prompts = request["prompt"]
+        if isinstance(prompts, list) and (stream or not self.server.supports_batches):
+            self.send_body(400, "application/json", json.dumps({"error": "batched prompts aren't supported"}))
+            return
+        responses = self.server.next_responses(len(prompts) if isinstance(prompts, list) else 1)
+        if responses is None:
+            self.send_body(self.server.error_status, "application/json", json.dumps({"error": "injected error"}))
+            return
+
+        all_tokens = [split_into_tokens(r)[:request.get("max_tokens", None)] for r in responses]
+        processed_tokens = sum([self.server.process_prompt(p, request.get("cache_prompt", False))
+                                for p in (prompts if isinstance(prompts, list) else [prompts])])
+        prefill_seconds = (processed_tokens / self.server.prompt_tokens_per_second
+                           if self.server.prompt_tokens_per_second else 0)
+        time.sleep(self.server.time_to_first_token + prefill_seconds)
+        if not stream:
+            # a batch is generated in parallel, so it takes as long as its longest response.
+            time.sleep(self.get_token_delay() * max([len(t) for t in all_tokens]))
+            choices = [{"index": i, "text": "".join(t)} for i, t in enumerate(all_tokens)]
+            self.server.record_tokens(sum([len(t) for t in all_tokens]))
+            self.send_body(200, "application/json", json.dumps({"choices": choices}))
+            return
+
+        tokens = all_tokens[0]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for index, token in enumerate(tokens):
+                if index > 0:
+                    time.sleep(self.get_token_delay())
+                self.write_chunk(f"data: {json.dumps({'choices': [{'index': 0, 'text': token}]})}\n\n")
+                self.server.record_tokens(1)
+            self.write_chunk("")  # the end of the chunked body
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream (e.g. it cancelled the request); stop generating, like a real server.
+            self.server.record_disconnect()
+            self.close_connection = True
+
+    def get_token_delay(self) -> float:
+        return 1 / self.server.tokens_per_second if self.server.tokens_per_second else 0
+
+    def send_body(self, status: int, content_type: str, body: str):
+        encoded = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def write_chunk(self, text: str):
+        encoded = text.encode("utf-8")
+        self.wfile.write(f"{len(encoded):X}\r\n".encode("ascii") + encoded + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def split_into_tokens(text: str) -> list[str]:
+    """
+    :param text:
+    :return: the text split before each word, roughly the way a tokenizer streams text.
+    """
+    return re.findall(r"\s*\S+", text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="""Runs a stand-in for an OpenAI compatible completions server, answering with canned few shot responses.
+
+python -m tools.mock_inference_server --port 5000 --tokens_per_second 30 --time_to_first_token 0.5""")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=5000, help='The port to listen on; 0 picks a free port.')
+    parser.add_argument('--tokens_per_second', type=float, default=0,
+                        help='The generation speed of each request; 0 sends responses as fast as possible.')
+    parser.add_argument('--time_to_first_token', type=float, default=0,
+                        help='Seconds before the first token of each response.')
+    parser.add_argument('--prompt_tokens_per_second', type=float, default=0,
+                        help='The prompt processing speed, for the part of each prompt that isn\'t cached; 0 is '
+                             'instant.')
+    parser.add_argument('--prompt_cache_slots', type=int, default=4,
+                        help='How many recent prompts are kept for requests with "cache_prompt".')
+    parser.add_argument('--error_rate', type=float, default=0,
+                        help='The fraction of requests that fail with --error_status.')
+    parser.add_argument('--error_status', type=int, default=503)
+    parser.add_argument('--responses_file', type=str, default=None,
+                        help='A json list of responses to cycle through, instead of the built in few shot responses.')
+    parser.add_argument('--seed', type=int, default=None, help='Seeds the error injection.')
+    parser.add_argument('--no_batches', action='store_true',
+                        help='Reject requests with a list of prompts, like servers that don\'t support batches.')
+    args = parser.parse_args()
+
+    canned_responses = None
+    if args.responses_file:
+        with open(args.responses_file, 'r', encoding='utf-8') as f:
+            canned_responses = json.load(f)
+    mock_server = MockInferenceServer((args.host, args.port), args.tokens_per_second, args.time_to_first_token,
+                                      args.error_rate, args.error_status, canned_responses, args.seed,
+                                      not args.no_batches, args.prompt_tokens_per_second, args.prompt_cache_slots)
+    # the first line of output is the url, so that a parent process can find the port that was picked.
+    print(f"http://{mock_server.server_address[0]}:{mock_server.server_address[1]}/v1/completions", flush=True)
+    try:
+        mock_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(mock_server.stats), flush=True)
@@ -3,7 +3,7 @@ import json
 import tqdm
 import argparse
 
-from library.ai_requests import run_ai_request
+from library.ai_requests import run_ai_request, print_request_metrics, print_response_cache_stats
 
 
 def run(filepath: str, out_folder: str, trials: int, response_length: int):
@@ -27,6 +27,8 @@ def run(filepath: str, out_folder: str, trials: int, response_length: int):
             f.write(prompt)
             f.write("\n")
             f.write(result)
+    print_request_metrics()
+    print_response_cache_stats()
 
 
 def get_prompt_and_outfile(template, replacements_json, out_folder, trials):
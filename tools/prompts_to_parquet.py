@@ -1,26 +1,19 @@
 import argparse
-import os
 import tqdm
 import pandas as pd
 import random
 
-from library.prompt_parser import get_full_text_from_prompt_dict, load_prompt_file
+from library.batching_utils import list_inputs
+from library.prompt_parser import get_full_text_from_prompt_dict
 
 
 def generate_parquet(in_folder: str, out_file: str):
-    input_filepaths = []
-    for subfolder in os.listdir(in_folder):
-        if not os.path.isdir(os.path.join(in_folder, subfolder)):
-            continue
-        for filename in os.listdir(os.path.join(in_folder, subfolder)):
-            fp = os.path.join(in_folder, subfolder, filename)
-            if os.path.isfile(fp) and (fp.endswith(".txt") or fp.endswith(".json")):
-                input_filepaths.append(fp)
-    random.shuffle(input_filepaths)
+    chunk_inputs = list_inputs(in_folder, extensions=(".txt", ".json"))
+    random.shuffle(chunk_inputs)
 
     data_list = []
-    for subpath in tqdm.tqdm(input_filepaths):
-        script_chunk, prompt_dict = load_prompt_file(os.path.join(subpath))
+    for chunk_input in tqdm.tqdm(chunk_inputs):
+        script_chunk, prompt_dict = chunk_input.load()
         story = script_chunk
         if prompt_dict:
             story = get_full_text_from_prompt_dict(prompt_dict)
@@ -38,7 +31,7 @@ txt_to_dataset. Retains only the story data.
 python -m tools.prompts_to_parquet --input_folder in --output_file out""")
     parser.add_argument('--input_folder', type=str, required=True,
                         help='Input folder path. Should contain subfolders containing story chunks (.txt) or prompt'
-                             ' (.json) files.')
+                             ' (.json) files, and/or chunk shards (.chunks.jsonl, .chunks.parquet).')
     parser.add_argument('--output_file', type=str, required=True,
                         help='Output path of the parquet file.')
     args = parser.parse_args()